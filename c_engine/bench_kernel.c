@@ -0,0 +1,128 @@
+/*
+BENCHMARK
+training kernel: samples/sec of train() against the per-sample
+kernel it replaced (shuffle_TS, isolate_mb, calculate_CgradC)
+usage: nnfit_bench [ts_size] [mb_size] [epochs] [threads]
+*/
+
+#include "nnfit.h"
+
+
+// ---------------------------------------------
+// the previous main loop, kept as reference
+int train_reference(xfx_pair *train_set, float *wb_flat, float *C_epoch)
+{
+    model_param wb_ref = init_wb(wb_flat);
+    model_param *wb = &wb_ref;
+    xfx_pair *shuffled_ts = NULL;
+    xfx_pair *mb = NULL;
+    int mb_number = (int) ts_size/mb_size;
+    loss_gradloss CgradC_mb;
+    int epoch_converged = 0;
+
+    for (int epoch_index = 0; epoch_index < epoch_number; epoch_index++)
+    {
+        shuffled_ts = shuffle_TS(train_set);
+        for (int mb_index = 0; mb_index < mb_number; mb_index++)
+        {
+            mb = isolate_mb(shuffled_ts, mb_index);
+            CgradC_mb = calculate_CgradC(mb, *wb);
+            for(int i = 0; i < 3; i++)
+                {wb->w_layer_2[0][i] -= eta * CgradC_mb.gradC[i];}
+            for(int i = 0; i < 3; i++)
+                {wb->w_layer_1[i][0] -= eta * CgradC_mb.gradC[i+3];}
+            wb->b_layer_2[0] -= eta * CgradC_mb.gradC[6];
+            for(int i = 0; i < 3; i++)
+                {wb->b_layer_1[i] -= eta * CgradC_mb.gradC[i+7];}
+            C_epoch[epoch_index] += CgradC_mb.C;
+            free(mb);
+        }
+        C_epoch[epoch_index] = C_epoch[epoch_index] / (mb_number);
+        free(shuffled_ts);
+        epoch_converged = epoch_index;
+    }
+
+    return epoch_converged;
+}
+
+// ---------------------------------------------
+double now(void)
+{
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + 1e-9*t.tv_nsec;
+}
+
+// ---------------------------------------------
+// times one training function; returns samples/sec
+double bench(int (*train_fn)(xfx_pair *, float *, float *), \
+    xfx_pair *train_set, ini_data ini_d, float *final_C)
+{
+    float wb[N_PARAM(3)];
+    memcpy(wb, ini_d.wb, sizeof(wb));
+    float *C_epoch = calloc(epoch_number, sizeof(float));
+    eta = ini_d.eta;
+    delta = 0; // never stop early: same work for both kernels
+
+    double start = now();
+    train_fn(train_set, wb, C_epoch);
+    double seconds = now() - start;
+
+    *final_C = C_epoch[epoch_number - 1];
+    free(C_epoch);
+    double samples = (double) epoch_number * (ts_size/mb_size) * mb_size;
+
+    return samples/seconds;
+}
+
+int main(int argc, char *argv[])
+{
+    ts_size = argc > 1 ? atoi(argv[1]) : 100000;
+    mb_size = argc > 2 ? atoi(argv[2]) : 32;
+    epoch_number = argc > 3 ? atoi(argv[3]) : 20;
+    int threads = argc > 4 ? atoi(argv[4]) : 1;
+    if (ts_size <= 0 || mb_size <= 0 || mb_size > ts_size \
+        || epoch_number <= 0)
+    {
+        fprintf(stderr, "usage: %s [ts_size] [mb_size] [epochs] " \
+            "[threads]\n", argv[0]);
+        return 1;
+    }
+
+    init_rseed(1); // same TS and shuffles in every run
+    // [w1 | w2 | b1 | b2] of a 1-3-1 network, as the reference kernel
+    float wb[N_PARAM(3)] = {0.1, -0.2, 0.05, -0.1, 0.1, -0.01, \
+        0.01, -0.05, 0.22, 0};
+    n_hidden = 3;
+    ini_data ini_d = {.eta = 0.05, .n_hidden = 3, .wb = wb};
+    xfx_pair *train_set = generate_TS('A', 0.7, 0.5, 1.0, rng_state);
+
+    float C_ref, C_new;
+    double sps_ref = bench(train_reference, train_set, ini_d, &C_ref);
+    double sps_new = bench(train, train_set, ini_d, &C_new);
+    float C_mt = 0;
+    double sps_mt = 0;
+    if (threads > 1)
+    {
+        num_threads = threads;
+        sps_mt = bench(train, train_set, ini_d, &C_mt);
+    }
+
+    printf("ts_size %d, mb_size %d, epochs %d\n", \
+        ts_size, mb_size, epoch_number);
+    printf("  reference kernel: %12.0f samples/sec (final C %g)\n", \
+        sps_ref, C_ref);
+    printf("  fused kernel:     %12.0f samples/sec (final C %g)\n", \
+        sps_new, C_new);
+    printf("  speedup:          %12.2fx\n", sps_new/sps_ref);
+    if (threads > 1)
+    {
+        printf("  fused, %3d threads: %10.0f samples/sec (final C %g)\n", \
+            threads, sps_mt, C_mt);
+        printf("  speedup:          %12.2fx\n", sps_mt/sps_ref);
+    }
+
+    free_mem(train_set);
+
+    return 0;
+}
@@ -6,124 +6,228 @@ main code for the nnfit project
 #include "nnfit.h"
 
 
-int main(void)
+int main(int argc, char *argv[])
 {
-    // initialization
-    model_param wb = init(); // wb is weights and biases
-
-
-    // load training set from DB
-    xfx_pair *train_set = NULL;
-    train_set = read_TS();
-
-
-    // ---------
-    // MAIN LOOP
-    xfx_pair *shuffled_ts = NULL;
-    xfx_pair *mb = NULL;
-    float *C_epoch = calloc(epoch_number, sizeof(float));
-    float *eta_epoch = \
-        calloc(epoch_number, sizeof(float)); // for printing
-    int mb_number = (int) ts_size/mb_size;
-    loss_gradloss CgradC_mb;
-    int epoch_converged = 0;
-
-    // loop all epochs
-    for (int epoch_index = 0; epoch_index < epoch_number; epoch_index++)
+    // command line: 
+    // nnfit [-c config.ini] [-d nnfit.db] [-f xfx.bin] [-i ts_id] 
+    //       [-t threads] [-s every] [-S chunk] 
+    //       [-k checkpoint [-K every] [-r]] [-w] [-T]
+    static phase_timings run_timings; // with -T
+    int opt;
+    bool worker_mode = false;
+    bool resume = false;
+    while ((opt = getopt(argc, argv, "c:d:f:i:t:s:S:k:K:rwT")) != -1)
     {
-        // shuffle TS for each epoch
-        shuffled_ts = shuffle_TS(train_set);
-
-
-        // loop all minibatches from 0...mb_number
-        for (int mb_index = 0; mb_index < mb_number; mb_index++)
-        {
-            CgradC_mb = (loss_gradloss){0}; // compound literal
-            mb = isolate_mb(shuffled_ts, mb_index);
-            CgradC_mb = calculate_CgradC(mb, wb); // single mb calculation
-            // update of wb.w_layer_2
-            for(int i = 0; i < 3; i++)
-                {wb.w_layer_2[0][i] -= eta * CgradC_mb.gradC[i];}
-            // update of wb.w_layer_1
-            for(int i = 0; i < 3; i++)
-                {wb.w_layer_1[i][0] -= eta * CgradC_mb.gradC[i+3];}
-            // wb.b_layer_2
-            wb.b_layer_2[0] -= eta * CgradC_mb.gradC[6];
-            // wb.b_layer_1
-            for(int i = 0; i < 3; i++)
-                {wb.b_layer_1[i] -= eta * CgradC_mb.gradC[i+7];}
-            // accumulating C from all mb
-            C_epoch[epoch_index] += CgradC_mb.C;
-
-            free(mb);
-            mb = NULL;
-        }
-        C_epoch[epoch_index] = C_epoch[epoch_index] / (mb_number); // average
-        // check, every epoch_chk_freq if C converged
-        if ((epoch_index % 5) == 0 && C_epoch[epoch_index] < delta)
+        switch (opt)
         {
+        case 'c':
+            file_config = optarg;
+            break;
+        case 'd':
+            db_name = optarg;
+            break;
+        case 'f':
+            ts_file = optarg;
+            break;
+        case 'i':
+            ts_id = atoi(optarg) > 0 ? atoi(optarg) : 0;
+            break;
+        case 't':
+            num_threads = atoi(optarg) > 0 ? atoi(optarg) : 1;
             break;
+        case 's':
+            stream_every = atoi(optarg) > 0 ? atoi(optarg) : 1;
+            break;
+        case 'S':
+            stream_chunk = atoi(optarg) > 0 ? atoi(optarg) : 0;
+            break;
+        case 'k':
+            ckpt_file = optarg;
+            break;
+        case 'K':
+            ckpt_every = atoi(optarg) > 0 ? atoi(optarg) : 1;
+            break;
+        case 'r':
+            resume = true;
+            break;
+        case 'w':
+            worker_mode = true;
+            break;
+        case 'T':
+            timings = &run_timings;
+            break;
+        default:
+            fprintf(stderr, "usage: %s [-c config.ini] [-d nnfit.db] " \
+                "[-f xfx.bin] [-i ts_id] [-t threads] [-s every] [-S chunk] " \
+                "[-k checkpoint [-K every] [-r]] [-w] [-T]\n", argv[0]);
+            exit(1);
         }
-        epoch_converged = epoch_index;
+    }
 
-        // auto-adjust eta for faster convergence
-        float eta_adjustment = 0.8;
-        if (epoch_index > 0)
-        {
-            if ( fabs( 2* (C_epoch[epoch_index-1] - C_epoch[epoch_index]) \
-                / (C_epoch[epoch_index-1] + C_epoch[epoch_index]) ) < eta) \
-                {eta *= eta_adjustment;}
-        }
+    if (worker_mode)
+    {
+        ckpt_file = NULL; // checkpoints are per run, not per job
+        return run_worker();
+    }
 
-        eta_epoch[epoch_index] = eta;
+    // initialization
+    double t_phase = monotonic_time();
+    float *wb = init(); // wb is weights and biases, flat layout
+    if (timings != NULL) {timings->init = monotonic_time() - t_phase;}
 
-        free(shuffled_ts);
-        shuffled_ts = NULL;
-    }
 
+    // load training set: mapped binary TS file, or DB; with -S, only
+    // opened, and read in chunks during training
+    t_phase = monotonic_time();
+    xfx_pair *train_set = NULL;
+    if (stream_chunk > 0) {ts_chunks = open_TS_source();}
+    else {train_set = load_TS();}
+    if (timings != NULL) {timings->ts_load = monotonic_time() - t_phase;}
 
-    // print to stdout in JSON format
-    printf("{\n");
-
-    printf("  \"weights\": {\n");
-    printf("    \"w_layer_1\": [");
-    printf("%7.5f, ", wb.w_layer_1[0][0]);
-    printf("%7.5f, ", wb.w_layer_1[1][0]);
-    printf("%7.5f",  wb.w_layer_1[2][0]);
-    printf("],\n");
-
-    printf("    \"b_layer_1\": [");
-    printf("%7.5f, ", wb.b_layer_1[0]);
-    printf("%7.5f, ", wb.b_layer_1[1]);
-    printf("%7.5f",  wb.b_layer_1[2]);
-    printf("],\n");
-
-    printf("    \"w_layer_2\": [");
-    printf("%f, ", wb.w_layer_2[0][0]);
-    printf("%f, ", wb.w_layer_2[0][1]);
-    printf("%f",  wb.w_layer_2[0][2]);
-    printf("],\n");
-
-    printf("    \"b_layer_2\": %f\n", wb.b_layer_2[0]);
-    printf("  },\n");
-
-    printf("  \"loss\": {\n");
-    for (int i = 0; i < epoch_converged; i++) {
-        printf("    \"%d\": %f", i, C_epoch[i]);
-        if (i < epoch_converged - 1) printf(",");
-        printf("\n");
-    }
-    printf("  }\n");
 
-    printf("}\n");
+    // train and print to stdout in JSON format; when streaming, the 
+    // loss is printed during training and never stored
+    float *C_epoch = NULL;
+    if (stream_every == 0) {C_epoch = calloc(epoch_number, sizeof(float));}
+    // continue from the checkpoint, if there is a valid one
+    if (resume && ckpt_file != NULL) {load_checkpoint(wb, C_epoch);}
+    int epoch_converged = train(train_set, wb, C_epoch);
+    print_results(wb, C_epoch, epoch_converged, stream_every > 0);
 
 
     // free memory
-    free(train_set);
-    free(shuffled_ts);
-    free(mb);
+    if (ts_chunks != NULL) {close_TS_source(ts_chunks);}
+    else {release_TS(train_set);}
     free(C_epoch);
-    free(eta_epoch);
+    free(wb);
 
     return 0;
  }
+
+// ---------------------------------------------
+// worker mode: loads the TS once (opens it with -S), then trains one 
+// job per stdin line and prints one JSON result per stdout line, 
+// until end of input
+int run_worker(void)
+{
+    xfx_pair *train_set = NULL;
+    if (stream_chunk > 0) {ts_chunks = open_TS_source();}
+    else {train_set = load_TS();}
+
+    char *line = NULL; // grows with the hidden width
+    size_t line_cap = 0;
+    while (getline(&line, &line_cap, stdin) != -1)
+    {
+        // timings are per job: the TS load is not repeated
+        if (timings != NULL) {*timings = (phase_timings) {0};}
+        double t_phase = monotonic_time();
+        ini_data ini_d = {0};
+        if (read_job(line, &ini_d) != 0)
+        {
+            printf("{\"error\": \"bad job line\"}\n");
+            fflush(stdout);
+            continue;
+        }
+        // hyperparameters of this job
+        mb_size = ini_d.mb_size;
+        eta = ini_d.eta;
+        epoch_number = ini_d.epoch_num;
+        delta = ini_d.delta;
+        n_hidden = ini_d.n_hidden;
+        optimizer = ini_d.optimizer;
+        beta1 = ini_d.beta1;
+        beta2 = ini_d.beta2;
+        // each job shuffles from its own seed: its result does not
+        // depend on the jobs this worker ran before
+        init_rseed(ini_d.seed);
+        if (timings != NULL) {timings->init = monotonic_time() - t_phase;}
+
+        float *C_epoch = NULL;
+        if (stream_every == 0) {C_epoch = calloc(epoch_number, sizeof(float));}
+        int epoch_converged = train(train_set, ini_d.wb, C_epoch);
+        print_results(ini_d.wb, C_epoch, epoch_converged, true);
+        fflush(stdout);
+        free(C_epoch);
+        free(ini_d.wb);
+    }
+
+    free(line);
+    if (ts_chunks != NULL) {close_TS_source(ts_chunks);}
+    else {release_TS(train_set);}
+
+    return 0;
+}
+
+// ---------------------------------------------
+// prints weights, biases and loss to stdout in JSON format
+// wb: flat layout of a network with n_hidden units
+// eta: the final learning rate
+// C_epoch NULL (streaming): "epochs" replaces the "loss" object
+// "epochs_trained": epochs trained (see train_ctx), one more than 
+// the losses reported, or more if it converged
+// one_line: whole object in a single line (worker and streaming modes)
+void print_results(const float *wb, float *C_epoch, int epoch_converged, \
+    bool one_line)
+{
+    const char *nl = one_line ? "" : "\n";
+    const char *in1 = one_line ? "" : "  ";
+    const char *in2 = one_line ? "" : "    ";
+    const int h = n_hidden;
+    double t_output = monotonic_time();
+
+    printf("{%s", nl);
+
+    // weights at full float precision: resuming from them (see
+    // python/scheduler.py) continues the same descent
+    printf("%s\"weights\": {%s", in1, nl);
+    printf("%s\"w_layer_1\": [", in2);
+    for (int i = 0; i < h; i++)
+        {printf(i < h - 1 ? "%.9g, " : "%.9g", wb[P_W1(h) + i]);}
+    printf("],%s", nl);
+
+    printf("%s\"b_layer_1\": [", in2);
+    for (int i = 0; i < h; i++)
+        {printf(i < h - 1 ? "%.9g, " : "%.9g", wb[P_B1(h) + i]);}
+    printf("],%s", nl);
+
+    printf("%s\"w_layer_2\": [", in2);
+    for (int i = 0; i < h; i++)
+        {printf(i < h - 1 ? "%.9g, " : "%.9g", wb[P_W2(h) + i]);}
+    printf("],%s", nl);
+
+    printf("%s\"b_layer_2\": %.9g%s", in2, wb[P_B2(h)], nl);
+    printf("%s},%s", in1, nl);
+    // eta after its auto-adjustments, for the same reason
+    printf("%s\"eta\": %.17g,%s", in1, eta, nl);
+
+    if (C_epoch == NULL)
+    {
+        printf("%s\"epochs\": %d", in1, epoch_converged);
+    }
+    else
+    {
+        printf("%s\"loss\": {%s", in1, nl);
+        for (int i = 0; i < epoch_converged; i++) {
+            printf("%s\"%d\": %f", in2, i, C_epoch[i]);
+            if (i < epoch_converged - 1) printf(",");
+            printf("%s", one_line ? " " : "\n");
+        }
+        printf("%s}", in1);
+    }
+    printf(",%s%s\"epochs_trained\": %d", nl, in1, epochs_trained);
+    if (timings != NULL) {print_timings(t_output, nl, in1);}
+
+    printf("%s}\n", nl);
+}
+
+// ---------------------------------------------
+// phase timings (-T) as a last "timings" object, in seconds; the
+// output phase runs from t_output to here
+void print_timings(double t_output, const char *nl, const char *in1)
+{
+    timings->output = monotonic_time() - t_output;
+    printf(",%s%s\"timings\": {\"init\": %.6f, \"ts_load\": %.6f, " \
+        "\"shuffle\": %.6f, \"gradient\": %.6f, \"output\": %.6f}", \
+        nl, in1, timings->init, timings->ts_load, timings->shuffle, \
+        timings->gradient, timings->output);
+}
@@ -12,15 +12,141 @@ Header for the nnfit project
 #include <string.h>
 #include <stdbool.h>
 #include <math.h>
+#include <float.h>
+#include <stdint.h>
+#include <pthread.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include "sqlite3.h"
 
+#define TS_MAGIC "NNTS" // binary TS file: magic and format version
+#define TS_VERSION 2
+#define CKPT_MAGIC "NNCK" // checkpoint file: magic and format version
+#define CKPT_VERSION 3
+#define MAX_HIDDEN 4096 // max hidden width
+#define TS_BUFFER_CHUNKS 4 // out-of-core TS (-S): chunks in the buffer
+#define BETA1 0.9f // default decay of the momentum / Adam 1st moment
+#define BETA2 0.999f // default decay of the Adam 2nd moment
+#define ADAM_EPS 1e-8f // Adam: added to the root of the 2nd moment
+// weights and biases of a 1-h-1 network in one contiguous float array
+// [w1 (h) | w2 (h) | b1 (h) | b2], the column order of table optimal_wb
+#define N_PARAM(h) (3*(h) + 1)
+#define P_W1(h) 0
+#define P_W2(h) (h)
+#define P_B1(h) (2*(h))
+#define P_B2(h) (3*(h))
+// RNG of the TS generation and shuffles: mulberry32, counter-based,
+// its whole state one 32-bit word (as saved in checkpoints); every
+// seed is valid, so a run is reproducible from its seed alone
+#define RNG_INCREMENT 0x6D2B79F5u
+#define RNG_TS_STREAM 0x9E3779B9u // TS generation: seed ^ this
+#define TS_SEED 1 // default seed of the TS (ini ts_seed line)
+
 // structures
+typedef enum 
+{
+    OPT_SGD,      // wb -= eta*g
+    OPT_MOMENTUM, // m = beta1*m + g; wb -= eta*m
+    OPT_NESTEROV, // m = beta1*m + g; wb -= eta*(g + beta1*m)
+    OPT_ADAM      // bias-corrected 1st and 2nd moments, see mb_step
+} opt_type; // update rule of the weights and biases (ini optimizer)
 typedef struct 
 {
     float x;
     float fx;
 } xfx_pair; // {x, f(x)} pair
 typedef struct 
+{
+    char magic[4];      // TS_MAGIC
+    int32_t version;    // TS_VERSION
+    int32_t ts_size;    // number of xfx_pair records after the header
+    char fx_choice;
+    char pad[3];
+    float fx_a;
+    float fx_b;
+    float fx_c;
+    uint32_t checksum;  // CRC-32 of the records
+    int32_t ts_id;      // row of table training_sets, 0 = unversioned
+    uint32_t seed;      // RNG seed the TS was generated from
+} ts_header; // header of the binary TS file, followed by the records
+typedef struct 
+{
+    char magic[4];      // CKPT_MAGIC
+    int32_t version;    // CKPT_VERSION
+    double eta;         // after auto-adjustments
+    int32_t n_hidden;
+    int32_t epoch_number;
+    int32_t epoch;      // next epoch to train, epoch_number when done
+    int32_t epoch_converged;
+    int32_t n_loss;     // loss values after wb: epoch, or 0 if streaming
+    uint32_t rng_state; // shuffle RNG (rng_next)
+    float C_prev;       // loss of epoch - 1
+    uint32_t checksum;  // CRC-32 of wb, loss and optimizer state
+    int32_t optimizer;  // opt_type
+    int32_t n_opt;      // optimizer state values after the loss
+} ckpt_header; // 56-byte header of a checkpoint, followed by wb, loss 
+               // and optimizer state
+typedef struct 
+{
+    int epoch;
+    int epoch_converged;
+    float C_prev;
+} train_state; // where train starts: from a checkpoint, or all 0
+typedef struct 
+{
+    double init;     // ini file (job line in worker mode), new TS
+    double ts_load;  // TS mapped or read from db
+    double shuffle;  // TS index shuffles
+    double gradient; // minibatch gradients and wb updates
+    double output;   // results printed
+} phase_timings; // seconds spent in each phase of a run (option -T)
+typedef struct train_ctx train_ctx;
+typedef void (*epoch_hook)(const train_ctx *ctx, const float *wb, \
+    const float *C_epoch, train_state state, float C_reported, bool done);
+// reads records first...first+n-1 of an out-of-core TS into buf;
+// returns the number of records read
+typedef int (*chunk_reader)(void *source, int first, int n, xfx_pair *buf);
+struct train_ctx
+{
+    const xfx_pair *train_set; // NULL if read_chunk is set
+    int ts_size;
+    int mb_size;
+    int epoch_number;
+    double delta;
+    int n_hidden;
+    int threads;            // for the minibatch gradient
+    double eta;             // updated by the auto-adjustments
+    unsigned int rng_state; // TS shuffle (rng_next), updated
+    train_state start;      // from a checkpoint, or all 0
+    opt_type optimizer;
+    float beta1;
+    float beta2;
+    // optimizer state, 2*N_PARAM(n_hidden) floats: momentum or Adam 
+    // 1st moment, then Adam 2nd moment; updated. NULL = zeros
+    float *opt_state;
+    epoch_hook on_epoch;    // NULL, or see train_run
+    phase_timings *timings; // NULL, or shuffle and gradient added
+    // out-of-core TS: read in chunks of chunk_size records, 
+    // buffer_chunks at a time (see train_run); NULL = train_set
+    chunk_reader read_chunk;
+    void *ts_source;
+    int chunk_size;
+    int buffer_chunks;
+    // set by train_run: epochs trained, counted from epoch 0 (also 
+    // those before ctx->start); epoch k+1 if it converged at epoch k
+    int epochs_trained;
+}; // one training run: nothing shared, so runs can train concurrently
+typedef struct mb_pool mb_pool; // thread pool of one run (nnfit_train.c)
+typedef struct 
+{
+    int fd;             // ts_path, or -1: rows of table xfx
+    sqlite3 *db;
+    sqlite3_stmt *stmt; // rows by id range
+    sqlite3_int64 id_0; // id of record 0
+} ts_source; // out-of-core TS (option -S), see read_TS_chunk
+typedef struct 
 {
     bool flag_genTS;
     int ts_size;
@@ -32,10 +158,14 @@ typedef struct
     double eta;
     int epoch_num;
     double delta;
-    float wl1[3];
-    float wl2[3];
-    float bl1[3];
-    float bl2;
+    int n_hidden;
+    float *wb; // N_PARAM(n_hidden) initial weights and biases, malloc'd
+    opt_type optimizer;
+    float beta1;
+    float beta2;
+    unsigned int seed; // RNG seed, 0 = from the clock
+    int ts_id; // training set to train on, 0 = the last one
+    unsigned int ts_seed; // RNG seed of a new TS, 0 = from the clock
 } ini_data; // translated data from ini file
 typedef struct 
 {
@@ -49,7 +179,7 @@ typedef struct
     float w_layer_2[3][3];
     float b_layer_1[3];
     float b_layer_2[3];
-} model_param; // weights and biases
+} model_param; // weights and biases of the 1-3-1 reference kernel
 typedef struct 
 {
     float C;
@@ -57,33 +187,96 @@ typedef struct
 } loss_gradloss; // weights and biases
 
 
+// file paths (command line options -c, -d and -f)
+extern const char *file_config;
+extern const char *db_name;
+extern const char *ts_file;
+extern char ts_path[]; // binary file of training set ts_id, see select_TS
+extern int ts_id; // training set (table training_sets), option -i
+extern int num_threads; // command line option -t
+extern int stream_every; // command line option -s
+extern const char *ckpt_file; // command line option -k
+extern int ckpt_every; // command line option -K
+extern train_state resume_state; // set by load_checkpoint
+extern phase_timings *timings; // command line option -T, NULL = off
+extern int stream_chunk; // command line option -S, 0 = TS in memory
+extern ts_source *ts_chunks; // out-of-core TS, with -S
+extern unsigned int rng_state; // shuffle RNG, see init_rseed
+
 // global variables from ini file
 extern int ts_size;
 extern int mb_size;
 extern double eta; // learning rate
 extern int epoch_number;
 extern double delta; // threshold converg
+extern int n_hidden; // hidden width
+extern opt_type optimizer;
+extern float beta1;
+extern float beta2;
+extern float *opt_state; // set by load_checkpoint
+extern int epochs_trained; // set by train, see train_ctx
 
 
 // prototypes
+// -- training kernel (nnfit_train.c)
+int train_run(train_ctx *ctx, float *wb, float *C_epoch);
+void shuffle_idx(int *perm, int n, unsigned int *rng);
+double monotonic_time(void);
+float calculate_CgradC_fused(const xfx_pair *train_set, const int *idx, \
+    int n, int h, const float *p, float *gradC);
+float accumulate_CgradC(const xfx_pair *train_set, const int *idx, \
+    int n, int h, const float *p, float *gradC);
+mb_pool *start_pool(int n, int h);
+void stop_pool(mb_pool *pool);
+float calculate_CgradC_mt(mb_pool *pool, const xfx_pair *train_set, \
+    const int *idx, int n, const float *p, float *gradC);
+// -- main loop and output
+int train(xfx_pair *train_set, float *wb, float *C_epoch);
+void engine_epoch(const train_ctx *ctx, const float *wb, \
+    const float *C_epoch, train_state state, float C_reported, bool done);
+void print_epoch(int epoch, float C);
+void print_loss(float C);
+void print_results(const float *wb, float *C_epoch, int epoch_converged, \
+    bool one_line);
+void print_timings(double t_output, const char *nl, const char *in1);
+int run_worker(void);
+int read_job(const char *line, ini_data *ini_d);
 // -- TS
 xfx_pair *generate_TS(char fx_choice, \
-        float fx_a, float fx_b, float fx_c);
+        float fx_a, float fx_b, float fx_c, unsigned int seed);
 float calculate_fx(float x, char fx_choice, \
     float fx_a, float fx_b, float fx_c);
 void free_mem(xfx_pair *ts);
 // -- init
-model_param init(void);
-void init_rseed(void);
-model_param init_wb(ini_data ini_d);
+float *init(void);
+unsigned int init_rseed(unsigned int seed);
+int parse_optimizer(const char *name);
+model_param init_wb(const float *wb);
 ini_data init_readfile(void);
 // -- SQL
 int callback(void *NotUsed, int argc, char **argv, \
     char **azColName);
-int create_db(xfx_pair *ts);
+int create_db(xfx_pair *ts, ini_data ini_d);
+int find_TS(ini_data ini_d);
+void select_TS(int id);
 xfx_pair *read_TS(void);
 int count_db(void);
+// -- binary TS file
+int write_TS_file(xfx_pair *train_set, ini_data ini_d);
+xfx_pair *map_TS(void);
+xfx_pair *load_TS(void);
+void release_TS(xfx_pair *train_set);
+uint32_t crc32_TS(const void *data, size_t len);
+// -- out-of-core TS
+ts_source *open_TS_source(void);
+int read_TS_chunk(void *source, int first, int n, xfx_pair *buf);
+void close_TS_source(ts_source *src);
+// -- checkpoints
+int save_checkpoint(const train_ctx *ctx, const float *wb, \
+    const float *C_epoch, int epoch, int epoch_converged, float C_prev);
+int load_checkpoint(float *wb, float *C_epoch);
 // -- forward and backward passes
+// (per-sample kernel, kept as reference for the benchmark)
 activation forward_pass(model_param wb, float x);
 activation forward_pass_z(model_param wb, float x);
 float sigma_layer_1(float a);
@@ -96,4 +289,22 @@ loss_gradloss calculate_CgradC(xfx_pair *mb, \
 xfx_pair *isolate_mb(xfx_pair *shuffled_ts, \
     int mb_index);
 
+// ---------------------------------------------
+// next 32 random bits; inline, as the shuffles draw one per TS index
+static inline uint32_t rng_next(unsigned int *state)
+{
+    uint32_t z = (*state += RNG_INCREMENT);
+    z = (z ^ (z >> 15)) * (z | 1u);
+    z ^= z + (z ^ (z >> 7)) * (z | 61u);
+
+    return z ^ (z >> 14);
+}
+
+// ---------------------------------------------
+// uniform integer in [0, n), by multiply-shift: no division
+static inline uint32_t rng_below(unsigned int *state, uint32_t n)
+{
+    return (uint32_t) (((uint64_t) rng_next(state) * n) >> 32);
+}
+
 #endif
\ No newline at end of file
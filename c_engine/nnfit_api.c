@@ -0,0 +1,62 @@
+/*
+CODE
+Public API of libnnfit.so (see nnfit_api.h)
+*/
+
+#include "nnfit.h"
+#include "nnfit_api.h"
+
+
+// ---------------------------------------------
+int nnfit_n_param(int n_hidden)
+{
+    return N_PARAM(n_hidden);
+}
+
+// ---------------------------------------------
+// one train_run on the caller's buffers, with its own ctx
+int nnfit_train(const float *xfx, int ts_size, const nnfit_params *params,
+    float *wb, float *loss, double *eta_out, int *epochs_out)
+{
+    if (xfx == NULL || params == NULL || wb == NULL || ts_size <= 0 \
+        || params->mb_size <= 0 || params->mb_size > ts_size \
+        || params->epoch_num <= 0 || params->n_hidden < 1 \
+        || params->n_hidden > MAX_HIDDEN || params->threads < 1 \
+        || params->optimizer < NNFIT_SGD || params->optimizer > NNFIT_ADAM \
+        || params->beta1 < 0 || params->beta1 >= 1 \
+        || params->beta2 < 0 || params->beta2 >= 1)
+    {
+        return NNFIT_EINVAL;
+    }
+    if (loss != NULL) 
+        {memset(loss, 0, params->epoch_num*sizeof(float));}
+
+    // xfx_pair is two floats: the caller's pairs are the TS as is
+    train_ctx ctx = 
+    {
+        .train_set = (const xfx_pair *) xfx,
+        .ts_size = ts_size,
+        .mb_size = params->mb_size,
+        .epoch_number = params->epoch_num,
+        .delta = params->delta,
+        .n_hidden = params->n_hidden,
+        .threads = params->threads,
+        .eta = params->eta,
+        .rng_state = params->seed != 0 ? params->seed : \
+            (unsigned int) time(NULL) ^ (unsigned int) getpid(),
+        .start = {0},
+        .optimizer = (opt_type) params->optimizer,
+        .beta1 = params->beta1,
+        .beta2 = params->beta2,
+        .opt_state = NULL,
+        .on_epoch = NULL,
+        .timings = NULL,
+        .epochs_trained = 0,
+    };
+    int epoch_converged = train_run(&ctx, wb, loss);
+    if (epoch_converged < 0) {return NNFIT_ENOMEM;}
+    if (eta_out != NULL) {*eta_out = ctx.eta;}
+    if (epochs_out != NULL) {*epochs_out = ctx.epochs_trained;}
+
+    return epoch_converged;
+}
@@ -0,0 +1,52 @@
+/*
+HEADER
+Public API of libnnfit.so: the training kernel of the nnfit project,
+callable in-process (see python/cengine.py). Only needs the C 
+standard library: no SQLite, no files, no globals
+*/
+
+#ifndef NNFIT_API_H
+#define NNFIT_API_H
+
+#define NNFIT_EINVAL -1 // invalid arguments
+#define NNFIT_ENOMEM -2 // out of memory
+// optimizers of nnfit_params.optimizer (opt_type of nnfit.h)
+#define NNFIT_SGD 0
+#define NNFIT_MOMENTUM 1
+#define NNFIT_NESTEROV 2
+#define NNFIT_ADAM 3
+
+typedef struct 
+{
+    int mb_size;        // mini-batch size, <= ts_size
+    double eta;         // initial learning rate
+    int epoch_num;      // epoch number
+    double delta;       // threshold of C to stop grad-desc
+    int n_hidden;       // hidden width H, 1...4096
+    int threads;        // threads for the minibatch gradient, >= 1
+    unsigned int seed;  // TS shuffle seed; 0 = from the clock
+    int optimizer;      // NNFIT_SGD, NNFIT_MOMENTUM, ...
+    float beta1;        // momentum / Adam 1st moment decay, [0, 1)
+    float beta2;        // Adam 2nd moment decay, [0, 1)
+} nnfit_params; // hyperparameters of one training run
+
+// number of weights and biases of a 1-H-1 network: 3H + 1
+int nnfit_n_param(int n_hidden);
+
+// trains a 1-H-1 network on the caller's training set, as the engine
+// does, without copying it:
+//  xfx: ts_size (x, fx) float pairs, interleaved (the records of 
+//      xfx.bin, or a C-contiguous ts_size x 2 float32 array)
+//  wb: in: initial weights and biases, out: trained ones; 
+//      nnfit_n_param(n_hidden) floats, layout [w1 (H)|w2 (H)|b1 (H)|b2]
+//  loss: epoch_num floats, loss of each epoch trained; may be NULL
+//  eta_out: eta after its auto-adjustments; may be NULL
+//  epochs_out: epochs trained, epoch_num or fewer if it converged 
+//      (the engine's "epochs_trained"); may be NULL
+// returns the number of epochs to report (the "loss" of the engine's
+// output is loss[0...n-1]), or NNFIT_EINVAL / NNFIT_ENOMEM. 
+// Thread-safe: calls on different buffers can run concurrently
+int nnfit_train(const float *xfx, int ts_size, const nnfit_params *params,
+    float *wb, float *loss, double *eta_out, int *epochs_out);
+
+#endif
@@ -0,0 +1,562 @@
+/*
+CODE
+Training kernel for the nnfit project
+*/
+
+#include "nnfit.h"
+
+#define MT_MIN_CHUNK 64 // min samples per thread, else fewer threads
+
+// thread pool: the minibatch is split in contiguous chunks, one per
+// thread; each writes its partial sums to its own slot and the main
+// thread adds the slots in thread order, so results only depend on
+// the number of threads. One pool per train_run
+typedef struct
+{
+    mb_pool *pool;
+    int id;
+} pool_arg;
+struct mb_pool
+{
+    // current job
+    const xfx_pair *train_set;
+    const int *idx;
+    int n;
+    int h;
+    const float *p;
+    bool stop;
+    // threads
+    int size;
+    pthread_t *threads;
+    pool_arg *args;
+    float *partial; // per thread: gradC (N_PARAM(h)), C
+    pthread_barrier_t job_ready;
+    pthread_barrier_t job_done;
+};
+// buffers of an out-of-core epoch (see epoch_streamed)
+typedef struct
+{
+    xfx_pair *buf;    // shuffle buffer: buffer_chunks chunks + left over
+    int *idx;         // shuffled indices of buf
+    xfx_pair *left;   // samples left over from a fill (< mb_size)
+    int *chunk_perm;  // chunk order of the epoch
+    int n_chunks;
+    bool read_error;
+} stream_buf;
+// optimizer state of a run (see mb_step)
+typedef struct
+{
+    float *m;  // velocity (momentum, Nesterov) or Adam 1st moment
+    float *v;  // Adam 2nd moment
+    long step; // updates done, for the Adam bias correction
+    bool unbiased; // Adam bias corrections are 1 from here on
+} opt_buf;
+
+static float mb_step(const train_ctx *ctx, mb_pool *pool, \
+    const xfx_pair *train_set, const int *idx, float *wb, float *gradC, \
+    opt_buf *opt);
+static float epoch_streamed(train_ctx *ctx, mb_pool *pool, stream_buf *sb, \
+    float *wb, float *gradC, opt_buf *opt);
+
+
+// ---------------------------------------------
+// minibatch gradient descent over all epochs of ctx, with the update
+// rule ctx->optimizer: updates wb (N_PARAM(ctx->n_hidden) floats), 
+// ctx->eta, ctx->rng_state and ctx->opt_state, and fills C_epoch 
+// (epoch_number long, or NULL); returns the number of epochs to 
+// report, -1 if out of memory, or -2 if the TS cannot be read; sets 
+// ctx->epochs_trained. 
+// Starts from ctx->start, and from ctx->opt_state if set (else from
+// zero optimizer state). Uses no globals: runs with their own ctx 
+// can train at the same time.
+// ctx->on_epoch, if set, is called after each epoch that is kept 
+// with the state to resume from and the loss of the last epoch to 
+// report (epoch_converged - 1), and once more with done = true and 
+// state.epoch = epoch_number when training ends (see engine_epoch).
+// With ctx->timings, the shuffle and gradient times are added to it,
+// timed once per epoch (per buffer fill out of core, where reads
+// are added to ts_load).
+// With ctx->read_chunk, the TS is read in chunks (see epoch_streamed)
+// and memory does not depend on ts_size
+int train_run(train_ctx *ctx, float *wb, float *C_epoch)
+{
+    const int h = ctx->n_hidden;
+    const int mb_size = ctx->mb_size;
+    const int epoch_number = ctx->epoch_number;
+    // all buffers allocated once: no allocation inside the loops
+    int n_param = N_PARAM(h);
+    stream_buf sb = {0};
+    int n_perm = ctx->ts_size; // TS indices to shuffle
+    if (ctx->read_chunk != NULL)
+    {
+        // the buffer also holds the samples left over from the 
+        // previous fill, fewer than mb_size
+        sb.n_chunks = (ctx->ts_size + ctx->chunk_size - 1)/ctx->chunk_size;
+        n_perm = ctx->buffer_chunks*ctx->chunk_size + mb_size;
+        sb.buf = malloc(n_perm*sizeof(xfx_pair));
+        sb.left = malloc(mb_size*sizeof(xfx_pair));
+        sb.chunk_perm = malloc(sb.n_chunks*sizeof(int));
+    }
+    int *perm = malloc(n_perm*sizeof(int)); // shuffled TS indices
+    sb.idx = perm;
+    float *gradC = malloc(n_param*sizeof(float));
+    // optimizer state: the caller's, else zeros of this run only
+    float *state = ctx->opt_state;
+    if (state == NULL && ctx->optimizer != OPT_SGD) 
+        {state = calloc(2*n_param, sizeof(float));}
+    // threads used for this mb size
+    int threads = ctx->threads < mb_size/MT_MIN_CHUNK ? \
+        ctx->threads : mb_size/MT_MIN_CHUNK;
+    mb_pool *pool = threads > 1 ? start_pool(threads, h) : NULL;
+    if (perm == NULL || gradC == NULL || (threads > 1 && pool == NULL) \
+        || (ctx->optimizer != OPT_SGD && state == NULL) \
+        || (ctx->read_chunk != NULL && (sb.buf == NULL || sb.left == NULL \
+            || sb.chunk_perm == NULL)))
+    {
+        if (pool != NULL) {stop_pool(pool);}
+        if (state != ctx->opt_state) {free(state);}
+        free(perm);
+        free(gradC);
+        free(sb.buf);
+        free(sb.left);
+        free(sb.chunk_perm);
+        return -1;
+    }
+    // ---------
+    // MAIN LOOP
+    int mb_number = (int) ctx->ts_size/mb_size;
+    int epoch_converged = ctx->start.epoch_converged;
+    float C_now = 0; // loss of this epoch
+    float C_prev = ctx->start.C_prev; // loss of the previous epoch
+    int epoch_start = ctx->start.epoch;
+    ctx->epochs_trained = epoch_start;
+    // every epoch runs mb_number updates, also out of core
+    opt_buf opt = {state, state != NULL ? state + n_param : NULL, \
+        (long) epoch_start*mb_number, false};
+
+    // loop all epochs
+    for (int epoch_index = epoch_start; epoch_index < epoch_number; \
+        epoch_index++)
+    {
+        if (ctx->read_chunk != NULL)
+        {
+            C_now = epoch_streamed(ctx, pool, &sb, wb, gradC, &opt);
+            if (sb.read_error)
+            {
+                epoch_converged = -2;
+                break;
+            }
+        }
+        else
+        {
+            // shuffle TS indices for each epoch, from the identity: the
+            // order only depends on rng_state, as saved in checkpoints
+            double t_shuffle = ctx->timings != NULL ? monotonic_time() : 0;
+            for (int i = 0; i < ctx->ts_size; i++) {perm[i] = i;}
+            shuffle_idx(perm, ctx->ts_size, &ctx->rng_state);
+            double t_gradient = ctx->timings != NULL ? monotonic_time() : 0;
+            C_now = 0;
+
+            // loop all minibatches from 0...mb_number
+            for (int mb_index = 0; mb_index < mb_number; mb_index++)
+            {
+                // single mb calculation, on mb_size shuffled indices
+                C_now += mb_step(ctx, pool, ctx->train_set, \
+                    perm + mb_index*mb_size, wb, gradC, &opt);
+            }
+            if (ctx->timings != NULL)
+            {
+                double t_end = monotonic_time();
+                ctx->timings->shuffle += t_gradient - t_shuffle;
+                ctx->timings->gradient += t_end - t_gradient;
+            }
+        }
+        C_now = C_now / (mb_number); // average
+        ctx->epochs_trained = epoch_index + 1;
+        if (C_epoch != NULL) {C_epoch[epoch_index] = C_now;}
+        // check, every epoch_chk_freq if C converged
+        if ((epoch_index % 5) == 0 && C_now < ctx->delta)
+        {
+            break;
+        }
+        epoch_converged = epoch_index;
+
+        // auto-adjust eta for faster convergence
+        float eta_adjustment = 0.8;
+        if (epoch_index > 0)
+        {
+            if ( fabs( 2* (C_prev - C_now) / (C_prev + C_now) ) < ctx->eta) \
+                {ctx->eta *= eta_adjustment;}
+        }
+        // epoch_index - 1 is now the last epoch to report
+        float C_reported = C_prev;
+        C_prev = C_now;
+
+        if (ctx->on_epoch != NULL)
+        {
+            train_state state = {epoch_index + 1, epoch_converged, C_prev};
+            ctx->on_epoch(ctx, wb, C_epoch, state, C_reported, false);
+        }
+    }
+    if (ctx->on_epoch != NULL && epoch_start < epoch_number \
+        && epoch_converged >= 0)
+    {
+        train_state state = {epoch_number, epoch_converged, C_prev};
+        ctx->on_epoch(ctx, wb, C_epoch, state, 0, true);
+    }
+
+    if (pool != NULL) {stop_pool(pool);}
+    if (state != ctx->opt_state) {free(state);}
+    free(perm);
+    free(gradC);
+    free(sb.buf);
+    free(sb.left);
+    free(sb.chunk_perm);
+
+    return epoch_converged;
+}
+
+// ---------------------------------------------
+// one minibatch: C and gradC on the TS samples idx[0...mb_size-1],
+// then the update of all weights and biases by ctx->optimizer, with
+// g = gradC:
+//  SGD       wb -= eta*g
+//  momentum  m = beta1*m + g; wb -= eta*m
+//  Nesterov  m = beta1*m + g; wb -= eta*(g + beta1*m)
+//  Adam      m = beta1*m + (1 - beta1)*g; v = beta2*v + (1 - beta2)*g^2
+//            wb -= eta*m_hat/(sqrt(v_hat) + ADAM_EPS), with m_hat and
+//            v_hat the moments over (1 - beta^step)
+// returns C
+static float mb_step(const train_ctx *ctx, mb_pool *pool, \
+    const xfx_pair *train_set, const int *idx, float *wb, float *gradC, \
+    opt_buf *opt)
+{
+    float C;
+    if (pool != NULL)
+    {
+        C = calculate_CgradC_mt(pool, train_set, idx, ctx->mb_size, \
+            wb, gradC);
+    }
+    else
+    {
+        C = calculate_CgradC_fused(train_set, idx, ctx->mb_size, \
+            ctx->n_hidden, wb, gradC);
+    }
+    const int n_param = N_PARAM(ctx->n_hidden);
+    const float beta1 = ctx->beta1;
+    float *m = opt->m;
+    opt->step++;
+    switch (ctx->optimizer)
+    {
+    case OPT_MOMENTUM:
+        for (int k = 0; k < n_param; k++)
+        {
+            m[k] = beta1*m[k] + gradC[k];
+            // a velocity decaying to 0 goes through the subnormals, 
+            // several times slower to compute with
+            if (fabsf(m[k]) < FLT_MIN) {m[k] = 0;}
+            wb[k] -= ctx->eta * m[k];
+        }
+        break;
+    case OPT_NESTEROV:
+        for (int k = 0; k < n_param; k++)
+        {
+            m[k] = beta1*m[k] + gradC[k];
+            if (fabsf(m[k]) < FLT_MIN) {m[k] = 0;}
+            wb[k] -= ctx->eta * (gradC[k] + beta1*m[k]);
+        }
+        break;
+    case OPT_ADAM:
+    {
+        const float beta2 = ctx->beta2;
+        float *v = opt->v;
+        // bias corrections, folded into the step size; once both 
+        // round to 1 they stay 1, and powf is not needed anymore
+        float m_scale = 1.0f;
+        float v_scale = 1.0f;
+        if (!opt->unbiased)
+        {
+            m_scale = 1.0f/(1.0f - powf(beta1, (float) opt->step));
+            v_scale = 1.0f/(1.0f - powf(beta2, (float) opt->step));
+            opt->unbiased = m_scale == 1.0f && v_scale == 1.0f;
+        }
+        for (int k = 0; k < n_param; k++)
+        {
+            m[k] = beta1*m[k] + (1.0f - beta1)*gradC[k];
+            v[k] = beta2*v[k] + (1.0f - beta2)*gradC[k]*gradC[k];
+            // moments decaying to 0, as above
+            if (fabsf(m[k]) < FLT_MIN) {m[k] = 0;}
+            if (v[k] < FLT_MIN) {v[k] = 0;}
+            wb[k] -= ctx->eta * m[k]*m_scale \
+                / (sqrtf(v[k]*v_scale) + ADAM_EPS);
+        }
+        break;
+    }
+    default:
+        for (int k = 0; k < n_param; k++)
+            {wb[k] -= ctx->eta * gradC[k];}
+    }
+
+    return C;
+}
+
+// ---------------------------------------------
+// one epoch over an out-of-core TS (ctx->read_chunk): the chunks in 
+// a random order, buffer_chunks at a time, each fill shuffled in the 
+// buffer together with the samples left over from the previous one.
+// Runs the same ts_size/mb_size minibatches as in memory, and every 
+// sample is seen once; returns the sum of their C, or NAN with 
+// sb->read_error set if a chunk cannot be read
+static float epoch_streamed(train_ctx *ctx, mb_pool *pool, stream_buf *sb, \
+    float *wb, float *gradC, opt_buf *opt)
+{
+    const int mb_size = ctx->mb_size;
+    int mb_left = ctx->ts_size/mb_size; // minibatches left in the epoch
+    int n_left = 0; // samples left over, at the start of the buffer
+    float C_sum = 0;
+
+    double t_shuffle = ctx->timings != NULL ? monotonic_time() : 0;
+    for (int c = 0; c < sb->n_chunks; c++) {sb->chunk_perm[c] = c;}
+    shuffle_idx(sb->chunk_perm, sb->n_chunks, &ctx->rng_state);
+    if (ctx->timings != NULL) 
+        {ctx->timings->shuffle += monotonic_time() - t_shuffle;}
+
+    for (int c = 0; c < sb->n_chunks && mb_left > 0; \
+        c += ctx->buffer_chunks)
+    {
+        // fill: the next buffer_chunks chunks after the left over
+        double t_read = ctx->timings != NULL ? monotonic_time() : 0;
+        int n = n_left;
+        for (int k = c; k < sb->n_chunks && k < c + ctx->buffer_chunks; k++)
+        {
+            int first = sb->chunk_perm[k]*ctx->chunk_size;
+            int count = ctx->ts_size - first < ctx->chunk_size ? \
+                ctx->ts_size - first : ctx->chunk_size;
+            if (ctx->read_chunk(ctx->ts_source, first, count, \
+                sb->buf + n) != count)
+            {
+                sb->read_error = true;
+                return NAN;
+            }
+            n += count;
+        }
+        t_shuffle = ctx->timings != NULL ? monotonic_time() : 0;
+        for (int i = 0; i < n; i++) {sb->idx[i] = i;}
+        shuffle_idx(sb->idx, n, &ctx->rng_state);
+        double t_gradient = ctx->timings != NULL ? monotonic_time() : 0;
+
+        int mb_fill = n/mb_size < mb_left ? n/mb_size : mb_left;
+        for (int mb_index = 0; mb_index < mb_fill; mb_index++)
+        {
+            C_sum += mb_step(ctx, pool, sb->buf, \
+                sb->idx + mb_index*mb_size, wb, gradC, opt);
+        }
+        mb_left -= mb_fill;
+        // samples not used yet go to the next fill
+        n_left = mb_left > 0 ? n - mb_fill*mb_size : 0;
+        for (int i = 0; i < n_left; i++) 
+            {sb->left[i] = sb->buf[sb->idx[mb_fill*mb_size + i]];}
+        memcpy(sb->buf, sb->left, n_left*sizeof(xfx_pair));
+        if (ctx->timings != NULL)
+        {
+            double t_end = monotonic_time();
+            ctx->timings->ts_load += t_shuffle - t_read;
+            ctx->timings->shuffle += t_gradient - t_shuffle;
+            ctx->timings->gradient += t_end - t_gradient;
+        }
+    }
+
+    return C_sum;
+}
+
+// ---------------------------------------------
+// Fisher-Yates shuffle of the TS indices, in place, with RNG state rng
+void shuffle_idx(int *perm, int n, unsigned int *rng)
+{
+    for (int i = n - 1; i > 0; i--)
+    {
+        int j = (int) rng_below(rng, (uint32_t) (i + 1));
+        int tmp = perm[i];
+        perm[i] = perm[j];
+        perm[j] = tmp;
+    }
+}
+
+// ---------------------------------------------
+// seconds from a monotonic clock, for phase timings
+double monotonic_time(void)
+{
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+
+    return t.tv_sec + 1e-9*t.tv_nsec;
+}
+
+// ---------------------------------------------
+// minibatch C and gradC in a single fused forward/backward pass
+// over the flat layout p (see N_PARAM); gradC gets the mb average
+// returns C, the mb average loss
+float calculate_CgradC_fused(const xfx_pair *train_set, const int *idx, \
+    int n, int h, const float *p, float *gradC)
+{
+    float C = accumulate_CgradC(train_set, idx, n, h, p, gradC);
+    for (int k = 0; k < N_PARAM(h); k++) {gradC[k] /= n;}
+
+    return C / n;
+}
+
+// ---------------------------------------------
+// sums of C and gradC over n samples (not averaged), hidden width h
+// every loop over the hidden units runs on contiguous arrays
+float accumulate_CgradC(const xfx_pair *train_set, const int *idx, \
+    int n, int h, const float *p, float *gradC)
+{
+    const float *w1 = p + P_W1(h);
+    const float *w2 = p + P_W2(h);
+    const float *b1 = p + P_B1(h);
+    float *g_w1 = gradC + P_W1(h);
+    float *g_w2 = gradC + P_W2(h);
+    float *g_b1 = gradC + P_B1(h);
+    float a1[h]; // layer 1 activations of the current sample
+    float C = 0;
+    float g_b2 = 0;
+    for (int k = 0; k < N_PARAM(h); k++) {gradC[k] = 0;}
+
+    // Loop for calculating all x in mini-batch
+    for (int s = 0; s < n; s++)
+    {
+        float x = train_set[idx[s]].x;
+        // forward pass [note eqs. 9-12]
+        for (int i = 0; i < h; i++)
+        {
+            float z1 = w1[i]*x + b1[i];
+            a1[i] = z1 > 0 ? z1 : 0; // ReLU
+        }
+        float a2 = p[P_B2(h)]; // linear output
+        for (int i = 0; i < h; i++) {a2 += w2[i]*a1[i];}
+        // backward pass: error of layer 2, then layer 1
+        float error_layer_2 = a2 - train_set[idx[s]].fx;
+        C += 0.5f*error_layer_2*error_layer_2;
+        g_b2 += error_layer_2;
+        for (int i = 0; i < h; i++)
+        {
+            float error_layer_1 = a1[i] > 0 ? error_layer_2*w2[i] : 0;
+            g_w2[i] += error_layer_2*a1[i];
+            g_w1[i] += error_layer_1*x;
+            g_b1[i] += error_layer_1;
+        }
+    }
+    gradC[P_B2(h)] = g_b2;
+
+    return C;
+}
+
+// ---------------------------------------------
+// MULTITHREADED MINIBATCH
+// ---------------------------------------------
+
+// ---------------------------------------------
+// partial sums of chunk 'id' of the pool's current job into its slot
+static void run_chunk(mb_pool *pool, int id)
+{
+    int first = (int) ((long) pool->n*id/pool->size);
+    int last = (int) ((long) pool->n*(id + 1)/pool->size);
+    float *slot = pool->partial + id*(N_PARAM(pool->h) + 1);
+    slot[N_PARAM(pool->h)] = accumulate_CgradC(pool->train_set, \
+        pool->idx + first, last - first, pool->h, pool->p, slot);
+}
+
+// ---------------------------------------------
+// pool thread: waits for a job, runs its chunk, repeats until stop
+static void *pool_thread(void *arg)
+{
+    mb_pool *pool = ((pool_arg *) arg)->pool;
+    int id = ((pool_arg *) arg)->id;
+    while (true)
+    {
+        pthread_barrier_wait(&pool->job_ready);
+        if (pool->stop) {break;}
+        run_chunk(pool, id);
+        pthread_barrier_wait(&pool->job_done);
+    }
+
+    return NULL;
+}
+
+// ---------------------------------------------
+// starts n - 1 pool threads for hidden width h; the calling thread 
+// runs chunk 0. Returns NULL if out of memory
+mb_pool *start_pool(int n, int h)
+{
+    mb_pool *pool = calloc(1, sizeof(mb_pool));
+    if (pool == NULL) {return NULL;}
+    pool->size = n;
+    pool->h = h;
+    pool->threads = malloc((n - 1)*sizeof(pthread_t));
+    pool->args = malloc(n*sizeof(pool_arg));
+    pool->partial = malloc(n*(N_PARAM(h) + 1)*sizeof(float));
+    if (pool->threads == NULL || pool->args == NULL || pool->partial == NULL)
+    {
+        free(pool->threads);
+        free(pool->args);
+        free(pool->partial);
+        free(pool);
+        return NULL;
+    }
+    pthread_barrier_init(&pool->job_ready, NULL, n);
+    pthread_barrier_init(&pool->job_done, NULL, n);
+    pool->stop = false;
+    for (int i = 1; i < n; i++)
+    {
+        pool->args[i] = (pool_arg) {pool, i};
+        pthread_create(&pool->threads[i - 1], NULL, pool_thread, \
+            &pool->args[i]);
+    }
+
+    return pool;
+}
+
+// ---------------------------------------------
+// stops and joins the pool threads, and frees the pool
+void stop_pool(mb_pool *pool)
+{
+    pool->stop = true;
+    pthread_barrier_wait(&pool->job_ready);
+    for (int i = 1; i < pool->size; i++) 
+        {pthread_join(pool->threads[i - 1], NULL);}
+    pthread_barrier_destroy(&pool->job_ready);
+    pthread_barrier_destroy(&pool->job_done);
+    free(pool->threads);
+    free(pool->args);
+    free(pool->partial);
+    free(pool);
+}
+
+// ---------------------------------------------
+// calculate_CgradC_fused split across the pool: same result for the
+// same number of threads, whatever the scheduling
+float calculate_CgradC_mt(mb_pool *pool, const xfx_pair *train_set, \
+    const int *idx, int n, const float *p, float *gradC)
+{
+    int n_param = N_PARAM(pool->h);
+    pool->train_set = train_set;
+    pool->idx = idx;
+    pool->n = n;
+    pool->p = p;
+    pthread_barrier_wait(&pool->job_ready);
+    run_chunk(pool, 0);
+    pthread_barrier_wait(&pool->job_done);
+
+    // reduction in thread order
+    float C = 0;
+    for (int k = 0; k < n_param; k++) {gradC[k] = 0;}
+    for (int t = 0; t < pool->size; t++)
+    {
+        const float *slot = pool->partial + t*(n_param + 1);
+        for (int k = 0; k < n_param; k++) {gradC[k] += slot[k];}
+        C += slot[n_param];
+    }
+    for (int k = 0; k < n_param; k++) {gradC[k] /= n;}
+
+    return C / n;
+}
@@ -6,8 +6,24 @@ Functions for the nnfit project
 #include "nnfit.h"
 
 #define X_EXTREME 1 // interval [-X_EXTREME, +X_EXTREME]
+#define BUSY_TIMEOUT 10000 // ms to wait for a locked db
 #define DB_NAME "../data/nnfit.db"
 #define FILE_CONFIG "../data/config.ini"
+#define TS_FILE "../data/xfx.bin"
+#define TS_PATH_LEN 1024
+
+// file paths, overridable from the command line
+const char *db_name = DB_NAME;
+const char *file_config = FILE_CONFIG;
+const char *ts_file = TS_FILE;
+// training set: row of table training_sets (0 = unversioned TS of an
+// older DB) and its binary file, ts_file with _<ts_id> before ".bin"
+int ts_id = 0;
+char ts_path[TS_PATH_LEN] = TS_FILE;
+
+// mapping of the binary TS file, if the TS comes from it
+static void *ts_map = NULL;
+static size_t ts_map_len = 0;
 
 // global variables taken from init file
 int ts_size = 0; 
@@ -15,6 +31,36 @@ int mb_size = 0;
 double eta = 0;
 int epoch_number = 0; 
 double delta = 0;
+int n_hidden = 3;
+int epochs_trained = 0;
+opt_type optimizer = OPT_SGD;
+float beta1 = BETA1;
+float beta2 = BETA2;
+
+// optimizer names in the ini file and job lines, in opt_type order
+static const char *OPT_NAMES[] = {"sgd", "momentum", "nesterov", "adam"};
+
+// shuffle RNG (rng_next): its state is a single int, saved in 
+// checkpoints; set from the ini seed by init_rseed
+unsigned int rng_state = 1;
+
+// threads for the minibatch gradient (command line option -t)
+int num_threads = 1;
+// streaming: loss printed every stream_every epochs (option -s), 0 = off
+int stream_every = 0;
+// checkpoints: state saved to ckpt_file every ckpt_every epochs and
+// when training ends (options -k and -K); NULL = off
+const char *ckpt_file = NULL;
+int ckpt_every = 10;
+// where the next train starts, set by load_checkpoint
+train_state resume_state = {0};
+float *opt_state = NULL;
+// phase timings of the run (option -T); NULL = off
+phase_timings *timings = NULL;
+// out-of-core TS: read in chunks of stream_chunk records (option -S),
+// never loaded whole; 0 = TS in memory
+int stream_chunk = 0;
+ts_source *ts_chunks = NULL;
 
 // ---------------------------------------------
 // INITIALIZATION
@@ -22,87 +68,128 @@ double delta = 0;
 
 // ---------------------------------------------
 // does whole initialization process
-model_param init(void)
+// returns the initial weights and biases (N_PARAM(n_hidden), malloc'd)
+float *init(void)
 {
-    // random seed can improve with arc4random()
-    init_rseed();
-
     // read ini file
     ini_data ini_d = init_readfile();
-
-    // weights and biases
-    model_param wb = init_wb(ini_d);
+    ini_d.seed = init_rseed(ini_d.seed);
     
     // run commands from init file
     ts_size = ini_d.ts_size; // stores TS size in global variable
     mb_size = ini_d.mb_size; // stores mini-batch size in global variable
-    if (ini_d.flag_genTS == true) // generates a new TS and DB for a chosen fx
-    {
-        xfx_pair *train_set = NULL;
-        train_set = generate_TS(ini_d.fx_choice, ini_d.fx_a, \
-            ini_d.fx_b, ini_d.fx_c);
-        create_db(train_set);
-        free_mem(train_set);
-    }
-    else
+    n_hidden = ini_d.n_hidden; // hidden width
+    if (ts_id == 0) {ts_id = ini_d.ts_id;} // -i first
+    if (ini_d.flag_genTS == true) // TS of the chosen fx: cached, or new
     {
-        ts_size = count_db();
+        // same fx, parameters, size and TS seed: same TS, generated once
+        if (ini_d.ts_seed == 0) // a new TS on each run
+        {
+            ini_d.ts_seed = (unsigned int) time(NULL) \
+                ^ (unsigned int) getpid();
+        }
+        ts_id = find_TS(ini_d);
+        if (ts_id == 0)
+        {
+            xfx_pair *train_set = generate_TS(ini_d.fx_choice, \
+                ini_d.fx_a, ini_d.fx_b, ini_d.fx_c, ini_d.ts_seed);
+            ts_id = create_db(train_set, ini_d);
+            if (ts_id == 0)
+            {
+                printf("Error: cannot store the training set in the DB.\n");
+                exit(1);
+            }
+            select_TS(ts_id);
+            write_TS_file(train_set, ini_d);
+            free_mem(train_set);
+        }
+        else
+        {
+            // the binary file is rewritten from the DB if it is gone
+            select_TS(ts_id);
+            xfx_pair *train_set = map_TS();
+            if (train_set == NULL)
+            {
+                ts_size = count_db();
+                train_set = read_TS();
+                write_TS_file(train_set, ini_d);
+                free_mem(train_set);
+            }
+            else {release_TS(train_set);}
+        }
     }
+    // else ts_size is set by load_TS
     eta = ini_d.eta; // learning rate
     epoch_number = ini_d.epoch_num;
     delta = ini_d.delta; // threshold converg
+    optimizer = ini_d.optimizer;
+    beta1 = ini_d.beta1;
+    beta2 = ini_d.beta2;
 
-    return wb;
+    return ini_d.wb;
 }
 
 // ---------------------------------------------
-// generates random seed from time
-void init_rseed(void)
+// sets the shuffle RNG state to seed, or if 0 to a seed from the 
+// clock and process id (runs then differ); returns the seed
+unsigned int init_rseed(unsigned int seed)
 {
-    // random seed
-    srand(time(NULL));
+    if (seed == 0)
+        {seed = (unsigned int) time(NULL) ^ (unsigned int) getpid();}
+    rng_state = seed;
+
+    return seed;
 }
 
 // ---------------------------------------------
-// initializes weights and biases
-model_param init_wb(ini_data ini_d)
+// opt_type of an optimizer name (see OPT_NAMES), -1 if unknown
+int parse_optimizer(const char *name)
 {
-    // weights and biases
-    // if possible generate from Gaussian dist
-    float init_w2[3][3] = {0};
-    float init_b2[3] = {0};
-    float init_w1[3][3] = {0};
-    float init_b1[3] = {0};
-    
-    for (int i = 0; i < 3; i++)
+    for (int i = 0; i < (int) (sizeof(OPT_NAMES)/sizeof(OPT_NAMES[0])); i++)
     {
-        init_w2[0][i] = ini_d.wl2[i];
-        init_w1[i][0] = ini_d.wl1[i];
-        init_b1[i] = ini_d.bl1[i];
+        if (strcmp(name, OPT_NAMES[i]) == 0) {return i;}
     }
-    init_b2[0] = ini_d.bl2;
 
-    model_param wb;  
-    memcpy(wb.w_layer_2, init_w2, sizeof(init_w2)); // third (output) layer
-    memcpy(wb.b_layer_2, init_b2, sizeof(init_b2));
-    memcpy(wb.w_layer_1, init_w1, sizeof(init_w1)); // second (hidden) layer
-    memcpy(wb.b_layer_1, init_b1, sizeof(init_b1));
+    return -1;
+}
+
+// ---------------------------------------------
+// weights and biases of the 1-3-1 reference kernel from the flat 
+// layout of a network with n_hidden = 3
+model_param init_wb(const float *wb)
+{
+    model_param wb_ref = {0};  
+    for (int i = 0; i < 3; i++)
+    {
+        wb_ref.w_layer_1[i][0] = wb[P_W1(3) + i]; // second (hidden) layer
+        wb_ref.w_layer_2[0][i] = wb[P_W2(3) + i]; // third (output) layer
+        wb_ref.b_layer_1[i] = wb[P_B1(3) + i];
+    }
+    wb_ref.b_layer_2[0] = wb[P_B2(3)];
 
-    return wb;
+    return wb_ref;
 }
 
 // ---------------------------------------------
 // read ini file 
+// lines 0-19: fixed inputs (see README), weights of hidden units 0-2
+// line 20 (optional): hidden width h, default 3
+// lines 21-: for hidden units 3...h-1, all w1, then all w2, then all b1
+// next lines (optional): optimizer name (default sgd), beta1, beta2,
+// RNG seed (default 0, from the clock), training set id (default 0, 
+// the last one), TS seed (default TS_SEED)
 ini_data init_readfile(void)
 {
     // read ini file
-    const int DATA_LEN = 11; // number of data chars in each line
-    const int LINE_LENGTH = 100; 
+    // data of each line: its first token, up to the blank or the '//'
+    // of its comment; long enough for a double at full precision
+    enum {DATA_LEN = 32}; 
+    enum {LINE_LENGTH = 160}; 
+    enum {INP_BASE = 20}; // number of fixed inputs
     char line[LINE_LENGTH]; // total length of line 
-    char data[DATA_LEN] = {};
-    ini_data ini_d;
+    ini_data ini_d = {0};
 
-    FILE *init_file = fopen(FILE_CONFIG,"r");
+    FILE *init_file = fopen(file_config,"r");
     if (init_file == NULL)
     {
         printf("I/O error: ini file.");
@@ -110,18 +197,22 @@ ini_data init_readfile(void)
     }  
     
     // read each line
-    const int INP_MAX = 20; // number of inputs to read
-    int i = 0;
-    char inputs[INP_MAX][DATA_LEN] = {}; // contains the INP_MAX inputs
+    const int INP_MAX = INP_BASE + 1 + 3*(MAX_HIDDEN - 3) + 6; // max inputs
+    int n_inputs = 0;
+    char (*inputs)[DATA_LEN] = calloc(INP_MAX, DATA_LEN); // all inputs
+    if (inputs == NULL)
+    {
+        printf("Memory allocation failed in init_readfile.\n");
+        exit(1);
+    }
     fgets(line, LINE_LENGTH - 1, init_file); // eliminates first line
     fgets(line, LINE_LENGTH - 1, init_file); // eliminates second line
-    while (fgets(line, LINE_LENGTH - 1, init_file) != NULL) 
+    while (n_inputs < INP_MAX \
+        && fgets(line, LINE_LENGTH - 1, init_file) != NULL) 
     {
         // save all input in inputs
-        sscanf(line, "%s", data);
-        data[DATA_LEN-1] = '\0';
-        memcpy(inputs[i], data, sizeof(data));
-        i++;
+        if (sscanf(line, " %31[^ \t\r\n/]", inputs[n_inputs]) == 1) 
+            {n_inputs++;}
     } 
      
     fclose(init_file);
@@ -137,26 +228,114 @@ ini_data init_readfile(void)
     ini_d.eta = atof(inputs[7]);
     ini_d.epoch_num = atoi(inputs[8]);
     ini_d.delta = atof(inputs[9]);
-    for (int i = 0; i < 3; i++)
+    int h = n_inputs > INP_BASE ? atoi(inputs[INP_BASE]) : 3;
+    int n_extra = h > 3 ? h - 3 : 0; // hidden units after the first 3
+    if (h < 1 || h > MAX_HIDDEN \
+        || n_inputs < INP_BASE + (n_extra > 0 ? 1 + 3*n_extra : 0))
+    {
+        printf("Error in init file: hidden width or its weights.\n");
+        exit(1);
+    }
+    ini_d.n_hidden = h;
+    ini_d.wb = malloc(N_PARAM(h)*sizeof(float));
+    if (ini_d.wb == NULL)
+    {
+        printf("Memory allocation failed in init_readfile.\n");
+        exit(1);
+    }
+    // floats as read_job reads them: straight to float, not via double
+    for (int i = 0; i < h; i++)
+    {
+        int i_w1 = i < 3 ? 10 + i : INP_BASE + 1 + (i - 3);
+        int i_w2 = i < 3 ? 13 + i : INP_BASE + 1 + n_extra + (i - 3);
+        int i_b1 = i < 3 ? 16 + i : INP_BASE + 1 + 2*n_extra + (i - 3);
+        ini_d.wb[P_W1(h) + i] = strtof(inputs[i_w1], NULL);
+        ini_d.wb[P_W2(h) + i] = strtof(inputs[i_w2], NULL);
+        ini_d.wb[P_B1(h) + i] = strtof(inputs[i_b1], NULL);
+    }
+    ini_d.wb[P_B2(h)] = strtof(inputs[19], NULL);
+    int i_opt = INP_BASE + 1 + 3*n_extra; // optimizer line
+    int opt = n_inputs > i_opt ? parse_optimizer(inputs[i_opt]) : OPT_SGD;
+    ini_d.beta1 = n_inputs > i_opt + 1 ? \
+        strtof(inputs[i_opt + 1], NULL) : BETA1;
+    ini_d.beta2 = n_inputs > i_opt + 2 ? \
+        strtof(inputs[i_opt + 2], NULL) : BETA2;
+    if (opt < 0 || ini_d.beta1 < 0 || ini_d.beta1 >= 1 \
+        || ini_d.beta2 < 0 || ini_d.beta2 >= 1)
+    {
+        printf("Error in init file: optimizer or its betas.\n");
+        exit(1);
+    }
+    ini_d.optimizer = opt;
+    ini_d.seed = n_inputs > i_opt + 3 ? strtoul(inputs[i_opt + 3], NULL, 10) : 0;
+    ini_d.ts_id = n_inputs > i_opt + 4 ? atoi(inputs[i_opt + 4]) : 0;
+    if (ini_d.ts_id < 0)
     {
-        ini_d.wl1[i] = atof(inputs[10+i]);
-        ini_d.wl2[i] = atof(inputs[13+i]);
-        ini_d.bl1[i] = atof(inputs[16+i]);
+        printf("Error in init file: training set id.\n");
+        exit(1);
     }
-    ini_d.bl2 = atof(inputs[19]);
+    ini_d.ts_seed = n_inputs > i_opt + 5 \
+        ? strtoul(inputs[i_opt + 5], NULL, 10) : TS_SEED;
+
+    free(inputs);
 
     return ini_d;
 }
 
+// ---------------------------------------------
+// worker mode: parses one job line into ini_d, of the form
+// mb eta epoch_num delta optimizer beta1 beta2 seed h wb[N_PARAM(h)]
+// ini_d->wb is malloc'd on success; returns 0 on success
+int read_job(const char *line, ini_data *ini_d)
+{
+    int n_read = 0;
+    int h = 0;
+    char opt_name[16];
+    if (sscanf(line, "%d %lf %d %lf %15s %f %f %u %d%n", &ini_d->mb_size, \
+        &ini_d->eta, &ini_d->epoch_num, &ini_d->delta, opt_name, \
+        &ini_d->beta1, &ini_d->beta2, &ini_d->seed, &h, &n_read) != 9 \
+        || ini_d->mb_size <= 0 || ini_d->mb_size > ts_size \
+        || ini_d->epoch_num <= 0 || h < 1 || h > MAX_HIDDEN \
+        || parse_optimizer(opt_name) < 0 || ini_d->beta1 < 0 \
+        || ini_d->beta1 >= 1 || ini_d->beta2 < 0 || ini_d->beta2 >= 1)
+    {
+        return 1;
+    }
+    ini_d->optimizer = parse_optimizer(opt_name);
+    ini_d->n_hidden = h;
+    ini_d->wb = malloc(N_PARAM(h)*sizeof(float));
+    if (ini_d->wb == NULL)
+    {
+        return 1;
+    }
+    const char *pos = line + n_read;
+    for (int k = 0; k < N_PARAM(h); k++)
+    {
+        char *end;
+        ini_d->wb[k] = strtof(pos, &end);
+        if (end == pos)
+        {
+            free(ini_d->wb);
+            ini_d->wb = NULL;
+            return 1;
+        }
+        pos = end;
+    }
+
+    return 0;
+}
+
 
 // ---------------------------------------------
 // TRAINING SET
 // ---------------------------------------------
 
 // ---------------------------------------------
-// generates de training set
+// generates de training set: ts_size x uniform in the x-interval, 
+// from the RNG stream of seed ^ RNG_TS_STREAM (its own state: 
+// rng_state is not advanced)
 xfx_pair *generate_TS(char fx_choice, \
-        float fx_a, float fx_b, float fx_c)
+        float fx_a, float fx_b, float fx_c, unsigned int seed)
 {
     xfx_pair *train_set = malloc(ts_size * sizeof(xfx_pair));
     if (train_set == NULL)
@@ -166,10 +345,13 @@ xfx_pair *generate_TS(char fx_choice, \
     }
     
     float rescaled_rand;
+    unsigned int rng = seed ^ RNG_TS_STREAM;
     for (int i = 0; i < ts_size; i++)
     {
-        // colapse random number to the interval of interest
-        rescaled_rand = (float) (rand()-RAND_MAX/2)/(RAND_MAX/2)*X_EXTREME;
+        // colapse random number to the interval of interest: the top
+        // 24 bits, exact in a float, to [-1, 1)
+        rescaled_rand = ((float) (rng_next(&rng) >> 8)/(1 << 23) - 1) \
+            *X_EXTREME;
         train_set[i].x = rescaled_rand;
         train_set[i].fx = calculate_fx(train_set[i].x, fx_choice, fx_a, \
             fx_b, fx_c);
@@ -214,79 +396,214 @@ void free_mem(xfx_pair *ts)
 // ---------------------------------------------
 
 // ---------------------------------------------
-// creates a db with the training set
-int create_db(xfx_pair *train_set)
+// stores a new training set: a row of table training_sets, keyed by
+// fx, its parameters, ts_size and TS seed, and its records in table xfx
+// with that ts_id. Sets of other keys are kept. If another engine 
+// stored the same key meanwhile, its set (the same records) is used.
+// returns the ts_id, 0 on error
+int create_db(xfx_pair *train_set, ini_data ini_d)
 {
     sqlite3 *db;
     int db_status;
     char *err_msg = 0;
 
     // open/create db
-    db_status = sqlite3_open(DB_NAME, &db);
+    db_status = sqlite3_open(db_name, &db);
     if (db_status != SQLITE_OK) 
     {
         fprintf(stderr, "Error: %s", sqlite3_errmsg(db));
         sqlite3_close(db);
-        return 1;
+        return 0;
     }
+    sqlite3_busy_timeout(db, BUSY_TIMEOUT);
     
-    char sql_qry[256];
-
-    // create table
-    strcpy(sql_qry, "CREATE TABLE IF NOT EXISTS xfx (id INTEGER PRIMARY KEY, \
-        x REAL, fx REAL);");
+    // create tables (as python/db.py); xfx of older DBs gets ts_id, 
+    // which fails harmlessly if it is there
+    const char *sql_qry = "CREATE TABLE IF NOT EXISTS xfx (" \
+        "id INTEGER PRIMARY KEY, x REAL, fx REAL, ts_id INTEGER);" \
+        "CREATE TABLE IF NOT EXISTS training_sets (" \
+        "id INTEGER PRIMARY KEY, fx TEXT, a REAL, b REAL, c REAL, " \
+        "ts_size INTEGER, seed INTEGER, checksum INTEGER, " \
+        "UNIQUE (fx, a, b, c, ts_size, seed));";
     db_status = sqlite3_exec(db, sql_qry, 0, 0, &err_msg);
     if (db_status != SQLITE_OK)
     {
         fprintf(stderr, "Error: %s\n", err_msg);
+        sqlite3_free(err_msg);
     }
- 
-    // delete previous data
-    sprintf(sql_qry, "DELETE FROM xfx;");
-    db_status = sqlite3_exec(db, sql_qry, callback, 0, &err_msg);
+    sqlite3_exec(db, "ALTER TABLE xfx ADD COLUMN ts_id INTEGER;", 0, 0, 0);
+    sqlite3_exec(db, "CREATE INDEX IF NOT EXISTS idx_xfx_ts_id " \
+        "ON xfx (ts_id, id);", 0, 0, 0);
+
+    // Begin transaction: immediate, so no other engine stores the 
+    // same key between the check and the inserts
+    db_status = sqlite3_exec(db, "BEGIN IMMEDIATE;", callback, 0, &err_msg);
     if (db_status != SQLITE_OK)
     {
         fprintf(stderr, "Error: %s\n", err_msg);
+        sqlite3_free(err_msg);
+        sqlite3_close(db);
+        return 0;
+    }
+    int id = 0;
+    sqlite3_stmt *stmt;
+    char fx[2] = {ini_d.fx_choice, '\0'};
+    db_status = sqlite3_prepare_v2(db, "INSERT OR IGNORE INTO " \
+        "training_sets (fx, a, b, c, ts_size, seed, checksum) " \
+        "VALUES (?, ?, ?, ?, ?, ?, ?);", -1, &stmt, 0);
+    if (db_status == SQLITE_OK)
+    {
+        sqlite3_bind_text(stmt, 1, fx, -1, SQLITE_STATIC);
+        sqlite3_bind_double(stmt, 2, ini_d.fx_a);
+        sqlite3_bind_double(stmt, 3, ini_d.fx_b);
+        sqlite3_bind_double(stmt, 4, ini_d.fx_c);
+        sqlite3_bind_int(stmt, 5, ts_size);
+        sqlite3_bind_int64(stmt, 6, ini_d.ts_seed);
+        sqlite3_bind_int64(stmt, 7, \
+            crc32_TS(train_set, ts_size*sizeof(xfx_pair)));
+        db_status = sqlite3_step(stmt);
+        if (db_status == SQLITE_DONE && sqlite3_changes(db) == 1)
+            {id = (int) sqlite3_last_insert_rowid(db);}
+        sqlite3_finalize(stmt);
+    }
+    if (db_status != SQLITE_DONE)
+    {
+        fprintf(stderr, "Error: %s\n", sqlite3_errmsg(db));
+        sqlite3_exec(db, "ROLLBACK;", NULL, 0, NULL);
+        sqlite3_close(db);
+        return 0;
+    }
+    if (id == 0)
+    {
+        // stored by another engine
+        sqlite3_exec(db, "COMMIT;", NULL, 0, NULL);
+        sqlite3_close(db);
+        return find_TS(ini_d);
     }
 
-    const int LENGTH_SQLQRY = 60;
-    char sql_qry_ins[LENGTH_SQLQRY];
-    // Begin transaction
-    db_status = sqlite3_exec(db, "BEGIN TRANSACTION;", callback, 0, &err_msg);
+    // insert new training set, one prepared statement for all rows
+    db_status = sqlite3_prepare_v2(db, \
+        "INSERT INTO xfx (x, fx, ts_id) VALUES (?, ?, ?);", -1, &stmt, 0);
     if (db_status != SQLITE_OK)
     {
-        fprintf(stderr, "Error: %s\n", err_msg);
-        return 1;
+        fprintf(stderr, "Failed to prepare statement: %s\n", \
+            sqlite3_errmsg(db));
+        sqlite3_exec(db, "ROLLBACK;", NULL, 0, NULL);
+        sqlite3_close(db);
+        return 0;
     }
-    // insert new training set
     for (int i = 0; i < ts_size; i++)
     {
-        sprintf(sql_qry_ins, "INSERT INTO xfx (x, fx) VALUES (%7.4f,%7.4f);", \
-            train_set[i].x, train_set[i].fx);
-        db_status = sqlite3_exec(db, sql_qry_ins, callback, 0, &err_msg);
-        if (db_status != SQLITE_OK)
+        sqlite3_bind_double(stmt, 1, train_set[i].x);
+        sqlite3_bind_double(stmt, 2, train_set[i].fx);
+        sqlite3_bind_int(stmt, 3, id);
+        db_status = sqlite3_step(stmt);
+        sqlite3_reset(stmt);
+        if (db_status != SQLITE_DONE)
         {
-            fprintf(stderr, "Error: %s\n", err_msg);
+            fprintf(stderr, "Error: %s\n", sqlite3_errmsg(db));
             break;
         }
     }
+    sqlite3_finalize(stmt);
     // Commit the transaction if all statements were successful
+    if (db_status != SQLITE_DONE) 
+    {
+        sqlite3_exec(db, "ROLLBACK;", NULL, 0, NULL);
+        sqlite3_close(db);
+        return 0;
+    }
     db_status = sqlite3_exec(db, "COMMIT;", NULL, 0, &err_msg);
     if (db_status != SQLITE_OK) {
         fprintf(stderr, "Failed to commit transaction: %s\n", err_msg);
         sqlite3_free(err_msg);
         sqlite3_exec(db, "ROLLBACK;", NULL, 0, NULL); // Rollback on commit failure
         sqlite3_close(db);
-        return 1;
+        return 0;
     } 
   
     sqlite3_close(db);
 
-    return 0;
+    return id;
+}
+
+// ---------------------------------------------
+// ts_id of the stored training set of ini_d's fx, parameters, 
+// ts_size and TS seed; 0 if there is none (or no table training_sets)
+int find_TS(ini_data ini_d)
+{
+    sqlite3 *db;
+    sqlite3_stmt *stmt = NULL;
+    int id = 0;
+    char fx[2] = {ini_d.fx_choice, '\0'};
+
+    if (sqlite3_open_v2(db_name, &db, SQLITE_OPEN_READONLY, NULL) \
+        != SQLITE_OK)
+    {
+        sqlite3_close(db);
+        return 0;
+    }
+    sqlite3_busy_timeout(db, BUSY_TIMEOUT);
+    // a, b, c are compared as stored: doubles of the ini floats
+    if (sqlite3_prepare_v2(db, "SELECT id FROM training_sets WHERE " \
+        "fx = ? AND a = ? AND b = ? AND c = ? AND ts_size = ? " \
+        "AND seed = ?;", -1, &stmt, 0) == SQLITE_OK)
+    {
+        sqlite3_bind_text(stmt, 1, fx, -1, SQLITE_STATIC);
+        sqlite3_bind_double(stmt, 2, ini_d.fx_a);
+        sqlite3_bind_double(stmt, 3, ini_d.fx_b);
+        sqlite3_bind_double(stmt, 4, ini_d.fx_c);
+        sqlite3_bind_int(stmt, 5, ini_d.ts_size);
+        sqlite3_bind_int64(stmt, 6, ini_d.ts_seed);
+        if (sqlite3_step(stmt) == SQLITE_ROW) 
+            {id = sqlite3_column_int(stmt, 0);}
+    }
+    sqlite3_finalize(stmt);
+    sqlite3_close(db);
+
+    return id;
 }
 
 // ---------------------------------------------
-// reads an existent DB and loads the TS
+// sets ts_id to id, or if 0 to the last training set stored (stays 0
+// on a DB without table training_sets: its one unversioned TS), and
+// ts_path to the binary file of ts_id
+void select_TS(int id)
+{
+    if (id == 0)
+    {
+        sqlite3 *db;
+        sqlite3_stmt *stmt = NULL;
+        if (sqlite3_open_v2(db_name, &db, SQLITE_OPEN_READONLY, NULL) \
+            == SQLITE_OK)
+        {
+            sqlite3_busy_timeout(db, BUSY_TIMEOUT);
+            if (sqlite3_prepare_v2(db, "SELECT MAX(id) FROM training_sets;", \
+                -1, &stmt, 0) == SQLITE_OK && sqlite3_step(stmt) == SQLITE_ROW)
+                {id = sqlite3_column_int(stmt, 0);}
+            sqlite3_finalize(stmt);
+        }
+        sqlite3_close(db);
+    }
+    ts_id = id;
+
+    // ts_file with _<ts_id> before its extension
+    const char *dot = strrchr(ts_file, '.');
+    const char *slash = strrchr(ts_file, '/');
+    int len = (dot != NULL && (slash == NULL || dot > slash)) ? \
+        (int) (dot - ts_file) : (int) strlen(ts_file);
+    if (ts_id == 0)
+        {snprintf(ts_path, TS_PATH_LEN, "%s", ts_file);}
+    else
+    {
+        snprintf(ts_path, TS_PATH_LEN, "%.*s_%d%s", len, ts_file, ts_id, \
+            ts_file + len);
+    }
+}
+
+// ---------------------------------------------
+// reads an existent DB and loads the TS ts_id (0: the whole table xfx,
+// of an older DB)
 xfx_pair *read_TS(void)
 {
     xfx_pair *train_set = malloc(ts_size*sizeof(xfx_pair));
@@ -300,15 +617,17 @@ xfx_pair *read_TS(void)
     sqlite3_stmt *stmt;
     int db_status;
  
-    // open/create db
-    db_status = sqlite3_open(DB_NAME, &db);
+    // open db read-only: several engines may share it
+    db_status = sqlite3_open_v2(db_name, &db, SQLITE_OPEN_READONLY, NULL);
     if (db_status != SQLITE_OK) 
     {
         fprintf(stderr, "Error: %s", sqlite3_errmsg(db));
         sqlite3_close(db);
         exit(1);
     }
-    char sql_qry[256] = "SELECT * FROM xfx;";
+    sqlite3_busy_timeout(db, BUSY_TIMEOUT);
+    const char *sql_qry = ts_id == 0 ? "SELECT * FROM xfx ORDER BY id;" \
+        : "SELECT * FROM xfx WHERE ts_id = ? ORDER BY id;";
 
     // read training set
     // Prepare the statement
@@ -318,6 +637,7 @@ xfx_pair *read_TS(void)
         sqlite3_close(db);
         exit(1);
     }
+    if (ts_id != 0) {sqlite3_bind_int(stmt, 1, ts_id);}
 
     // Execute the statement
     int i = 0;
@@ -338,29 +658,24 @@ xfx_pair *read_TS(void)
 }
 
 // ---------------------------------------------
-// counts number of elements in DB
+// counts number of elements of the TS ts_id in DB (see read_TS)
 int count_db(void)
 {
-    xfx_pair *train_set = malloc(ts_size*sizeof(xfx_pair));
-    if (train_set == NULL)
-    {
-        printf("Memory allocation failed in read_TS.\n");
-        exit(1);
-    }
-
     sqlite3 *db;
     sqlite3_stmt *stmt;
     int db_status;
  
-    // open/create db
-    db_status = sqlite3_open(DB_NAME, &db);
+    // open db read-only: several engines may share it
+    db_status = sqlite3_open_v2(db_name, &db, SQLITE_OPEN_READONLY, NULL);
     if (db_status != SQLITE_OK) 
     {
         fprintf(stderr, "Error: %s", sqlite3_errmsg(db));
         sqlite3_close(db);
         exit(1);
     }
-    char sql_qry[256] = "SELECT COUNT(*) FROM xfx;";
+    sqlite3_busy_timeout(db, BUSY_TIMEOUT);
+    const char *sql_qry = ts_id == 0 ? "SELECT COUNT(*) FROM xfx;" \
+        : "SELECT COUNT(*) FROM xfx WHERE ts_id = ?;";
 
     // Prepare the statement
     db_status = sqlite3_prepare_v2(db, sql_qry, -1, &stmt, 0);
@@ -370,6 +685,7 @@ int count_db(void)
         sqlite3_close(db);
         exit(1);
     }
+    if (ts_id != 0) {sqlite3_bind_int(stmt, 1, ts_id);}
 
     // Execute the statement
     db_status = sqlite3_step(stmt);
@@ -383,6 +699,531 @@ int count_db(void)
     return cnt;
 }
 
+// ---------------------------------------------
+// BINARY TS FILE
+// ---------------------------------------------
+
+// ---------------------------------------------
+// writes the TS ts_id to ts_path: a ts_header followed by the records.
+// Written to a temporary file and renamed, so engines mapping the
+// previous file never see a partial one
+int write_TS_file(xfx_pair *train_set, ini_data ini_d)
+{
+    ts_header header = {0};
+    memcpy(header.magic, TS_MAGIC, sizeof(header.magic));
+    header.version = TS_VERSION;
+    header.ts_size = ts_size;
+    header.fx_choice = ini_d.fx_choice;
+    header.fx_a = ini_d.fx_a;
+    header.fx_b = ini_d.fx_b;
+    header.fx_c = ini_d.fx_c;
+    header.checksum = crc32_TS(train_set, ts_size*sizeof(xfx_pair));
+    header.ts_id = ts_id;
+    header.seed = ini_d.ts_seed;
+
+    char tmp_name[TS_PATH_LEN + 32];
+    snprintf(tmp_name, sizeof(tmp_name), "%s.%d.tmp", ts_path, (int) getpid());
+    FILE *bin_file = fopen(tmp_name, "wb");
+    if (bin_file == NULL)
+    {
+        fprintf(stderr, "I/O error: cannot write %s\n", tmp_name);
+        return 1;
+    }
+    size_t written = fwrite(&header, sizeof(header), 1, bin_file);
+    written += fwrite(train_set, sizeof(xfx_pair), ts_size, bin_file);
+    if (fclose(bin_file) != 0 || written != (size_t) ts_size + 1 \
+        || rename(tmp_name, ts_path) != 0)
+    {
+        fprintf(stderr, "I/O error: cannot write %s\n", ts_path);
+        remove(tmp_name);
+        return 1;
+    }
+
+    return 0;
+}
+
+// ---------------------------------------------
+// maps ts_path read-only and sets ts_size from its header; all engines
+// mapping it share one page-cache copy. NULL if missing or invalid
+xfx_pair *map_TS(void)
+{
+    int fd = open(ts_path, O_RDONLY);
+    if (fd < 0)
+    {
+        return NULL;
+    }
+    struct stat st;
+    if (fstat(fd, &st) != 0 || (size_t) st.st_size < sizeof(ts_header))
+    {
+        close(fd);
+        return NULL;
+    }
+    void *map = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (map == MAP_FAILED)
+    {
+        return NULL;
+    }
+
+    const ts_header *header = map;
+    if (memcmp(header->magic, TS_MAGIC, sizeof(header->magic)) != 0 \
+        || header->version != TS_VERSION || header->ts_size <= 0 \
+        || header->ts_id != ts_id \
+        || (size_t) st.st_size != sizeof(ts_header) \
+            + header->ts_size*sizeof(xfx_pair))
+    {
+        fprintf(stderr, "Warning: invalid %s, reading the DB\n", ts_path);
+        munmap(map, st.st_size);
+        return NULL;
+    }
+    ts_map = map;
+    ts_map_len = st.st_size;
+    ts_size = header->ts_size;
+
+    return (xfx_pair *) ((char *) map + sizeof(ts_header));
+}
+
+// ---------------------------------------------
+// loads the TS ts_id (if 0, the last one, see select_TS): mapped from
+// its binary file, else read from the DB
+// sets ts_size; the TS must be released with release_TS
+xfx_pair *load_TS(void)
+{
+    select_TS(ts_id);
+    xfx_pair *train_set = map_TS();
+    if (train_set == NULL)
+    {
+        ts_size = count_db();
+        train_set = read_TS();
+    }
+
+    return train_set;
+}
+
+// ---------------------------------------------
+// releases a TS returned by load_TS
+void release_TS(xfx_pair *train_set)
+{
+    if (ts_map != NULL)
+    {
+        munmap(ts_map, ts_map_len);
+        ts_map = NULL;
+        ts_map_len = 0;
+    }
+    else
+    {
+        free(train_set);
+    }
+}
+
+// ---------------------------------------------
+// CRC-32 (IEEE, as zlib.crc32) of the TS records
+uint32_t crc32_TS(const void *data, size_t len)
+{
+    static uint32_t table[256];
+    static bool table_ready = false;
+    if (!table_ready)
+    {
+        for (uint32_t i = 0; i < 256; i++)
+        {
+            uint32_t c = i;
+            for (int k = 0; k < 8; k++)
+                {c = (c & 1) ? 0xEDB88320u ^ (c >> 1) : c >> 1;}
+            table[i] = c;
+        }
+        table_ready = true;
+    }
+
+    const unsigned char *bytes = data;
+    uint32_t crc = 0xFFFFFFFFu;
+    for (size_t i = 0; i < len; i++)
+        {crc = table[(crc ^ bytes[i]) & 0xFF] ^ (crc >> 8);}
+
+    return crc ^ 0xFFFFFFFFu;
+}
+
+// ---------------------------------------------
+// OUT-OF-CORE TS
+// ---------------------------------------------
+
+// ---------------------------------------------
+// opens the TS ts_id for reading in chunks (see read_TS_chunk) and 
+// sets ts_size: its binary file if valid, else table xfx by id ranges.
+// Exits if neither can be read
+ts_source *open_TS_source(void)
+{
+    select_TS(ts_id);
+    ts_source *src = calloc(1, sizeof(ts_source));
+    if (src == NULL)
+    {
+        printf("Memory allocation failed in open_TS_source.\n");
+        exit(1);
+    }
+    src->fd = open(ts_path, O_RDONLY);
+    if (src->fd >= 0)
+    {
+        ts_header header;
+        struct stat st;
+        if (pread(src->fd, &header, sizeof(header), 0) == sizeof(header) \
+            && fstat(src->fd, &st) == 0 \
+            && memcmp(header.magic, TS_MAGIC, sizeof(header.magic)) == 0 \
+            && header.version == TS_VERSION && header.ts_size > 0 \
+            && header.ts_id == ts_id \
+            && (size_t) st.st_size == sizeof(ts_header) \
+                + header.ts_size*sizeof(xfx_pair))
+        {
+            ts_size = header.ts_size;
+            return src;
+        }
+        fprintf(stderr, "Warning: invalid %s, reading the DB\n", ts_path);
+        close(src->fd);
+        src->fd = -1;
+    }
+
+    // rows of the TS in table xfx: ids are consecutive (see create_db)
+    sqlite3_stmt *stmt;
+    if (sqlite3_open_v2(db_name, &src->db, SQLITE_OPEN_READONLY, NULL) \
+        != SQLITE_OK)
+    {
+        fprintf(stderr, "Error: %s", sqlite3_errmsg(src->db));
+        exit(1);
+    }
+    sqlite3_busy_timeout(src->db, BUSY_TIMEOUT);
+    if (sqlite3_prepare_v2(src->db, ts_id == 0 ? \
+        "SELECT COUNT(*), MIN(id) FROM xfx;" : \
+        "SELECT COUNT(*), MIN(id) FROM xfx WHERE ts_id = ?;", \
+        -1, &stmt, 0) != SQLITE_OK \
+        || (ts_id != 0 && sqlite3_bind_int(stmt, 1, ts_id) != SQLITE_OK) \
+        || sqlite3_step(stmt) != SQLITE_ROW)
+    {
+        fprintf(stderr, "Error: %s\n", sqlite3_errmsg(src->db));
+        exit(1);
+    }
+    ts_size = sqlite3_column_int(stmt, 0);
+    src->id_0 = sqlite3_column_int64(stmt, 1);
+    sqlite3_finalize(stmt);
+    if (sqlite3_prepare_v2(src->db, "SELECT x, fx FROM xfx " \
+        "WHERE id >= ? AND id < ? ORDER BY id;", -1, &src->stmt, 0) \
+        != SQLITE_OK)
+    {
+        fprintf(stderr, "Failed to prepare statement: %s\n", \
+            sqlite3_errmsg(src->db));
+        exit(1);
+    }
+
+    return src;
+}
+
+// ---------------------------------------------
+// chunk_reader of a ts_source: records first...first+n-1 into buf,
+// with pread from ts_path or one id range of table xfx; returns the
+// number of records read
+int read_TS_chunk(void *source, int first, int n, xfx_pair *buf)
+{
+    ts_source *src = source;
+    if (src->fd >= 0)
+    {
+        size_t len = n*sizeof(xfx_pair);
+        off_t offset = sizeof(ts_header) + (off_t) first*sizeof(xfx_pair);
+        size_t done = 0;
+        while (done < len)
+        {
+            ssize_t got = pread(src->fd, (char *) buf + done, len - done, \
+                offset + done);
+            if (got <= 0) {break;}
+            done += got;
+        }
+        return (int) (done/sizeof(xfx_pair));
+    }
+
+    int i = 0;
+    sqlite3_bind_int64(src->stmt, 1, src->id_0 + first);
+    sqlite3_bind_int64(src->stmt, 2, src->id_0 + first + n);
+    while (i < n && sqlite3_step(src->stmt) == SQLITE_ROW)
+    {
+        buf[i].x = sqlite3_column_double(src->stmt, 0);
+        buf[i].fx = sqlite3_column_double(src->stmt, 1);
+        i++;
+    }
+    sqlite3_reset(src->stmt);
+
+    return i;
+}
+
+// ---------------------------------------------
+// closes a TS opened by open_TS_source
+void close_TS_source(ts_source *src)
+{
+    if (src->fd >= 0) {close(src->fd);}
+    sqlite3_finalize(src->stmt);
+    sqlite3_close(src->db);
+    free(src);
+}
+
+// ---------------------------------------------
+// ENGINE TRAINING
+// ---------------------------------------------
+
+// ---------------------------------------------
+// train_run on the engine's globals: updates wb (N_PARAM(n_hidden) 
+// floats), eta and rng_state, and fills C_epoch (epoch_number long, 
+// or NULL); returns the number of epochs to report. With 
+// stream_every > 0, the loss of these epochs is also printed as it 
+// becomes known. Starts from resume_state and opt_state (then reset), 
+// and saves checkpoints if ckpt_file is set (see engine_epoch). With
+// ts_chunks (-S), the TS is read from it in chunks and train_set is 
+// not used
+int train(xfx_pair *train_set, float *wb, float *C_epoch)
+{
+    // optimizer state: from the checkpoint, else zeros; kept here so
+    // that checkpoints can save it
+    float *state = opt_state;
+    if (state == NULL && optimizer != OPT_SGD)
+    {
+        state = calloc(2*N_PARAM(n_hidden), sizeof(float));
+        if (state == NULL)
+        {
+            printf("Memory allocation failed in train.\n");
+            exit(1);
+        }
+    }
+    opt_state = NULL;
+    train_ctx ctx = 
+    {
+        .train_set = train_set,
+        .ts_size = ts_size,
+        .mb_size = mb_size,
+        .epoch_number = epoch_number,
+        .delta = delta,
+        .n_hidden = n_hidden,
+        .threads = num_threads,
+        .eta = eta,
+        .rng_state = rng_state,
+        .start = resume_state,
+        .optimizer = optimizer,
+        .beta1 = beta1,
+        .beta2 = beta2,
+        .opt_state = state,
+        .on_epoch = engine_epoch,
+        .timings = timings,
+    };
+    if (ts_chunks != NULL)
+    {
+        ctx.read_chunk = read_TS_chunk;
+        ctx.ts_source = ts_chunks;
+        ctx.chunk_size = stream_chunk;
+        ctx.buffer_chunks = TS_BUFFER_CHUNKS;
+    }
+    resume_state = (train_state) {0};
+    int epoch_converged = train_run(&ctx, wb, C_epoch);
+    free(state);
+    if (epoch_converged == -2)
+    {
+        fprintf(stderr, "I/O error: cannot read the TS in train\n");
+        exit(1);
+    }
+    if (epoch_converged < 0)
+    {
+        printf("Memory allocation failed in train.\n");
+        exit(1);
+    }
+    eta = ctx.eta;
+    rng_state = ctx.rng_state;
+    epochs_trained = ctx.epochs_trained;
+
+    return epoch_converged;
+}
+
+// ---------------------------------------------
+// epoch hook of the engine: streams the loss of the epoch that is now
+// known to be reported (-s), and saves checkpoints (-k): every 
+// ckpt_every epochs, and a last one that resuming from only prints 
+// the results
+void engine_epoch(const train_ctx *ctx, const float *wb, \
+    const float *C_epoch, train_state state, float C_reported, bool done)
+{
+    int reported = state.epoch_converged - 1;
+    if (!done && stream_every > 0 && reported >= 0 \
+        && reported % stream_every == 0)
+    {
+        print_epoch(reported, C_reported);
+    }
+    if (ckpt_file != NULL && (done || (state.epoch % ckpt_every == 0 \
+        && state.epoch < ctx->epoch_number)))
+    {
+        save_checkpoint(ctx, wb, C_epoch, state.epoch, \
+            state.epoch_converged, state.C_prev);
+    }
+}
+
+// ---------------------------------------------
+// streaming mode (-s): one JSON record per line, flushed at once
+// so that the reader sees every epoch as it ends
+void print_epoch(int epoch, float C)
+{
+    printf("{\"epoch\": %d, \"loss\": ", epoch);
+    print_loss(C);
+    printf("}\n");
+    fflush(stdout);
+}
+
+// ---------------------------------------------
+// loss as a JSON number; a diverged run prints NaN or Infinity,
+// as read by Python's json module
+void print_loss(float C)
+{
+    if (isnan(C)) {printf("NaN");}
+    else if (isinf(C)) {printf(C > 0 ? "Infinity" : "-Infinity");}
+    else {printf("%f", C);}
+}
+
+// ---------------------------------------------
+// CHECKPOINTS
+// ---------------------------------------------
+
+// ---------------------------------------------
+// writes the training state of ctx to ckpt_file: a ckpt_header, wb, 
+// the loss of epochs 0...epoch-1 (none when streaming) and the 
+// optimizer state (none for SGD). Written aside and renamed, so a 
+// killed engine leaves the previous checkpoint whole
+int save_checkpoint(const train_ctx *ctx, const float *wb, \
+    const float *C_epoch, int epoch, int epoch_converged, float C_prev)
+{
+    int n_param = N_PARAM(ctx->n_hidden);
+    int n_loss = C_epoch != NULL ? epoch : 0;
+    int n_opt = ctx->opt_state != NULL ? 2*n_param : 0;
+    ckpt_header header = {0};
+    memcpy(header.magic, CKPT_MAGIC, sizeof(header.magic));
+    header.version = CKPT_VERSION;
+    header.n_hidden = ctx->n_hidden;
+    header.epoch_number = ctx->epoch_number;
+    header.epoch = epoch;
+    header.epoch_converged = epoch_converged;
+    header.n_loss = n_loss;
+    header.rng_state = ctx->rng_state;
+    header.eta = ctx->eta;
+    header.C_prev = C_prev;
+    header.optimizer = ctx->optimizer;
+    header.n_opt = n_opt;
+    header.checksum = crc32_TS(wb, n_param*sizeof(float));
+    if (n_loss > 0)
+    {
+        header.checksum = crc32_TS(C_epoch, n_loss*sizeof(float)) \
+            ^ header.checksum;
+    }
+    if (n_opt > 0)
+    {
+        header.checksum = crc32_TS(ctx->opt_state, n_opt*sizeof(float)) \
+            ^ header.checksum;
+    }
+
+    char tmp_name[1024];
+    snprintf(tmp_name, sizeof(tmp_name), "%s.%d.tmp", ckpt_file, \
+        (int) getpid());
+    FILE *ckpt = fopen(tmp_name, "wb");
+    if (ckpt == NULL)
+    {
+        fprintf(stderr, "I/O error: cannot write %s\n", tmp_name);
+        return 1;
+    }
+    size_t written = fwrite(&header, sizeof(header), 1, ckpt);
+    written += fwrite(wb, sizeof(float), n_param, ckpt);
+    if (n_loss > 0) {written += fwrite(C_epoch, sizeof(float), n_loss, ckpt);}
+    if (n_opt > 0) 
+        {written += fwrite(ctx->opt_state, sizeof(float), n_opt, ckpt);}
+    if (fclose(ckpt) != 0 \
+        || written != (size_t) (1 + n_param + n_loss + n_opt) \
+        || rename(tmp_name, ckpt_file) != 0)
+    {
+        fprintf(stderr, "I/O error: cannot write %s\n", ckpt_file);
+        remove(tmp_name);
+        return 1;
+    }
+
+    return 0;
+}
+
+// ---------------------------------------------
+// restores the training state from ckpt_file into wb, C_epoch (may 
+// be NULL), eta, rng_state, resume_state and opt_state (malloc'd, 
+// see train). The checkpoint must be of a run with the same n_hidden,
+// epoch_number and optimizer.
+// returns 0 if restored, 1 if there is no valid checkpoint
+int load_checkpoint(float *wb, float *C_epoch)
+{
+    FILE *ckpt = fopen(ckpt_file, "rb");
+    if (ckpt == NULL)
+    {
+        return 1;
+    }
+    int n_param = N_PARAM(n_hidden);
+    ckpt_header header;
+    float *wb_ckpt = malloc(n_param*sizeof(float));
+    float *loss_ckpt = malloc((epoch_number + 1)*sizeof(float));
+    float *opt_ckpt = malloc(2*n_param*sizeof(float));
+    int status = 1;
+    if (wb_ckpt != NULL && loss_ckpt != NULL && opt_ckpt != NULL \
+        && fread(&header, sizeof(header), 1, ckpt) == 1 \
+        && memcmp(header.magic, CKPT_MAGIC, sizeof(header.magic)) == 0 \
+        && header.version == CKPT_VERSION && header.n_hidden == n_hidden \
+        && header.epoch_number == epoch_number \
+        && header.epoch >= 0 && header.epoch <= epoch_number \
+        && header.n_loss >= 0 && header.n_loss <= header.epoch \
+        && header.optimizer == (int32_t) optimizer \
+        && header.n_opt == (optimizer != OPT_SGD ? 2*n_param : 0) \
+        && fread(wb_ckpt, sizeof(float), n_param, ckpt) == (size_t) n_param \
+        && fread(loss_ckpt, sizeof(float), header.n_loss, ckpt) \
+            == (size_t) header.n_loss \
+        && fread(opt_ckpt, sizeof(float), header.n_opt, ckpt) \
+            == (size_t) header.n_opt)
+    {
+        uint32_t checksum = crc32_TS(wb_ckpt, n_param*sizeof(float));
+        if (header.n_loss > 0)
+        {
+            checksum ^= crc32_TS(loss_ckpt, header.n_loss*sizeof(float));
+        }
+        if (header.n_opt > 0)
+        {
+            checksum ^= crc32_TS(opt_ckpt, header.n_opt*sizeof(float));
+        }
+        // a streamed run (no loss) cannot fill a C_epoch
+        if (checksum == header.checksum \
+            && (C_epoch == NULL || header.n_loss == header.epoch))
+        {
+            status = 0;
+        }
+    }
+    fclose(ckpt);
+    if (status == 0)
+    {
+        memcpy(wb, wb_ckpt, n_param*sizeof(float));
+        if (C_epoch != NULL)
+        {
+            memcpy(C_epoch, loss_ckpt, header.n_loss*sizeof(float));
+        }
+        eta = header.eta;
+        rng_state = header.rng_state;
+        resume_state.epoch = header.epoch;
+        resume_state.epoch_converged = header.epoch_converged;
+        resume_state.C_prev = header.C_prev;
+        if (header.n_opt > 0)
+        {
+            free(opt_state);
+            opt_state = opt_ckpt;
+            opt_ckpt = NULL;
+        }
+    }
+    else
+    {
+        fprintf(stderr, "Warning: invalid %s, starting over\n", ckpt_file);
+    }
+    free(wb_ckpt);
+    free(loss_ckpt);
+    free(opt_ckpt);
+
+    return status;
+}
+
 // ---------------------------------------------
 // auxiliary function to send commands to SQL
 int callback(void *NotUsed, int argc, \
@@ -546,7 +1387,7 @@ xfx_pair *shuffle_TS(xfx_pair *train_set)
     
     for (int i = 0; i < ts_size; i++)
     {
-        rand_slot = rand() % (ts_size);        
+        rand_slot = rng_below(&rng_state, ts_size);
         if (used_slots[rand_slot] == false)
         {
             shuffled_ts[rand_slot].x = train_set[i].x;
@@ -1,64 +1,53 @@
 # -------------------------------------------------------------------
 # analysis.py: analysis and visualization module
+# matplotlib is only imported when a plot is made (see _pyplot)
+# many experiments are loaded in bulk (load_sweep), and long curves
+# are downsampled before they are plotted (lttb)
 
-import matplotlib # type: ignore
-# Set the interactive backend: requires system-wide installation of 
-# sudo apt install python3-tk, out of venv
-matplotlib.use('TkAgg') # TkAgg is often pre-installed and reliable
-
-import matplotlib.pyplot as plt # type: ignore 
 import numpy as np
 import math
 
 import sqlite3
 import config
 import db
+import experiments
+
+#global
+PLOT_POINTS = 2000 # points per plotted curve, see lttb
+PERCENTILES = (5, 25, 50, 75, 95) # loss percentiles across a sweep
 
 # -------------------------------------------------------------------
 def find_min_loss():
     '''
-    find the experiment with minimum loss in table 'loss'
+    find the experiment with minimum loss in table 'summary'
     return exp_id of best experiment 
     '''
-    sql_qry_sel01 = '''
-        SELECT l.exp_id, l.mse
-        FROM loss l
-        WHERE l.mse = (
-            SELECT MIN(mse) 
-            FROM loss);
-    '''
-    with sqlite3.connect(config.FILE_DB) as db:
-        cursor = db.cursor()
-        cursor.execute(sql_qry_sel01)
-        row = cursor.fetchone()
+    # nnfit.db files written before 'summary' existed get it filled
+    db.build_summary()
+    best = db.top_k(1, order_by='min_mse')[0]
     
     print("Best experiment:")
-    print(f"exp_id = {row[0]} MSE = {row[1]}")
+    print(f"exp_id = {best['exp_id']} MSE = {best['min_mse']}")
     
-    return row[0]
+    return best['exp_id']
 
 # -------------------------------------------------------------------
-def plot_loss(best_exp):
+def plot_loss(best_exp, file_plot=None):
     '''
     plot loss vs epoch for experiment 'best_exp' as defined 
-    by lowest MSE in table 'loss'
+    by lowest MSE in table 'loss'; shown in a window, or saved to
+    'file_plot' (e.g. loss.png) without any display
     '''
-    sql_qry_sel01 = '''
-        SELECT l.epoch, l.mse
-        FROM loss l
-        WHERE l.exp_id = ?;
-    '''
-    with sqlite3.connect(config.FILE_DB) as db:
-        cursor = db.cursor()
-        cursor.execute(sql_qry_sel01, (best_exp,))
-        row = cursor.fetchall()
-    
+    plt = _pyplot(file_plot)
     # Create the plot
     # define argument and function
-    epoch = np.array(tuple(i0[0] for i0 in row))
-    loss = np.array(tuple(i1[1] for i1 in row))
+    loss = db.read_loss(best_exp)
+    # the stored epochs: all, or every K of a streamed curve
+    epoch = np.flatnonzero(~np.isnan(loss))
+    # long curves: the PLOT_POINTS points that keep their shape
+    epoch, loss_plot = lttb(epoch, loss[epoch], PLOT_POINTS)
     plt.figure(figsize=(8, 6)) 
-    plt.plot(epoch, loss, label='Loss', color='blue')
+    plt.plot(epoch, loss_plot, label='Loss', color='blue')
     # titles and labels
     plt.title('LOSS')
     plt.xlabel('epoch')
@@ -67,56 +56,34 @@ def plot_loss(best_exp):
     plt.grid(True)
     plt.legend()
     # Display
-    plt.show(block=False)
+    _show(plt, file_plot)
 
-    return row
+    return loss
 
 # -------------------------------------------------------------------
-def plot_function(best_exp):
+def plot_function(best_exp, file_plot=None):
     '''
     use table predictions + the function itself from table ini
-    to plot both analytical function and predictions
+    to plot both analytical function and predictions; shown in a
+    window, or saved to 'file_plot' (e.g. fx.png)
     '''
-    # read function and function parameters
+    plt = _pyplot(file_plot)
+    # read function and function parameters, and predictions, on
+    # one connection
     sql_qry_sel01 = '''
         SELECT i.fx, i.a, i.b, i.c
         FROM ini i
         WHERE i.id = ?;
     '''
-    try:
-        with sqlite3.connect(config.FILE_DB) as db:
-            cursor = db.cursor()
-            cursor.execute(sql_qry_sel01, (best_exp,))
-            row_fx = cursor.fetchall()
-    except Exception as e:
-        print(e)
-    # read predictions 
-    sql_qry_sel02 = '''
-        SELECT p.x, p.fx_pred
-        FROM predictions p
-        WHERE p.exp_id = ?;
-    '''
-    try:
-        with sqlite3.connect(config.FILE_DB) as db:
-            cursor = db.cursor()
-            cursor.execute(sql_qry_sel02, (best_exp,))
-            row_pred = cursor.fetchall()
-    except Exception as e:
-        print(e)
+    with sqlite3.connect(config.FILE_DB) as db_con:
+        row_fx = db_con.execute(sql_qry_sel01, (best_exp,)).fetchall()
+        x, fx_pred = db.read_predictions([best_exp], db_con)
 
     # prepare analytic results
     x_analyt = np.linspace(-1,1,100)
-    if row_fx[0][0] == "A":
-        f_analyt = row_fx[0][1]*(x_analyt - row_fx[0][2])* \
-            (x_analyt - row_fx[0][2]) + row_fx[0][3]
-    elif row_fx[0][0] == "B":
-        f_analyt = row_fx[0][1]*x_analyt + row_fx[0][2]
-    elif row_fx[0][0] == "C":
-        f_analyt = row_fx[0][1]*np.cos(row_fx[0][2]*x_analyt) \
-            + row_fx[0][3]
+    f_analyt = experiments.calculate_fx(x_analyt, *row_fx[0])
     # prepare predictions' results
-    x = np.array(tuple(r[0] for r in row_pred))
-    fx_pred = np.array(tuple(r[1] for r in row_pred))
+    fx_pred = fx_pred[0]
 
     # create plot
     plt.figure(figsize=(8, 6)) 
@@ -132,7 +99,170 @@ def plot_function(best_exp):
     plt.grid(True)
     plt.legend()
     # Display
-    plt.show(block=False)
+    _show(plt, file_plot)
+
+# -------------------------------------------------------------------
+def plot_losses(exp_ids, file_plot=None, q=PERCENTILES):
+    '''
+    plot the loss percentiles q per epoch across experiments exp_ids
+    (e.g. a whole sweep): the median, and bands between the other 
+    percentiles; shown in a window, or saved to 'file_plot'
+    '''
+    plt = _pyplot(file_plot)
+    epoch, loss_q = loss_percentiles(db.read_losses(exp_ids), q)
+    plt.figure(figsize=(8, 6))
+    # bands from the outer percentiles inwards, median on top
+    for i in range(len(q)//2):
+        plt.fill_between(epoch, loss_q[i], loss_q[-1 - i], color='blue',
+            alpha=0.15*(i + 1), label=f'p{q[i]}-p{q[-1 - i]}')
+    if len(q) % 2 == 1:
+        plt.plot(epoch, loss_q[len(q)//2], color='blue',
+                 label=f'p{q[len(q)//2]}')
+    # losses of a sweep span orders of magnitude
+    plt.yscale('log')
+    plt.title(f'LOSS of {len(exp_ids)} experiments')
+    plt.xlabel('epoch')
+    plt.ylabel('loss')
+    plt.grid(True)
+    plt.legend()
+    _show(plt, file_plot)
+
+    return epoch, loss_q
+
+# -------------------------------------------------------------------
+def load_sweep(exp_ids):
+    '''
+    loads many experiments at once, on one connection and with one 
+    query per table (see db.read_losses)
+
+    :param exp_ids: experiment ids, e.g. db.sweep_exp_ids(sweep)
+    :return dict:
+        "exp_ids": int array
+        "loss": list of float32 curves indexed by epoch (lengths 
+            differ: runs stop when they converge; NaN at epochs 
+            without a stored loss, see db.read_loss)
+        "wb": (len(exp_ids), max 3H+1) float32 array of the optimal
+            weights and biases, NaN padded (no result, smaller H)
+        "x", "fx_pred": test grid and (len(exp_ids), len(x)) 
+            predictions (see db.read_predictions)
+    '''
+    with sqlite3.connect(config.FILE_DB) as db_con:
+        curves = db.read_losses(exp_ids, db_con)
+        wbs = db.read_optimal_wbs(exp_ids, db_con)
+        x, fx_pred = db.read_predictions(exp_ids, db_con)
+    n_param = max((len(wb) for wb in wbs if wb is not None), default=0)
+    wb = np.full((len(wbs), n_param), np.nan, dtype=np.float32)
+    for i, wb_exp in enumerate(wbs):
+        if wb_exp is not None:
+            wb[i, :len(wb_exp)] = wb_exp
+
+    return {"exp_ids": np.asarray(exp_ids), "loss": curves, "wb": wb, 
+            "x": x, "fx_pred": fx_pred}
+
+# -------------------------------------------------------------------
+def resample(curves, num_points=PLOT_POINTS):
+    '''
+    curves of different lengths on one grid of at most num_points
+    epochs, evenly spaced up to the longest curve. Curves with
+    epochs not stored (NaN, e.g. streamed every K epochs) are 
+    interpolated between the stored ones
+
+    :return epoch: int array, the grid
+    :return matrix: (len(curves), len(epoch)) float array, NaN past
+        the end of a curve
+    '''
+    length = max((len(curve) for curve in curves), default=0)
+    epoch = np.unique(np.linspace(0, max(0, length - 1), 
+                                  min(num_points, length)).astype(int))
+    matrix = np.full((len(curves), len(epoch)), np.nan)
+    for i, curve in enumerate(curves):
+        stored = np.flatnonzero(~np.isnan(curve))
+        if 0 < len(stored) < len(curve):
+            n = np.searchsorted(epoch, stored[-1] + 1)
+            matrix[i, :n] = np.interp(epoch[:n], stored, curve[stored])
+        else:
+            n = np.searchsorted(epoch, len(curve))
+            matrix[i, :n] = curve[epoch[:n]]
+
+    return epoch, matrix
+
+# -------------------------------------------------------------------
+def loss_percentiles(curves, q=PERCENTILES, num_points=PLOT_POINTS):
+    '''
+    percentiles q of the loss at each epoch across curves, computed
+    at once on their resample grid; curves that stopped earlier 
+    (converged) are left out of the later epochs
+
+    :return epoch: int array of at most num_points epochs
+    :return loss_q: (len(q), len(epoch)) array
+    '''
+    epoch, matrix = resample(curves, num_points)
+    if len(epoch) == 0:
+        return epoch, np.empty((len(q), 0))
+
+    return epoch, np.nanpercentile(matrix, q, axis=0)
+
+# -------------------------------------------------------------------
+def lttb(x, y, num_points=PLOT_POINTS):
+    '''
+    Largest-Triangle-Three-Buckets downsampling: keeps the first and 
+    last points, and from each of num_points - 2 buckets in between 
+    the point forming the largest triangle with the point kept before
+    it and the mean of the next bucket. Peaks and steps survive, 
+    unlike with a stride. Curves with at most num_points points are 
+    returned as they are
+
+    :return x, y: numpy arrays of num_points points
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    if n <= num_points or num_points < 3:
+        return x, y
+    xf = x.astype(np.float64)
+    yf = y.astype(np.float64)
+    # bucket i holds points edges[i]...edges[i+1]-1
+    edges = np.linspace(1, n - 1, num_points - 1).astype(int)
+    keep = np.empty(num_points, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(num_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            x_next = xf[hi:edges[i + 2]].mean()
+            y_next = yf[hi:edges[i + 2]].mean()
+        else:
+            x_next, y_next = xf[n - 1], yf[n - 1]
+        # twice the triangle areas, for all points of the bucket
+        area = np.abs((xf[a] - x_next)*(yf[lo:hi] - yf[a]) 
+                      - (xf[a] - xf[lo:hi])*(y_next - yf[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return x[keep], y[keep]
+
+# -------------------------------------------------------------------
+def _pyplot(file_plot):
+    # imported on first use, so that runs without plots never load
+    # matplotlib; files are drawn with the non-interactive Agg backend
+    import matplotlib # type: ignore
+    if file_plot is not None:
+        matplotlib.use('Agg')
+    else:
+        # Set the interactive backend: requires system-wide installation 
+        # of sudo apt install python3-tk, out of venv
+        matplotlib.use('TkAgg') # TkAgg is often pre-installed and reliable
+    import matplotlib.pyplot as plt # type: ignore 
+
+    return plt
+
+def _show(plt, file_plot):
+    if file_plot is None:
+        plt.show(block=False)
+    else:
+        plt.savefig(file_plot)
+        plt.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,512 @@
+# -------------------------------------------------------------------
+# bench.py: benchmark module
+# throughput of the engine, the orchestrator pipeline, the db
+# functions, the predictions and the analysis of a sweep, and time
+# to convergence of each optimizer; results are kept in a history db
+# and compared against a saved baseline to flag regressions
+#
+# usage: python3 bench.py [--suite engine pipeline db predict analysis
+#            optimizer] [--quick] [--save-baseline] [--note text]
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import cengine
+import config
+import db
+import analysis
+import experiments
+import main
+import runner
+
+#global
+SUITES = ['engine', 'pipeline', 'db', 'predict', 'analysis', 'optimizer']
+TOLERANCE = 0.10 # relative drop from the baseline flagged as regression
+LOWER_IS_BETTER = {'epochs', 'ms'} # units of costs; all others are rates
+REPEATS = 3 # best of REPEATS timings is kept
+# engine grid: samples per cell, so that every cell takes similar time
+ENGINE_TS_SIZES = [1000, 10000, 100000]
+ENGINE_MB_SIZES = [8, 32, 256]
+ENGINE_SAMPLES = 2000000
+PIPELINE_EXPS = 30 # experiments per pipeline sweep
+PIPELINE_BACKENDS = ['worker', 'process', 'numpy', 'library']
+DB_EXPS = 200 # experiments per db benchmark
+DB_EPOCHS = 100 # loss curve length
+PREDICT_EXPS = [1, 100, 1000] # experiments predicted at once
+ANALYSIS_EXPS = 300 # experiments of the analysed sweep
+ANALYSIS_EPOCHS = 100000 # loss curve length
+# optimizer runs: same TS, initial wb and shuffles for all, each
+# optimizer with an eta of its own scale (momentum: eta/(1 - beta1)
+# as SGD's); epochs to reach the delta
+OPTIMIZER_ETAS = {'sgd': 0.1, 'momentum': 0.01, 'nesterov': 0.01, 
+                  'adam': 0.01}
+OPTIMIZER_HIDDEN = 16
+OPTIMIZER_DELTA = 2e-4
+OPTIMIZER_EPOCHS = 2000 # reported when the delta is not reached
+QUICK_SCALE = 10 # --quick divides work by QUICK_SCALE
+
+# -------------------------------------------------------------------
+def create_tables(file_bench=None):
+    '''
+    creates the history tables of the benchmark db
+    (default config.FILE_BENCH_DB):
+        - bench_runs: one row per run: time, git revision, host, note
+            and whether it is a baseline
+        - bench_results: one row per measure of a run: suite, name,
+            params (JSON), value and unit (rates, higher is better, 
+            or costs in LOWER_IS_BETTER units)
+    '''
+    with sqlite3.connect(file_bench or config.FILE_BENCH_DB) as bench_db:
+        bench_db.executescript("""
+            CREATE TABLE IF NOT EXISTS bench_runs (
+                id INTEGER PRIMARY KEY,
+                started TEXT, git_rev TEXT, host TEXT, note TEXT,
+                baseline INTEGER DEFAULT 0
+                );
+            CREATE TABLE IF NOT EXISTS bench_results (
+                id INTEGER PRIMARY KEY,
+                run_id INTEGER,
+                suite TEXT, name TEXT, params TEXT,
+                value REAL, unit TEXT,
+                FOREIGN KEY(run_id) REFERENCES bench_runs(id)
+                );
+            CREATE INDEX IF NOT EXISTS idx_bench_run
+                ON bench_results(run_id);
+        """)
+
+# -------------------------------------------------------------------
+def save_run(results, note=None, baseline=False, file_bench=None):
+    '''
+    stores the results of one run in the history
+    :param results: list of dicts (suite, name, params, value, unit)
+    :param baseline: mark the run as the new baseline
+    :return run_id
+    '''
+    create_tables(file_bench)
+    with sqlite3.connect(file_bench or config.FILE_BENCH_DB) as bench_db:
+        cursor = bench_db.cursor()
+        cursor.execute("""
+            INSERT INTO bench_runs (started, git_rev, host, note, baseline)
+            VALUES (?, ?, ?, ?, ?);
+        """, (time.strftime("%Y-%m-%d %H:%M:%S"), _git_rev(),
+              platform.node(), note, int(baseline)))
+        run_id = cursor.lastrowid
+        cursor.executemany("""
+            INSERT INTO bench_results (run_id, suite, name, params, value, unit)
+            VALUES (?, ?, ?, ?, ?, ?);
+        """, ((run_id, r["suite"], r["name"], json.dumps(r["params"],
+              sort_keys=True), r["value"], r["unit"]) for r in results))
+        bench_db.commit()
+
+    return run_id
+
+# -------------------------------------------------------------------
+def read_run(run_id, file_bench=None):
+    '''
+    results of run 'run_id' as {(suite, name, params): value}
+    '''
+    with sqlite3.connect(file_bench or config.FILE_BENCH_DB) as bench_db:
+        rows = bench_db.execute("""
+            SELECT suite, name, params, value FROM bench_results
+            WHERE run_id = ?;
+        """, (run_id,)).fetchall()
+
+    return {(suite, name, params): value for suite, name, params, value
+            in rows}
+
+# -------------------------------------------------------------------
+def baseline_run(file_bench=None):
+    '''
+    id of the last run saved as baseline, None if there is none
+    '''
+    create_tables(file_bench)
+    with sqlite3.connect(file_bench or config.FILE_BENCH_DB) as bench_db:
+        row = bench_db.execute("""
+            SELECT MAX(id) FROM bench_runs WHERE baseline = 1;
+        """).fetchone()
+
+    return row[0]
+
+# -------------------------------------------------------------------
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''
+    compares the results of a run with a baseline run
+    :param results: list of dicts, as from run
+    :param baseline: {(suite, name, params): value}, as from read_run
+    :return list of dicts: the results plus "baseline", "change"
+        (relative speed-up, None without baseline) and "flag": 
+        'REGRESSION' below 1 - tolerance, 'faster' above 1 + tolerance,
+        else ''
+    '''
+    report = []
+    for r in results:
+        key = (r["suite"], r["name"], json.dumps(r["params"], sort_keys=True))
+        base = baseline.get(key)
+        change = None
+        if base and r["unit"] in LOWER_IS_BETTER:
+            change = base/r["value"] - 1 if r["value"] else None
+        elif base:
+            change = r["value"]/base - 1
+        flag = ''
+        if change is not None and change < -tolerance:
+            flag = 'REGRESSION'
+        elif change is not None and change > tolerance:
+            flag = 'faster'
+        report.append(dict(r, baseline=base, change=change, flag=flag))
+
+    return report
+
+# -------------------------------------------------------------------
+def print_report(report):
+    '''
+    one line per measure: value, baseline and change
+    '''
+    print(f"{'measure':<44} {'value':>14} {'baseline':>14} {'change':>8}")
+    for r in report:
+        params = " ".join(f"{k}={v}" for k, v in r["params"].items())
+        name = f"{r['suite']}.{r['name']} {params}"
+        base = f"{r['baseline']:14.1f}" if r["baseline"] else f"{'-':>14}"
+        change = f"{100*r['change']:+7.1f}%" if r["change"] is not None \
+            else f"{'-':>8}"
+        print(f"{name:<44} {r['value']:14.1f} {base} {change} "
+              f"{r['unit']} {r['flag']}")
+
+# -------------------------------------------------------------------
+def run(suites=SUITES, quick=False):
+    '''
+    runs the benchmark suites
+    :param suites: any of SUITES
+    :param quick: QUICK_SCALE times less work (noisier)
+    :return list of dicts (suite, name, params, value, unit)
+    '''
+    scale = QUICK_SCALE if quick else 1
+    runner.compile_c(config.C_ENGINE_DIR)
+    results = []
+    if 'engine' in suites:
+        results.extend(bench_engine(ENGINE_SAMPLES//scale))
+    if 'pipeline' in suites:
+        results.extend(bench_pipeline(max(2, PIPELINE_EXPS//scale)))
+    if 'db' in suites:
+        results.extend(bench_db(max(2, DB_EXPS//scale)))
+    if 'predict' in suites:
+        results.extend(bench_predict(PREDICT_EXPS))
+    if 'analysis' in suites:
+        results.extend(bench_analysis(ANALYSIS_EXPS, 
+                                      ANALYSIS_EPOCHS//scale))
+    if 'optimizer' in suites:
+        results.extend(bench_optimizer(OPTIMIZER_EPOCHS))
+
+    return results
+
+# -------------------------------------------------------------------
+def bench_engine(samples):
+    '''
+    training kernel (libnnfit.so, in process): samples/sec and
+    epochs/sec over the grid ENGINE_TS_SIZES x ENGINE_MB_SIZES,
+    'samples' trained per cell, on a synthetic TS (fx A)
+    '''
+    results = []
+    rng = np.random.default_rng(0)
+    wb_0 = np.array([0.1, -0.2, 0.05, -0.1, 0.1, -0.01, 0.01, -0.05,
+                     0.22, 0], dtype=np.float32)
+    for ts_size in ENGINE_TS_SIZES:
+        x = rng.uniform(-config.X_EXTREME, config.X_EXTREME, ts_size)
+        xfx = cengine.as_xfx((x, experiments.calculate_fx(x, "A", 0.7,
+                                                          0.5, 1.0)))
+        for mb in ENGINE_MB_SIZES:
+            if mb > ts_size:
+                continue
+            epochs = max(1, samples//ts_size)
+            def train():
+                # delta = 0: all epochs run
+                cengine.train_arrays(xfx, wb_0.copy(), mb, 0.05, epochs,
+                                     0, seed=1)
+            seconds = _best_time(train)
+            trained = epochs*(ts_size//mb)*mb
+            params = {"ts_size": ts_size, "mb": mb}
+            results.append(_result('engine', 'samples', params,
+                                   trained/seconds, 'samples/s'))
+            results.append(_result('engine', 'epochs', params,
+                                   epochs/seconds, 'epochs/s'))
+
+    return results
+
+# -------------------------------------------------------------------
+def bench_pipeline(num_of_exps):
+    '''
+    the sweep of main.main, end to end, for each backend: running
+    'num_of_exps' experiments, storing their results, predicting and
+    storing the test results; experiments/sec. The initialization
+    run (TS generation) is done once, in a scratch data directory
+    '''
+    results = []
+    with _scratch_data():
+        db.create_tables()
+        main.new_sweep()
+        ini_data = config.read(config.FILE_CONFIG)
+        points = experiments.generate_wb_points(num_of_exps,
+            config.W_EXTREME, config.bl1_EXTREME)
+        for backend in PIPELINE_BACKENDS:
+            def sweep():
+                sweep, exp_ids = db.save_pending(points)
+                # repeats of the same points would be cache hits
+                all_stdout = runner.run_sweep(points, backend, 
+                                              use_cache=False)
+                with db.ResultWriter(background=True) as writer:
+                    for exp_id, stdout in zip(exp_ids, all_stdout):
+                        writer.save_result(exp_id, stdout)
+                opt_wbs = [db.read_optimal_wb(exp_id) for exp_id in exp_ids]
+                x_grid = experiments.test_grid(config.TEST_SIZE)
+                fx_pred, mse = experiments.evaluate(opt_wbs, x_grid,
+                    ini_data['fx'], ini_data['a'], ini_data['b'],
+                    ini_data['c'])
+                with db.ResultWriter() as writer:
+                    writer.save_test_grid(x_grid)
+                    writer.save_test_results(exp_ids, x_grid, fx_pred, mse)
+            seconds = _best_time(sweep)
+            results.append(_result('pipeline', 'sweep',
+                {"backend": backend, "exps": num_of_exps},
+                num_of_exps/seconds, 'exps/s'))
+
+    return results
+
+# -------------------------------------------------------------------
+def bench_db(num_of_exps):
+    '''
+    insert and query throughput of the db functions, on a scratch
+    db holding 'num_of_exps' synthetic experiments of DB_EPOCHS epochs
+    '''
+    results = []
+    with _scratch_data():
+        db.create_tables()
+        rng = np.random.default_rng(0)
+        ini_data = config.read(config.FILE_CONFIG_1ST)
+        ini_data['new_ts'] = 'N'
+        all_stdout = [_synthetic_stdout(rng, ini_data["hidden"], DB_EPOCHS)
+                      for _ in range(num_of_exps)]
+        x_grid = experiments.test_grid(config.TEST_SIZE)
+        exp_ids = []
+
+        def rate(name, fn, count, unit='ops/s'):
+            results.append(_result('db', name, {"exps": num_of_exps},
+                                   count/_best_time(fn), unit))
+
+        # inserts, one connection per call
+        def save_experiment():
+            exp_ids[:] = [db.save_experiment(ini_data)
+                          for _ in range(num_of_exps)]
+        rate('save_experiment', save_experiment, num_of_exps)
+        rate('save_optimal_wb', lambda: [db.save_optimal_wb(stdout, exp_id)
+            for exp_id, stdout in zip(exp_ids, all_stdout)], num_of_exps)
+        rate('save_loss', lambda: [db.save_loss(stdout, exp_id)
+            for exp_id, stdout in zip(exp_ids, all_stdout)], num_of_exps)
+        predictions = [{float(x): float(x)} for x in x_grid]
+        rate('save_predictions', lambda: [db.save_predictions(predictions,
+            exp_id) for exp_id in exp_ids], num_of_exps*len(x_grid),
+            'rows/s')
+        # inserts through one writer
+        def writer_save(background):
+            with db.ResultWriter(background=background) as writer:
+                for stdout in all_stdout:
+                    writer.save(ini_data, stdout)
+        rate('ResultWriter.save', lambda: writer_save(False), num_of_exps)
+        rate('ResultWriter.save background', lambda: writer_save(True),
+             num_of_exps)
+        def loss_stream():
+            with db.LossStream(ini_data) as stream:
+                for epoch in range(num_of_exps*DB_EPOCHS):
+                    stream.append(epoch, 0.01)
+        rate('LossStream.append', loss_stream, num_of_exps*DB_EPOCHS,
+             'rows/s')
+        fx_pred = rng.standard_normal((num_of_exps, len(x_grid)))
+        rate('save_test_results', lambda: db.save_test_results(exp_ids,
+            x_grid, fx_pred, fx_pred[:, 0]**2), num_of_exps*len(x_grid),
+            'rows/s')
+        # queries
+        rate('read_loss', lambda: [db.read_loss(exp_id)
+            for exp_id in exp_ids], num_of_exps)
+        rate('read_optimal_wb', lambda: [db.read_optimal_wb(exp_id)
+            for exp_id in exp_ids], num_of_exps)
+        rate('top_k', lambda: [db.top_k(10) for _ in range(100)], 100)
+        rate('leaderboard', lambda: [db.leaderboard(5) for _ in range(100)],
+             100)
+
+    return results
+
+# -------------------------------------------------------------------
+def bench_predict(exps_list):
+    '''
+    predictions/sec of experiments.evaluate (all experiments at once
+    on the test grid) and of experiments.predictions (one experiment)
+    '''
+    results = []
+    rng = np.random.default_rng(0)
+    x_grid = experiments.test_grid(config.TEST_SIZE)
+    for num_of_exps in exps_list:
+        opt_wb = rng.uniform(-1, 1, (num_of_exps, 3*config.HIDDEN + 1))
+        seconds = _best_time(lambda: [experiments.evaluate(opt_wb, x_grid,
+            "A", 0.7, 0.5, 1.0) for _ in range(10)])/10
+        results.append(_result('predict', 'evaluate', {"exps": num_of_exps},
+            num_of_exps*len(x_grid)/seconds, 'preds/s'))
+    opt_wb = [0] + list(rng.uniform(-1, 1, 3*config.HIDDEN + 1))
+    seconds = _best_time(lambda: [experiments.predictions(opt_wb,
+        config.TEST_SIZE, 0) for _ in range(100)])/100
+    results.append(_result('predict', 'predictions', {"exps": 1},
+        config.TEST_SIZE/seconds, 'preds/s'))
+
+    return results
+
+# -------------------------------------------------------------------
+def bench_analysis(num_of_exps, epochs):
+    '''
+    analysis of a sweep of 'num_of_exps' experiments with loss curves
+    of 'epochs' epochs, on a scratch db: curves/sec loaded in bulk 
+    (analysis.load_sweep) and one by one (db.read_loss), and 
+    epochs/sec of analysis.loss_percentiles and analysis.lttb
+    '''
+    results = []
+    params = {"exps": num_of_exps, "epochs": epochs}
+    with _scratch_data():
+        db.create_tables()
+        rng = np.random.default_rng(0)
+        curves = [np.sort(rng.uniform(0, 0.1, epochs))[::-1].astype(
+            np.float32) for _ in range(num_of_exps)]
+        exp_ids = list(range(1, num_of_exps + 1))
+        with db.connect() as db_con:
+            for exp_id, curve in zip(exp_ids, curves):
+                db._insert_curve(db_con.cursor(), exp_id, curve)
+
+        def rate(name, fn, count, unit):
+            results.append(_result('analysis', name, params,
+                                   count/_best_time(fn), unit))
+
+        rate('load_sweep', lambda: analysis.load_sweep(exp_ids),
+             num_of_exps, 'curves/s')
+        rate('read_loss', lambda: [db.read_loss(exp_id) 
+             for exp_id in exp_ids], num_of_exps, 'curves/s')
+        rate('loss_percentiles', lambda: analysis.loss_percentiles(curves),
+             num_of_exps*epochs, 'epochs/s')
+        rate('lttb', lambda: analysis.lttb(np.arange(epochs), curves[0]),
+             epochs, 'epochs/s')
+
+    return results
+
+# -------------------------------------------------------------------
+def bench_optimizer(epoch_num):
+    '''
+    time to convergence of each optimizer (libnnfit.so, in process):
+    epochs and wall time until the loss drops below OPTIMIZER_DELTA,
+    from the same initial wb, TS (fx A) and shuffle seed; epoch_num
+    if it is never reached. Lower is better
+    '''
+    results = []
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-config.X_EXTREME, config.X_EXTREME, 1000)
+    xfx = cengine.as_xfx((x, experiments.calculate_fx(x, "A", 0.7, 0.5, 
+                                                      1.0)))
+    wb_0 = rng.uniform(-config.W_EXTREME, config.W_EXTREME,
+                       3*OPTIMIZER_HIDDEN + 1).astype(np.float32)
+    wb_0[-1] = 0
+    for optimizer, eta in OPTIMIZER_ETAS.items():
+        epochs = 0
+        def train():
+            nonlocal epochs
+            _, _, epochs = cengine.train_arrays(xfx, wb_0.copy(), 8, eta,
+                epoch_num, OPTIMIZER_DELTA, seed=1, optimizer=optimizer)
+        seconds = _best_time(train)
+        params = {"optimizer": optimizer}
+        results.append(_result('optimizer', 'epochs', params, epochs, 
+                               'epochs'))
+        results.append(_result('optimizer', 'time', params, 1e3*seconds, 
+                               'ms'))
+
+    return results
+
+# -------------------------------------------------------------------
+def _result(suite, name, params, value, unit):
+    return {"suite": suite, "name": name, "params": params,
+            "value": value, "unit": unit}
+
+def _best_time(fn, repeats=REPEATS):
+    # shortest of 'repeats' runs: the least disturbed one
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def _synthetic_stdout(rng, hidden, epochs):
+    # a stdout dict as from runner.run_c
+    return {
+        "weights": {
+            "w_layer_1": rng.uniform(-1, 1, hidden).tolist(),
+            "b_layer_1": rng.uniform(-1, 1, hidden).tolist(),
+            "w_layer_2": rng.uniform(-1, 1, hidden).tolist(),
+            "b_layer_2": float(rng.uniform(-1, 1))
+        },
+        "eta": 0.1,
+        "loss": {str(epoch): float(loss) for epoch, loss in
+                 enumerate(np.sort(rng.uniform(0, 0.1, epochs))[::-1])},
+        "wall_time": 0.01
+    }
+
+@contextlib.contextmanager
+def _scratch_data():
+    # db, TS file, config.ini and checkpoints in a temporary directory,
+    # so that benchmarks never touch data/
+    keys = ['FILE_DB', 'FILE_TS', 'FILE_CONFIG', 'CHECKPOINT_DIR']
+    saved = {key: getattr(config, key) for key in keys}
+    with tempfile.TemporaryDirectory(prefix="nnfit_bench_") as work_dir:
+        config.FILE_DB = os.path.join(work_dir, "nnfit.db")
+        config.FILE_TS = os.path.join(work_dir, "xfx.bin")
+        config.FILE_CONFIG = os.path.join(work_dir, "config.ini")
+        config.CHECKPOINT_DIR = os.path.join(work_dir, "checkpoints")
+        try:
+            yield work_dir
+        finally:
+            for key, value in saved.items():
+                setattr(config, key, value)
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=config.BASE_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="nnfit benchmarks")
+    parser.add_argument("--suite", nargs="+", choices=SUITES, default=SUITES,
+        help="suites to run (default all)")
+    parser.add_argument("--quick", action="store_true",
+        help=f"{QUICK_SCALE} times less work")
+    parser.add_argument("--save-baseline", action="store_true",
+        help="store this run as the new baseline")
+    parser.add_argument("--note", help="note stored with the run")
+    args = parser.parse_args()
+
+    results = run(args.suite, args.quick)
+    base_id = baseline_run()
+    baseline = read_run(base_id) if base_id is not None else {}
+    report = compare(results, baseline)
+    run_id = save_run(results, args.note, args.save_baseline)
+    print(f"\nrun {run_id}, baseline: {base_id}")
+    print_report(report)
+    regressions = sum(r["flag"] == 'REGRESSION' for r in report)
+    if regressions:
+        print(f"\n{regressions} regressions (more than "
+              f"{100*TOLERANCE:.0f}% slower than the baseline)")
+        raise SystemExit(1)
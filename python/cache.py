@@ -0,0 +1,147 @@
+# -------------------------------------------------------------------
+# cache.py: result cache module
+# results of past runs in table 'cache', by a hash of the experiment
+# and of its training set: identical experiments are not run again
+
+import hashlib
+import json
+import sys
+import time
+import zlib
+
+import numpy as np
+
+import config
+import db
+
+#global
+CACHE_VERSION = 5 # bump when the engine's results change for same input
+# ini keys that do not change a run's result: the TS is in the key
+# through its fingerprint
+IGNORED_KEYS = {'new_ts', 'ts_id', 'ts_seed'}
+
+# -------------------------------------------------------------------
+def ts_fingerprint(ts_id=None):
+    '''
+    identity of training set ts_id (default the last one): the header
+    of its binary TS file (size, function, parameters, CRC-32 of the
+    records, ts_id and seed), else the CRC-32 of its rows of table 'xfx'
+    '''
+    try:
+        header, records = db.read_ts_file(ts_id)
+    except (OSError, ValueError):
+        x, fx = db.read_ts_db(ts_id)
+        header = {"ts_size": len(x),
+                  "checksum": zlib.crc32(fx.tobytes(), zlib.crc32(x.tobytes()))}
+
+    return json.dumps(header, sort_keys=True)
+
+# -------------------------------------------------------------------
+def experiment_key(ini_data, fingerprint, backend=None):
+    '''
+    stable hash of an experiment: all its ini keys, its training set
+    and the engine that runs it. Floats are rounded to float32, as
+    read by the engine, so 0.1 and 0.10000000149 are the same key.
+
+    :param ini_data: ini_data dictionary
+    :param fingerprint: see ts_fingerprint
+    :param backend: see runner.run_sweep; 'numpy' results are kept
+        apart from the C engine's ('process', 'worker', 'library'),
+        and these by the engine settings that change a result: 
+        threads of the gradient sums (ENGINE_THREADS) and chunks of 
+        an out-of-core TS (ENGINE_CHUNK, engine processes only). The
+        C backends share results: they train on the same values (the
+        ini floats are written exactly, see scheduler.check)
+    '''
+    backend = backend or config.BACKEND
+    definition = {key: _canonical(value) for key, value in ini_data.items()
+                  if key not in IGNORED_KEYS}
+    engine = 'numpy' if backend == 'numpy' else {
+        "threads": config.ENGINE_THREADS,
+        "chunk": config.ENGINE_CHUNK if backend in ('process', 'worker') 
+                 else 0}
+    text = json.dumps({"version": CACHE_VERSION, "ts": fingerprint,
+                       "engine": engine, "ini": definition}, sort_keys=True)
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# -------------------------------------------------------------------
+def run_sweep(ini_data_all_points, run, backend=None, checkpoints=None):
+    '''
+    yields the stdout dicts of all experiments in order: from table
+    'cache' when an identical experiment ran before (with "cached":
+    True), else by running the missing ones with 'run'. New results
+    are stored, and the cache is then cut to config.CACHE_MAX_ENTRIES
+    and config.CACHE_MAX_BYTES, least recently used first.
+
+    :param ini_data_all_points: list of ini_data dictionaries
+    :param run: function(ini_data_points, checkpoints) that yields
+        their stdout dicts in order (see runner.run_sweep)
+    :param backend: see experiment_key
+    :param checkpoints: checkpoint file per experiment, or None
+    '''
+    start = time.perf_counter()
+    # experiments may train on different training sets
+    last = db.resolve_ts_id()
+    ts_ids = [ini_data.get("ts_id") or last 
+              for ini_data in ini_data_all_points]
+    fingerprints = {ts_id: ts_fingerprint(ts_id) for ts_id in set(ts_ids)}
+    keys = [experiment_key(ini_data, fingerprints[ts_id], backend)
+            for ini_data, ts_id in zip(ini_data_all_points, ts_ids)]
+    found = db.read_cache(keys)
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    # lookup time, shared by the hits
+    lookup = (time.perf_counter() - start)/max(1, len(found))
+
+    new_entries = []
+    try:
+        results = iter(())
+        if missing:
+            results = run([ini_data_all_points[i] for i in missing],
+                          None if checkpoints is None
+                          else [checkpoints[i] for i in missing])
+        for i, key in enumerate(keys):
+            if key in found:
+                stdout = found[key]
+                stdout["cached"] = True
+                if config.TIMINGS:
+                    stdout["timings"] = {"cache": lookup}
+            else:
+                stdout = next(results)
+                new_entries.append((key, {k: v for k, v in stdout.items()
+                                          if k != "timings"}))
+            yield stdout
+    finally:
+        # also what was run before an interruption
+        if new_entries:
+            db.write_cache(new_entries)
+            db.evict_cache(config.CACHE_MAX_ENTRIES, config.CACHE_MAX_BYTES)
+
+# -------------------------------------------------------------------
+def _canonical(value):
+    # floats as the engine reads them (float32), text as is
+    if isinstance(value, (float, np.floating)):
+        return repr(float(np.float32(value)))
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return str(value)
+
+# -------------------------------------------------------------------
+def main(argv):
+    '''
+    python3 cache.py stats | clear [path/to/nnfit.db]
+    '''
+    if len(argv) < 2 or argv[1] not in ('stats', 'clear'):
+        print(main.__doc__.strip())
+        return
+    file_db = argv[2] if len(argv) > 2 else None
+    db.create_tables(file_db)
+    if argv[1] == 'clear':
+        db.evict_cache(0, 0, file_db)
+    stats = db.cache_stats(file_db)
+    print(f"cache: {stats['entries']} results, {stats['bytes']/2**20:.1f} MiB, "
+          f"{stats['hits']} hits")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
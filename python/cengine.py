@@ -0,0 +1,169 @@
+# -------------------------------------------------------------------
+# cengine.py: in-process c_engine module
+# trains through the engine's shared library (libnnfit.so, see 
+# c_engine/nnfit_api.h) with ctypes, on NumPy buffers the engine reads
+# and writes in place: no process, no config file, no copy of the TS
+
+import ctypes
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import config
+
+#global
+NNFIT_EINVAL = -1 # nnfit_api.h return codes
+NNFIT_ENOMEM = -2
+
+class Params(ctypes.Structure):
+    '''
+    nnfit_params of nnfit_api.h
+    '''
+    _fields_ = [("mb_size", ctypes.c_int),
+                ("eta", ctypes.c_double),
+                ("epoch_num", ctypes.c_int),
+                ("delta", ctypes.c_double),
+                ("n_hidden", ctypes.c_int),
+                ("threads", ctypes.c_int),
+                ("seed", ctypes.c_uint),
+                ("optimizer", ctypes.c_int),
+                ("beta1", ctypes.c_float),
+                ("beta2", ctypes.c_float)]
+
+_lib = None # loaded once, on first use
+
+# -------------------------------------------------------------------
+def load(file_lib=None):
+    '''
+    load the shared library 'file_lib' (default config.FILE_C_LIBRARY,
+    built by runner.compile_c) and declare its functions
+    '''
+    global _lib
+    if _lib is None:
+        lib = ctypes.CDLL(file_lib or config.FILE_C_LIBRARY)
+        float_p = ctypes.POINTER(ctypes.c_float)
+        lib.nnfit_n_param.argtypes = [ctypes.c_int]
+        lib.nnfit_n_param.restype = ctypes.c_int
+        lib.nnfit_train.argtypes = [float_p, ctypes.c_int, 
+            ctypes.POINTER(Params), float_p, float_p, 
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_int)]
+        lib.nnfit_train.restype = ctypes.c_int
+        _lib = lib
+
+    return _lib
+
+# -------------------------------------------------------------------
+def as_xfx(ts):
+    '''
+    the training set as the engine reads it, without copying when 
+    possible: a C-contiguous float32 array of (x, fx) pairs. 'ts' is 
+    the records of db.read_ts_file (np.memmap, no copy), an 
+    (n, 2) float32 array (no copy), or a pair of arrays x, fx
+    '''
+    if isinstance(ts, tuple):
+        x, fx = ts
+        xfx = np.empty((len(x), 2), dtype=np.float32)
+        xfx[:, 0] = x
+        xfx[:, 1] = fx
+        return xfx
+    if ts.dtype.names is not None:
+        ts = ts.view(np.float32).reshape(-1, 2)
+
+    return np.ascontiguousarray(ts, dtype=np.float32)
+
+# -------------------------------------------------------------------
+def train_arrays(xfx, wb, mb, eta, epoch_num, delta, threads=1, seed=0,
+                 optimizer='sgd', beta1=config.BETA1, beta2=config.BETA2):
+    '''
+    train one network in this process; 'wb' is updated in place.
+    The call releases the GIL: trainings in different threads run
+    in parallel.
+
+    :param xfx: training set, see as_xfx
+    :param wb: float32 array of the 3H+1 initial weights and biases,
+        in the flat layout of config.wb_keys(H); must be contiguous
+    :param mb, eta, epoch_num, delta: as in ini_data
+    :param threads: threads for the minibatch gradient (-t)
+    :param seed: TS shuffle seed, 0 = from the clock
+    :param optimizer, beta1, beta2: as in ini_data, see config.OPTIMIZERS
+    :return loss: float32 array, loss of the epochs to report
+    :return eta: eta after its auto-adjustments
+    :return epochs_trained: epochs trained, epoch_num or fewer if it
+        converged
+    '''
+    lib = load()
+    xfx = as_xfx(xfx)
+    if wb.dtype != np.float32 or not wb.flags.c_contiguous:
+        raise ValueError("cengine: wb must be a contiguous float32 array")
+    hidden = (len(wb) - 1)//3
+    if lib.nnfit_n_param(hidden) != len(wb):
+        raise ValueError(f"cengine: {len(wb)} weights and biases is not 3H+1")
+    loss = np.zeros(epoch_num, dtype=np.float32)
+    eta_out = ctypes.c_double(0)
+    epochs_out = ctypes.c_int(0)
+    params = Params(mb, eta, epoch_num, delta, hidden, threads, seed,
+                    config.OPTIMIZERS.index(optimizer), beta1, beta2)
+    float_p = ctypes.POINTER(ctypes.c_float)
+    epochs = lib.nnfit_train(xfx.ctypes.data_as(float_p), len(xfx), 
+        ctypes.byref(params), wb.ctypes.data_as(float_p), 
+        loss.ctypes.data_as(float_p), ctypes.byref(eta_out), 
+        ctypes.byref(epochs_out))
+    if epochs == NNFIT_EINVAL:
+        raise ValueError(f"cengine: invalid parameters: mb {mb}, " 
+            f"epoch_num {epoch_num}, hidden {hidden}, threads {threads}, "
+            f"ts_size {len(xfx)}, betas {beta1} {beta2}")
+    if epochs == NNFIT_ENOMEM:
+        raise MemoryError("cengine: out of memory")
+
+    return loss[:epochs], eta_out.value, epochs_out.value
+
+# -------------------------------------------------------------------
+def train(ini_data, xfx, threads=None):
+    '''
+    train the experiment 'ini_data' in this process, shuffling with
+    its seed (ini_data "seed")
+    return a stdout dict, as returned by runner.run_c
+    '''
+    hidden = ini_data["hidden"]
+    wb = np.array([ini_data[key] for key in config.wb_keys(hidden)], 
+                  dtype=np.float32)
+    start = time.perf_counter()
+    loss, eta, epochs_trained = train_arrays(xfx, wb, ini_data["mb"], ini_data["eta"], 
+        ini_data["epoch_num"], ini_data["delta"], 
+        threads or config.ENGINE_THREADS, ini_data["seed"], 
+        ini_data["optimizer"],
+        ini_data["beta1"], ini_data["beta2"])
+    wall_time = time.perf_counter() - start
+
+    # same layout as the c_engine stdout
+    return {
+        "weights": {
+            "w_layer_1": wb[0:hidden].tolist(),
+            "b_layer_1": wb[2*hidden:3*hidden].tolist(),
+            "w_layer_2": wb[hidden:2*hidden].tolist(),
+            "b_layer_2": float(wb[3*hidden])
+        },
+        "eta": eta,
+        # loss as the engine prints it (%f)
+        "loss": {str(epoch): float(f"{C:f}") for epoch, C in enumerate(loss)},
+        "epochs_trained": epochs_trained,
+        "wall_time": wall_time,
+        **({"timings": {"engine": wall_time}} if config.TIMINGS else {})
+    }
+
+# -------------------------------------------------------------------
+def run_sweep(ini_data_all_points, xfx, num_workers):
+    '''
+    train all experiments in this process, 'num_workers' at a time
+    (threads: the engine runs without the GIL), all on the same 
+    training set buffer. Yields the stdout dicts in order
+    '''
+    xfx = as_xfx(xfx)
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        yield from pool.map(lambda ini_data: train(ini_data, xfx), 
+                            ini_data_all_points)
+
+
+if __name__ == '__main__':
+    None
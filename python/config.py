@@ -3,17 +3,71 @@
 # handles config.ini files I/O
 # global constants and parameters
 
+import numbers
 import os
 
 
 #global
-INI_LINES = 20 # number of data lines in file
-INI_DATA_LENGTH = 10 # length of data in each line
+INI_LINES = 20 # number of fixed data lines in file
+# followed by the optional hidden-width line and, for hidden units
+# 3...hidden-1, their w1, w2 and b1 lines (see wb_keys), then the
+# optional optimizer, beta1, beta2, seed, ts_id and ts_seed lines
+HIDDEN = 3 # default hidden width, as in the original 1-3-1 network
+# update rule of the weights and biases, in the engine's order; the 
+# defaults apply when the ini file has no optimizer lines
+OPTIMIZERS = ['sgd', 'momentum', 'nesterov', 'adam']
+OPTIMIZER = 'sgd'
+BETA1 = 0.9 # momentum, or decay of Adam's 1st moment
+BETA2 = 0.999 # decay of Adam's 2nd moment
+# seed of the engine's shuffles; in config_1st.ini, the seed of the 
+# whole sweep, from which the points and the seed of each experiment 
+# are derived (see experiments.py). 0 = a new one for each sweep
+SEED = 0
+# training set to train on (table training_sets), 0 = the last one;
+# with new_ts = Y, the set of fx, a, b, c, ts_size and ts_seed is 
+# used if it was generated before, else generated and stored
+TS_ID = 0
+# seed of the TS generation, apart from SEED: sweeps of different 
+# points share the TS. 0 = a new TS for each sweep
+TS_SEED = 1
+INI_DATA_LENGTH = 10 # column of the '//' comments, after short data
+# longest data of a line the engine reads (init_readfile): floats are
+# written at full precision, so every backend trains on the same values
+INI_DATA_MAX = 31
 NUM_OF_EXP = 30 # > 0
 W_EXTREME = 1.0
 bl1_EXTREME = 1.0
 X_EXTREME = 1 # in c_engine, the x-interval
 TEST_SIZE = 40 # number of point to predict
+NUM_OF_WORKERS = os.cpu_count() or 1 # engines running at the same time
+# threads per engine for the minibatch gradient; pays off for large
+# mb sizes (thousands), with NUM_OF_WORKERS * ENGINE_THREADS <= cores
+ENGINE_THREADS = 1
+# out-of-core TS: engines read it in chunks of this many records
+# (option -S) and never hold it whole, for TS larger than memory;
+# 0 = TS in memory ('process' and 'worker' backends)
+ENGINE_CHUNK = 0
+# how experiments are run: 'process' (one engine process per experiment),
+# 'worker' (long-lived engines, training set loaded once per sweep)
+# 'numpy' (all experiments trained at once by npengine) or 'library'
+# (the engine's shared library, in this process: see cengine.py)
+BACKEND = 'worker'
+# how a sweep is scheduled: 'full' (every experiment trains for 
+# epoch_num), 'halving' (successive halving: only the best go on, see
+# scheduler.py) or 'hyperband'
+SCHEDULER = 'full'
+# per-phase timings of each experiment (engine option -T), stored in
+# table 'timings' and summarized at the end of main; False = off
+TIMINGS = True
+# results of past runs (table 'cache'): an experiment identical to
+# one that ran before, on the same TS, is not run again (see cache.py);
+# least recently used results go beyond either limit
+CACHE = True
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_BYTES = 256*2**20
+# loss curves in db: 'blob' (one float32 BLOB per experiment, table
+# loss_curve) or 'rows' (one row per epoch, table loss)
+LOSS_STORAGE = 'blob'
 # set absolute directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 C_ENGINE_DIR = os.path.join(BASE_DIR, "..", "c_engine")
@@ -22,7 +76,13 @@ DATA_DIR = os.path.join(BASE_DIR, "..", "data")
 FILE_CONFIG = os.path.join(DATA_DIR, "config.ini")
 FILE_CONFIG_1ST = os.path.join(DATA_DIR, "config_1st.ini")
 FILE_C_ENGINE = os.path.join(C_ENGINE_DIR, "nnfit")
+FILE_C_LIBRARY = os.path.join(C_ENGINE_DIR, "libnnfit.so")
 FILE_DB = os.path.join(DATA_DIR, "nnfit.db")
+FILE_TS = os.path.join(DATA_DIR, "xfx.bin") # binary copy of table xfx
+FILE_BENCH_DB = os.path.join(DATA_DIR, "bench.db") # benchmark history
+# engine checkpoints of running experiments (BACKEND = 'process')
+CHECKPOINT_DIR = os.path.join(DATA_DIR, "checkpoints")
+CHECKPOINT_EVERY = 10 # epochs between checkpoints
 
 
 
@@ -37,10 +97,13 @@ def read(file_name):
     with open(file_name, mode='r', newline='\n') as ini_file:
         ini_file.readline() # title
         ini_file.readline()
-        # data part of line goes to string 'str_data'
+        # data part of line goes to string 'str_data', the comment
+        # part ('//') is eliminated
         for i in range(INI_LINES):
-            str_data.append(ini_file.read(INI_DATA_LENGTH).strip())
-            ini_file.readline() # comment part ('//') is eliminates 
+            str_data.append(ini_file.readline().split('//', 1)[0].strip())
+        # hidden width and weights of the extra hidden units
+        extra_data = [line.split('//', 1)[0].strip() for line in ini_file]
+        extra_data = [data for data in extra_data if data]
     
     ini_data = {"new_ts": 0, "ts_size": 0, "mb": 0, "fx": 0, "a": 0, 
             "b": 0, "c": 0, "eta": 0, "epoch_num": 0, "delta": 0, 
@@ -57,9 +120,56 @@ def read(file_name):
         else:
             ini_data[key] = float(str_data[i])
         i = i + 1
+    ini_data["hidden"] = int(extra_data[0]) if extra_data else HIDDEN
+    extra_keys = wb_keys(ini_data["hidden"])
+    extra_keys = [key for key in extra_keys if key not in ini_data]
+    if len(extra_data) < 1 + len(extra_keys) and extra_keys:
+        raise ValueError(f"{file_name}: missing weights of hidden units")
+    for key, data in zip(extra_keys, extra_data[1:]):
+        ini_data[key] = float(data)
+    # optimizer, its betas, the RNG seed and the TS
+    opt_data = extra_data[1 + len(extra_keys):]
+    ini_data["optimizer"] = opt_data[0] if opt_data else OPTIMIZER
+    ini_data["beta1"] = float(opt_data[1]) if len(opt_data) > 1 else BETA1
+    ini_data["beta2"] = float(opt_data[2]) if len(opt_data) > 2 else BETA2
+    ini_data["seed"] = int(opt_data[3]) if len(opt_data) > 3 else SEED
+    ini_data["ts_id"] = int(opt_data[4]) if len(opt_data) > 4 else TS_ID
+    ini_data["ts_seed"] = int(opt_data[5]) if len(opt_data) > 5 else TS_SEED
+    if ini_data["optimizer"] not in OPTIMIZERS:
+        raise ValueError(f"{file_name}: unknown optimizer "
+                         f"{ini_data['optimizer']}")
 
     return ini_data
 
+# -------------------------------------------------------------------
+def wb_keys(hidden=HIDDEN):
+    '''
+    keys of the weights and biases of a network with 'hidden' units,
+    in the flat layout of the c_engine and table optimal_wb:
+    w1 (w00l1, w10l1, ...), w2 (w00l2, w01l2, ...), b1 (b0l1, ...), b0l2
+    '''
+    return ([f"w{i}0l1" for i in range(hidden)]
+            + [f"w0{i}l2" for i in range(hidden)]
+            + [f"b{i}l1" for i in range(hidden)] + ["b0l2"])
+
+# -------------------------------------------------------------------
+def _ini_str(value):
+    '''
+    data part of an ini line: strings and integers as they are, floats
+    at full precision (shortest repr that reads back to the same
+    value), padded to INI_DATA_LENGTH and always followed by a blank
+    '''
+    if isinstance(value, str):
+        data = value
+    elif isinstance(value, numbers.Integral):
+        data = str(int(value))
+    else:
+        data = repr(float(value))
+    if len(data) > INI_DATA_MAX:
+        raise ValueError(f"ini data longer than {INI_DATA_MAX}: {data}")
+    
+    return data.ljust(INI_DATA_LENGTH - 1, ' ') + ' '
+
 # -------------------------------------------------------------------
 def update(ini_data, file_name):
     '''
@@ -80,24 +190,42 @@ def update(ini_data, file_name):
              'delta': '// delta, threshold value of C to stop grad-desc [double ini_d.delta]', 
              'w00l1': '// w_{00}^{(1)} layer 1 (hidden) weight 00',
              'w10l1': '// w_{10}^{(1)}', 
-             'w20l1': '// w_{20}^{(1)} all three -> [float ini_d.wl1[3]]', 
+             'w20l1': '// w_{20}^{(1)} all three -> [float ini_d.wb]', 
              'w00l2': '// w_{00}^{(2)} layer 2 (output) weight 00',
              'w01l2': '// w_{01}^{(2)}', 
-             'w02l2': '// w_{02}^{(2)} all three -> [float ini_d.wl2[3]]', 
-             'b0l1': '// b_0^{(1)} layer 1 bias [float ini_d.b0l1]', 
+             'w02l2': '// w_{02}^{(2)} all three -> [float ini_d.wb]', 
+             'b0l1': '// b_0^{(1)} layer 1 bias [float ini_d.wb]', 
              'b1l1': '// b_1^{(1)}', 
-             'b2l1': '// b_2^{(1)} all three -> [float ini_d.bl1[3]]', 
-             'b0l2': '// b_0^{(2)} layer 2 bias [float ini_d.bl2]'}
+             'b2l1': '// b_2^{(1)} all three -> [float ini_d.wb]', 
+             'b0l2': '// b_0^{(2)} layer 2 bias [float ini_d.wb]'}
     str_ini_data = []
     i = 0
     # finds the matching keys in 'data' and 'labels'
     # and copy data[key]+value into 'str_data'
     for key, value in labels.items():
-        if isinstance(ini_data[key], str):
-            temp_str = str(ini_data[key]).ljust(INI_DATA_LENGTH, ' ')
-        else:
-            temp_str = str(f"{ini_data[key]}").ljust(INI_DATA_LENGTH, ' ')
-        str_ini_data.append(temp_str + value)
+        str_ini_data.append(_ini_str(ini_data[key]) + value)
+    # hidden width, then weights of hidden units 3...hidden-1
+    hidden = ini_data.get("hidden", HIDDEN)
+    str_ini_data.append(_ini_str(hidden) 
+                        + '// hidden width [int ini_d.n_hidden]')
+    for key in wb_keys(hidden):
+        if key not in labels:
+            str_ini_data.append(_ini_str(ini_data[key]) + f'// {key}')
+    # optimizer, its betas, the RNG seed and the TS, after all weights
+    opt_labels = {'optimizer': ('// optimizer: sgd, momentum, nesterov or ' 
+                                'adam [opt_type ini_d.optimizer]', OPTIMIZER),
+                  'beta1': ('// beta1, momentum or Adam 1st moment decay '
+                            '[float ini_d.beta1]', BETA1),
+                  'beta2': ('// beta2, Adam 2nd moment decay '
+                            '[float ini_d.beta2]', BETA2),
+                  'seed': ('// RNG seed, 0 = from the clock '
+                           '[unsigned ini_d.seed]', SEED),
+                  'ts_id': ('// training set id, 0 = the last one '
+                            '[int ini_d.ts_id]', TS_ID),
+                  'ts_seed': ('// TS seed, 0 = from the clock '
+                              '[unsigned ini_d.ts_seed]', TS_SEED)}
+    for key, (label, default) in opt_labels.items():
+        str_ini_data.append(_ini_str(ini_data.get(key, default)) + label)
         
     with open(file_name, mode='w', newline='\n') as ini_file:
         ini_file.write("DATA      // COMMENT \n") # title
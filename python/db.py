@@ -1,31 +1,157 @@
 # -------------------------------------------------------------------
 # db.py: database module
 # handles SQL I/O
-# one db with 5 tables: 'xfx', 'ini', 'predictions', 'optimal_wb' and 'loss'
+# one db with 14 tables: 'training_sets', 'xfx', 'ini', 'predictions', 
+# 'optimal_wb', 'loss', 'loss_curve', 'test_grid', 'test_mse', 'summary',
+# 'rungs', 'timings', 'cache' and 'jobs'
 
+import json
+import os
+import queue
 import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
 import config
 
+#global
+DB_PRAGMAS = ("journal_mode = WAL", "synchronous = NORMAL", 
+              "temp_store = MEMORY", "cache_size = -65536") # 64 MiB
+WRITER_QUEUE_SIZE = 256 # experiments queued for the writer thread
+STREAM_CHUNK = 500 # loss records per transaction of LossStream
+SQLITE_MAX_IDS = 500 # ids per "IN (...)" query of the bulk readers
+# columns of table 'ini', in insertion order
+INI_COLS = ['new_ts', 'ts_size', 'mb', 'fx', 'a', 'b', 'c', 
+            'eta', 'epoch_num', 'delta', 'w00l1', 'w10l1', 
+            'w20l1', 'w00l2', 'w01l2', 'w02l2', 'b0l1', 
+            'b1l1', 'b2l1', 'b0l2', 'hidden', 'optimizer', 'beta1', 
+            'beta2', 'seed', 'ts_id']
+# weights and biases of hidden units 0-2 as REAL columns of 'ini' and
+# 'optimal_wb' (NULL if hidden < 3); all hidden units are in column 
+# 'wb', a float32 BLOB in the flat layout of config.wb_keys
+WB_COLS = INI_COLS[10:20]
+# columns added to tables of older databases: {table: [(col, type)]}
+ADDED_COLS = {'ini': [('hidden', 'INTEGER DEFAULT 3'), ('wb', 'BLOB'), 
+                      ('sweep', 'INTEGER'), ('done', 'INTEGER DEFAULT 1'),
+                      ('optimizer', "TEXT DEFAULT 'sgd'"), 
+                      ('beta1', 'REAL DEFAULT 0.9'), 
+                      ('beta2', 'REAL DEFAULT 0.999'), 
+                      ('seed', 'INTEGER DEFAULT 0'), 
+                      ('ts_id', 'INTEGER DEFAULT 0')],
+              'xfx': [('ts_id', 'INTEGER')],
+              'optimal_wb': [('hidden', 'INTEGER DEFAULT 3'), ('wb', 'BLOB')]}
+# binary TS file written by the c_engine (ts_header in nnfit.h)
+TS_MAGIC = b"NNTS"
+TS_VERSION = 2
+TS_HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<i4'), 
+    ('ts_size', '<i4'), ('fx', 'S1'), ('pad', 'S3'), ('a', '<f4'), 
+    ('b', '<f4'), ('c', '<f4'), ('checksum', '<u4'), ('ts_id', '<i4'),
+    ('seed', '<u4')])
+TS_RECORD_DTYPE = np.dtype([('x', '<f4'), ('fx', '<f4')]) # xfx_pair
+# inserts; 'ini' takes an explicit id, or NULL for the next one
+SQL_INS_INI = f"""
+    INSERT INTO ini (id, {", ".join(INI_COLS)}, wb) 
+    VALUES (?{", ?"*len(INI_COLS)}, ?);
+"""
+SQL_INS_OPT = f"""
+    INSERT INTO optimal_wb (exp_id, {", ".join(WB_COLS)}, hidden, wb) 
+    VALUES (?{", ?"*len(WB_COLS)}, ?, ?);
+"""
+SQL_INS_LOSS = """
+    INSERT INTO loss (exp_id, epoch, mse) VALUES (?, ?, ?);
+"""
+SQL_INS_CURVE = """
+    INSERT OR REPLACE INTO loss_curve (exp_id, curve, final_mse, min_mse, epochs) 
+    VALUES (?, ?, ?, ?, ?);
+"""
+SQL_INS_SUMMARY = """
+    INSERT OR REPLACE INTO summary (
+        exp_id, fx, final_mse, min_mse, conv_epoch, epochs_run, wall_time
+        ) 
+        SELECT id, fx, ?, ?, ?, ?, ? 
+        FROM ini WHERE id = ?;
+"""
+# summary columns returned by top_k and leaderboard
+SUMMARY_COLS = ['exp_id', 'fx', 'final_mse', 'min_mse', 'conv_epoch', 
+                'epochs_run', 'wall_time']
+SQL_INS_RUNG = """
+    INSERT INTO rungs (sweep, bracket, rung, exp_id, epochs, loss, promoted) 
+    VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+SQL_INS_TIMING = """
+    INSERT INTO timings (sweep, exp_id, phase, seconds) VALUES (?, ?, ?, ?);
+"""
+SQL_INS_PRED = """
+    INSERT INTO predictions (exp_id, x, fx_pred) VALUES (?, ?, ?);
+"""
+SQL_DEL_PRED = """
+    DELETE FROM predictions WHERE exp_id = ?;
+"""
+SQL_INS_MSE = """
+    INSERT OR REPLACE INTO test_mse (exp_id, mse) VALUES (?, ?);
+"""
+
 
 # ----------------------------------------------------------------    
-def create_tables():
+def create_tables(file_db=None):
     '''
     Creates the necessary tables in the SQLite database for storing experiment data.
 
     Tables created:
-        - xfx: Stores x and fx values with an auto-incrementing primary key.
+        - training_sets: One row per training set generated by the 
+            c_engine, unique by fx, a, b, c, ts_size and seed, with the
+            CRC-32 of its records: a set is generated once and reused
+            (see find_training_set).
+        - xfx: Stores x and fx values with an auto-incrementing primary 
+            key, and the training set (ts_id) they belong to.
         - ini: Stores experiment initialization parameters and metadata.
         - predictions: Stores prediction results, referencing the ini table.
         - loss: Stores loss values, referencing the ini table.
+        - loss_curve: Stores each loss curve as one float32 BLOB plus
+            final and minimum loss and epochs run (see LOSS_STORAGE).
+        - test_grid: Stores the test grid shared by all experiments.
+        - test_mse: Stores the test MSE of each experiment on the grid.
+        - summary: One row per experiment with final and minimum MSE,
+            convergence epoch and wall time, kept up to date as results
+            are saved (see top_k and leaderboard).
+        - rungs: One row per experiment and rung of a scheduled sweep
+            (see scheduler.py): epochs trained, last loss and whether
+            it went on to the next rung.
+        - timings: Seconds spent in each phase of each experiment of a
+            sweep (see timing.py); exp_id is NULL for the stages run 
+            once per sweep.
+        - cache: Results of past runs by experiment key (see cache.py):
+            the engine's stdout as zlib-compressed JSON, its size, and
+            when it was stored and last used.
+        - jobs: Job queue of experiments run by worker processes (see
+            jobs.py): status, worker, heartbeat and attempts.
+    Indexes on exp_id and on the summary losses keep per-experiment
+    reads and best-run queries from scanning whole tables.
+    Tables 'ini', 'optimal_wb' and 'xfx' of older databases get the
+    columns added since ('hidden', 'wb', 'sweep', 'done', the 
+    optimizer's, 'seed' and 'ts_id', see ADDED_COLS); their rows of
+    'xfx' stay an unversioned training set (ts_id NULL, see ts_file).
 
-    The function connects to the database specified by `db_name`, executes the SQL
+    The function connects to the database specified by `file_db` (default 
+    config.FILE_DB), executes the SQL
     statements to create the tables if they do not exist, and commits the changes.
     Any SQLite errors encountered during execution are printed to the console.
     '''
+    sql_qry_sets = """
+        CREATE TABLE IF NOT EXISTS training_sets (
+            id INTEGER PRIMARY KEY, 
+            fx TEXT, a REAL, b REAL, c REAL, 
+            ts_size INTEGER, seed INTEGER, checksum INTEGER, 
+            UNIQUE (fx, a, b, c, ts_size, seed)
+            );
+    """
     sql_qry_xfx = """
         CREATE TABLE IF NOT EXISTS xfx (
             id INTEGER PRIMARY KEY, 
-            x REAL, fx REAL
+            x REAL, fx REAL, ts_id INTEGER
             );
     """
     sql_qry_ini = """
@@ -36,7 +162,12 @@ def create_tables():
             eta REAL, epoch_num INTEGER, delta REAL, 
             w00l1 REAL, w10l1 REAL, w20l1 REAL, 
             w00l2 REAL, w01l2 REAL, w02l2 REAL, 
-            b0l1 REAL, b1l1 REAL, b2l1 REAL, b0l2 REAL 
+            b0l1 REAL, b1l1 REAL, b2l1 REAL, b0l2 REAL, 
+            hidden INTEGER DEFAULT 3, wb BLOB, 
+            sweep INTEGER, done INTEGER DEFAULT 1, 
+            optimizer TEXT DEFAULT 'sgd', beta1 REAL DEFAULT 0.9, 
+            beta2 REAL DEFAULT 0.999, seed INTEGER DEFAULT 0, 
+            ts_id INTEGER DEFAULT 0 
             );
     """
     sql_qry_optimal = """
@@ -46,6 +177,7 @@ def create_tables():
             w00l1 REAL, w10l1 REAL, w20l1 REAL, 
             w00l2 REAL, w01l2 REAL, w02l2 REAL, 
             b0l1 REAL, b1l1 REAL, b2l1 REAL, b0l2 REAL, 
+            hidden INTEGER DEFAULT 3, wb BLOB, 
             FOREIGN KEY(exp_id) REFERENCES ini(id)
             );
     """
@@ -65,19 +197,125 @@ def create_tables():
             FOREIGN KEY(exp_id) REFERENCES ini(id)
             );
     """
+    sql_qry_curve = """
+        CREATE TABLE IF NOT EXISTS loss_curve (
+            exp_id INTEGER PRIMARY KEY, 
+            curve BLOB, 
+            final_mse REAL, min_mse REAL, epochs INTEGER, 
+            FOREIGN KEY(exp_id) REFERENCES ini(id)
+            );
+    """
+    sql_qry_grid = """
+        CREATE TABLE IF NOT EXISTS test_grid (
+            id INTEGER PRIMARY KEY, 
+            x REAL
+            );
+    """
+    sql_qry_mse = """
+        CREATE TABLE IF NOT EXISTS test_mse (
+            exp_id INTEGER PRIMARY KEY, 
+            mse REAL, 
+            FOREIGN KEY(exp_id) REFERENCES ini(id)
+            );
+    """
+    sql_qry_summary = """
+        CREATE TABLE IF NOT EXISTS summary (
+            exp_id INTEGER PRIMARY KEY, 
+            fx TEXT, 
+            final_mse REAL, min_mse REAL, 
+            conv_epoch INTEGER, epochs_run INTEGER, 
+            wall_time REAL, 
+            FOREIGN KEY(exp_id) REFERENCES ini(id)
+            );
+    """
+    sql_qry_rungs = """
+        CREATE TABLE IF NOT EXISTS rungs (
+            id INTEGER PRIMARY KEY, 
+            sweep INTEGER, bracket INTEGER, rung INTEGER, 
+            exp_id INTEGER, 
+            epochs INTEGER, loss REAL, promoted INTEGER, 
+            FOREIGN KEY(exp_id) REFERENCES ini(id)
+            );
+    """
+    sql_qry_timings = """
+        CREATE TABLE IF NOT EXISTS timings (
+            id INTEGER PRIMARY KEY, 
+            sweep INTEGER, exp_id INTEGER, 
+            phase TEXT, seconds REAL, 
+            FOREIGN KEY(exp_id) REFERENCES ini(id)
+            );
+    """
+    sql_qry_cache = """
+        CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY, 
+            stdout BLOB, size INTEGER, 
+            created REAL, used REAL, hits INTEGER DEFAULT 0
+            );
+    """
+    sql_qry_jobs = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            exp_id INTEGER PRIMARY KEY, 
+            sweep INTEGER, 
+            status TEXT DEFAULT 'pending', 
+            worker TEXT, heartbeat REAL, 
+            attempts INTEGER DEFAULT 0, error TEXT,
+            FOREIGN KEY(exp_id) REFERENCES ini(id)
+            );
+    """
+    sql_qry_idx = """
+        CREATE INDEX IF NOT EXISTS idx_xfx_ts_id ON xfx(ts_id, id);
+        CREATE INDEX IF NOT EXISTS idx_loss_exp ON loss(exp_id, epoch);
+        CREATE INDEX IF NOT EXISTS idx_pred_exp ON predictions(exp_id);
+        CREATE INDEX IF NOT EXISTS idx_opt_exp ON optimal_wb(exp_id);
+        CREATE INDEX IF NOT EXISTS idx_summary_final ON summary(final_mse);
+        CREATE INDEX IF NOT EXISTS idx_summary_min ON summary(min_mse);
+        CREATE INDEX IF NOT EXISTS idx_summary_fx 
+            ON summary(fx, final_mse);
+        CREATE INDEX IF NOT EXISTS idx_rungs_sweep ON rungs(sweep, rung);
+        CREATE INDEX IF NOT EXISTS idx_timings_sweep 
+            ON timings(sweep, phase);
+        CREATE INDEX IF NOT EXISTS idx_cache_used ON cache(used);
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, exp_id);
+    """
     # Connect to the database
     try:
-        with sqlite3.connect(config.FILE_DB) as db:
+        with sqlite3.connect(file_db or config.FILE_DB) as db:
             cursor = db.cursor()
+            db.execute(sql_qry_sets)
             db.execute(sql_qry_xfx)
             db.execute(sql_qry_ini)
             db.execute(sql_qry_optimal)
             db.execute(sql_qry_pred)
             db.execute(sql_qry_loss)
+            db.execute(sql_qry_curve)
+            db.execute(sql_qry_grid)
+            db.execute(sql_qry_mse)
+            db.execute(sql_qry_summary)
+            db.execute(sql_qry_rungs)
+            db.execute(sql_qry_timings)
+            db.execute(sql_qry_cache)
+            db.execute(sql_qry_jobs)
+            _add_columns(db)
+            db.executescript(sql_qry_idx)
             db.commit()
     except sqlite3.Error as e:
         print(e)
 
+# ----------------------------------------------------------------    
+def connect(file_db=None):
+    '''
+    opens a connection to the database tuned for bulk writes:
+    WAL journal (readers, e.g. c_engines, never block the writer),
+    relaxed syncing and a larger page cache
+    
+    file_db: database file, default config.FILE_DB
+    '''
+    db = sqlite3.connect(file_db or config.FILE_DB, timeout=30)
+    for pragma in DB_PRAGMAS:
+        db.execute(f"PRAGMA {pragma};")
+
+    return db
+
 # ----------------------------------------------------------------    
 def save_experiment(ini_data):
     '''
@@ -96,32 +334,12 @@ def save_experiment(ini_data):
         - The order of values in 'ini_data' must correspond to the columns 
             specified in the SQL query.
     '''
-    sql_qry_ins = """
-    INSERT INTO ini (
-        new_ts, ts_size, mb, fx, a, b, c, 
-        eta, epoch_num, delta, w00l1, w10l1, 
-        w20l1, w00l2, w01l2, w02l2, b0l1, b1l1, 
-        b2l1, b0l2
-        ) 
-        VALUES (
-        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 
-        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-        )
-    """
-    # tuple with all parameters to insert
-    correct_order_cols = ['new_ts', 'ts_size', 'mb', 'fx', 'a', 'b', 'c', 
-                          'eta', 'epoch_num', 'delta', 'w00l1', 'w10l1', 
-                          'w20l1', 'w00l2', 'w01l2', 'w02l2', 'b0l1', 
-                          'b1l1', 'b2l1', 'b0l2'
-                          ]
-    param = tuple(ini_data[col] for col in correct_order_cols)
    # Connect to the database
     try:
         with sqlite3.connect(config.FILE_DB) as db:
             cursor = db.cursor()
-            cursor.execute(sql_qry_ins, param)
             # extract exp_id of last inserted experiment
-            exp_id = cursor.lastrowid
+            exp_id = _insert_experiment(cursor, ini_data)
             db.commit()
     except sqlite3.Error as e:
         print(e)
@@ -137,29 +355,10 @@ def save_optimal_wb(stdout, exp_id):
     :param stdout (dict): output from c_engine
     :param exp_id: experiment id
     '''
-    sql_qry_ins = """
-        INSERT INTO optimal_wb (
-            exp_id,
-            w00l1, w10l1, w20l1, 
-            w00l2, w01l2, w02l2, 
-            b0l1, b1l1, b2l1, 
-            b0l2 
-            ) 
-            VALUES (
-            ?, ?, ?, ?, ?, ?,
-            ?, ?, ?, ?, ?
-            );
-    """
     try:
         with sqlite3.connect(config.FILE_DB) as db:
             cursor = db.cursor()
-            opt_wb = [exp_id]
-            # preparing list opt_wb to insert in db
-            for key in ['w_layer_1', 'w_layer_2', 
-                        'b_layer_1']:
-                    opt_wb.extend(list(stdout['weights'][key]))
-            opt_wb.append(stdout['weights']['b_layer_2'])
-            cursor.execute(sql_qry_ins, opt_wb)
+            opt_wb = _insert_optimal_wb(cursor, stdout, exp_id)
             db.commit()
             return opt_wb
     except sqlite3.Error as e:
@@ -169,26 +368,17 @@ def save_optimal_wb(stdout, exp_id):
 # ----------------------------------------------------------------    
 def save_loss(stdout, exp_id):
     '''
-    save loss(epoch) data into table 'loss' corresponding 
-    to the exp_id = exp_num
+    save loss(epoch) data into table 'loss' (one row per epoch) or
+    'loss_curve' (one BLOB), as set by config.LOSS_STORAGE,
+    corresponding to the exp_id = exp_num
     
     stdout (dict): from c_engine with w, b and loss
     exp_id: experiment number corresponging to id - table ini
     '''
-    sql_qry_ins = """
-        INSERT INTO loss (
-            exp_id, epoch, mse
-            ) 
-            VALUES (
-            ?, ?, ?
-            );
-    """
-    # print(stdout)
     try:
         with sqlite3.connect(config.FILE_DB) as db:
             cursor = db.cursor()
-            for epoch, loss in stdout["loss"].items():
-                cursor.execute(sql_qry_ins, (exp_id, epoch, loss))
+            _insert_loss(cursor, stdout, exp_id)
             db.commit()
     except sqlite3.Error as e:
             print(e)
@@ -196,39 +386,1159 @@ def save_loss(stdout, exp_id):
 # ----------------------------------------------------------------    
 def save_predictions(predictions, exp_id):
     '''
-    save predictions' data into table 'predictions'
+    save predictions' data into table 'predictions', replacing
+    those saved before for exp_id
     
     predictions (list of dicts): [{x: fx, ...}]
     exp_id: experiment id number corresponging to id - table ini
     '''
-    sql_qry_ins = """
-        INSERT INTO predictions (
-            exp_id, x, fx_pred
-            ) 
-            VALUES (
-            ?, ?, ?
-            );
-    """
     try:
         with sqlite3.connect(config.FILE_DB) as db:
             cursor = db.cursor()
-            for dict in predictions:
-                cursor.execute(
-                    sql_qry_ins, (
-                        exp_id, 
-                        list(dict.keys())[0], 
-                        list(dict.values())[0]
-                    )
-                )
+            cursor.execute(SQL_DEL_PRED, (exp_id,))
+            cursor.executemany(SQL_INS_PRED, (
+                (exp_id, list(dict.keys())[0], list(dict.values())[0])
+                for dict in predictions))
             db.commit()
-            '''
-            for x, fx_pred in predictions.items():
-                cursor.execute(sql_qry_ins, (exp_id, x, fx_pred))
+    except sqlite3.Error as e:
+            print(e)
+
+# ----------------------------------------------------------------    
+def save_test_grid(x_grid):
+    '''
+    stores the test grid shared by all experiments in table
+    'test_grid', replacing the previous one
+    
+    x_grid: test points
+    '''
+    try:
+        with sqlite3.connect(config.FILE_DB) as db:
+            cursor = db.cursor()
+            _insert_test_grid(cursor, x_grid)
             db.commit()
-            '''
     except sqlite3.Error as e:
             print(e)
 
+# ----------------------------------------------------------------    
+def save_test_results(exp_ids, x_grid, fx_pred, mse):
+    '''
+    save predictions on the test grid and test MSE of many
+    experiments into tables 'predictions' and 'test_mse', replacing
+    those of a previous test of the same experiments
+    
+    exp_ids: experiment ids, one per row of fx_pred
+    x_grid: test points
+    fx_pred: (len(exp_ids), len(x_grid)) predictions
+    mse: test MSE per experiment
+    '''
+    try:
+        with sqlite3.connect(config.FILE_DB) as db:
+            cursor = db.cursor()
+            _insert_test_results(cursor, exp_ids, x_grid, fx_pred, mse)
+            db.commit()
+    except sqlite3.Error as e:
+            print(e)
+
+# ----------------------------------------------------------------    
+def save_pending(ini_data_all_points):
+    '''
+    stores all experiments of a new sweep in table 'ini' before they
+    run, as not done (done = 0), so that an interrupted sweep can be
+    finished (see read_pending and ResultWriter.save_result)
+
+    return sweep number and the exp_ids, in order
+    '''
+    with connect() as db:
+        row = db.execute("SELECT MAX(sweep) FROM ini;").fetchone()
+        sweep = (row[0] or 0) + 1
+        cursor = db.cursor()
+        exp_ids = [_insert_experiment(cursor, ini_data) 
+                   for ini_data in ini_data_all_points]
+        _execute_in(cursor, """
+            UPDATE ini SET sweep = ?, done = 0 WHERE id IN ({});
+        """, [sweep], exp_ids)
+    db.close()
+
+    return sweep, exp_ids
+
+# ----------------------------------------------------------------    
+def read_pending(sweep=None):
+    '''
+    experiments of a sweep (default the last one) that are not done
+
+    return sweep number (None if there are no sweeps), their exp_ids
+        and ini_data dictionaries, in order
+    '''
+    with sqlite3.connect(config.FILE_DB) as db:
+        if sweep is None:
+            sweep = db.execute("SELECT MAX(sweep) FROM ini;").fetchone()[0]
+        exp_ids = [row[0] for row in db.execute("""
+            SELECT id FROM ini WHERE sweep = ? AND done = 0 ORDER BY id;
+        """, (sweep,))]
+
+    return sweep, exp_ids, read_ini(exp_ids)
+
+# ----------------------------------------------------------------    
+def read_ini(exp_ids):
+    '''
+    ini_data dictionaries of experiments in table 'ini', as they were
+    saved (see save_pending), in exp_ids order
+    '''
+    with sqlite3.connect(config.FILE_DB) as db:
+        rows = {row[0]: row for row in _select_in(db, f"""
+            SELECT id, {", ".join(INI_COLS)}, wb FROM ini WHERE id IN ({{}});
+        """, exp_ids)}
+    ini_data_all_points = []
+    for exp_id in exp_ids:
+        row = rows[exp_id]
+        ini_data = dict(zip(INI_COLS, row[1:-1]))
+        # base ini lines of missing hidden units (hidden < 3)
+        ini_data.update({col: 0 for col in WB_COLS if ini_data[col] is None})
+        # float32 of the BLOB back to the shortest decimal that reads
+        # as it (0.0001, not 9.999999747378752e-05): the saved values
+        wb = [float(str(w)) for w in np.frombuffer(row[-1], dtype=np.float32)]
+        ini_data.update(zip(config.wb_keys(ini_data["hidden"]), wb))
+        ini_data_all_points.append(ini_data)
+
+    return ini_data_all_points
+
+# ----------------------------------------------------------------    
+def sweep_exp_ids(sweep):
+    '''
+    exp_ids of all experiments of a sweep, in order
+    '''
+    with sqlite3.connect(config.FILE_DB) as db:
+        rows = db.execute("SELECT id FROM ini WHERE sweep = ? ORDER BY id;",
+                          (sweep,)).fetchall()
+
+    return [row[0] for row in rows]
+
+# ----------------------------------------------------------------    
+def optimal_wb(stdout):
+    '''
+    optimized weights and biases from a c_engine stdout, in the 
+    flat layout of config.wb_keys (w00l1 ... b0l2 for hidden = 3)
+    '''
+    opt_wb = []
+    for key in ['w_layer_1', 'w_layer_2', 'b_layer_1']:
+        opt_wb.extend(list(stdout['weights'][key]))
+    opt_wb.append(stdout['weights']['b_layer_2'])
+
+    return opt_wb
+
+# ----------------------------------------------------------------    
+# inserts shared by the save_* functions and ResultWriter; 
+# the caller owns the transaction
+def _insert_experiment(cursor, ini_data, exp_id=None):
+    keys = config.wb_keys(ini_data["hidden"])
+    param = ((exp_id,) 
+             + tuple(ini_data[col] if col not in WB_COLS or col in keys 
+                     else None for col in INI_COLS)
+             + (_wb_blob([ini_data[key] for key in keys]),))
+    cursor.execute(SQL_INS_INI, param)
+
+    return cursor.lastrowid
+
+def _insert_optimal_wb(cursor, stdout, exp_id):
+    opt_wb = optimal_wb(stdout)
+    hidden = len(stdout["weights"]["w_layer_1"])
+    wb = dict(zip(config.wb_keys(hidden), opt_wb))
+    cursor.execute(SQL_INS_OPT, [exp_id] + [wb.get(col) for col in WB_COLS]
+                   + [hidden, _wb_blob(opt_wb)])
+
+    return [exp_id] + opt_wb
+
+def _wb_blob(wb):
+    return np.asarray(wb, dtype=np.float32).tobytes()
+
+def _add_columns(db):
+    for table, cols in ADDED_COLS.items():
+        existing = {row[1] for row in db.execute(f"PRAGMA table_info({table});")}
+        for col, col_type in cols:
+            if col not in existing:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type};")
+
+def _insert_loss(cursor, stdout, exp_id):
+    # by epoch: scheduled curves have no loss at the end of a rung
+    curve = _curve_from_rows([(int(epoch), loss) 
+                              for epoch, loss in stdout["loss"].items()])
+    if config.LOSS_STORAGE == 'blob':
+        _insert_curve(cursor, exp_id, curve)
+    else:
+        cursor.executemany(SQL_INS_LOSS, (
+            (exp_id, epoch, loss) for epoch, loss in stdout["loss"].items()))
+    _insert_summary(cursor, exp_id, curve, stdout.get("wall_time"))
+
+def _insert_summary(cursor, exp_id, curve, wall_time=None):
+    # conv_epoch: first epoch with loss below the experiment's delta
+    row = cursor.execute("SELECT delta FROM ini WHERE id = ?;", 
+                         (exp_id,)).fetchone()
+    conv_epoch = None
+    if row is not None and len(curve):
+        below = np.flatnonzero(curve < row[0])
+        conv_epoch = int(below[0]) if len(below) else None
+    final_mse = float(curve[-1]) if len(curve) else None
+    min_mse = _min_loss(curve)
+    cursor.execute(SQL_INS_SUMMARY, (final_mse, min_mse, conv_epoch, 
+                                     len(curve), wall_time, exp_id))
+
+def _insert_curve(cursor, exp_id, curve):
+    final_mse = float(curve[-1]) if len(curve) else None
+    min_mse = _min_loss(curve)
+    cursor.execute(SQL_INS_CURVE, (exp_id, curve.tobytes(), 
+                                   final_mse, min_mse, len(curve)))
+
+def _min_loss(curve):
+    # epochs without a stored loss are NaN (see _curve_from_rows), 
+    # and are skipped as by LossStream
+    stored = curve[~np.isnan(curve)]
+    return float(stored.min()) if len(stored) else None
+
+def _curve_from_rows(rows):
+    # loss curve indexed by epoch from (epoch, mse) rows of table 
+    # 'loss'; curves streamed every K > 1 epochs have rows for epochs
+    # 0, K, 2K... only: the epochs between are NaN
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, 2)
+    epochs = rows[:, 0].astype(int)
+    curve = np.full(epochs.max() + 1 if len(epochs) else 0, np.nan, 
+                    dtype=np.float32)
+    curve[epochs] = rows[:, 1]
+
+    return curve
+
+def _insert_rungs(cursor, sweep, exp_ids, rungs):
+    cursor.executemany(SQL_INS_RUNG, ((sweep, row.get("bracket", 0), 
+        row["rung"], exp_ids[row["index"]], row["epochs"], row["loss"], 
+        int(row["promoted"])) for row in rungs))
+
+def _insert_timings(cursor, sweep, exp_ids, exp_timings, sweep_timings):
+    rows = [(sweep, exp_id, phase, seconds) 
+            for exp_id, timings in zip(exp_ids, exp_timings) 
+            for phase, seconds in (timings or {}).items()]
+    rows.extend((sweep, None, phase, seconds) 
+                for phase, seconds in (sweep_timings or {}).items())
+    cursor.executemany(SQL_INS_TIMING, rows)
+
+def _insert_test_grid(cursor, x_grid):
+    cursor.execute("DELETE FROM test_grid;")
+    cursor.executemany("INSERT INTO test_grid (x) VALUES (?);",
+                       ((float(x),) for x in x_grid))
+
+def _insert_test_results(cursor, exp_ids, x_grid, fx_pred, mse):
+    # a sweep tested again (main --resume, jobs.py finish) replaces
+    # its predictions, as test_mse does
+    cursor.executemany(SQL_DEL_PRED, ((exp_id,) for exp_id in exp_ids))
+    x_grid = [float(x) for x in x_grid]
+    for exp_id, row in zip(exp_ids, np.asarray(fx_pred).tolist()):
+        cursor.executemany(SQL_INS_PRED, 
+            ((exp_id, x, fx) for x, fx in zip(x_grid, row)))
+    cursor.executemany(SQL_INS_MSE, 
+        zip(exp_ids, (float(m) for m in mse)))
+
+
+# ----------------------------------------------------------------    
+class ResultWriter:
+    '''
+    results writer for a whole sweep: keeps one tuned connection 
+    (see connect) open and writes each experiment's ini, optimal 
+    wb and loss with executemany in a single transaction.
+
+    With background=True the writes run on a writer thread and save()
+    returns at once; exp_ids are then assigned by the writer, which 
+    must be the only one inserting into 'ini' while it is open.
+    Errors from the writer thread are raised by the next call.
+    write_time holds the seconds spent in write transactions.
+
+    usage:
+        with db.ResultWriter(background=True) as writer:
+            exp_id = writer.save(ini_data, stdout)
+    '''
+    def __init__(self, file_db=None, background=False):
+        self.background = background
+        self.error = None
+        self.write_time = 0
+        if not background:
+            self.db = connect(file_db)
+            return
+        self.next_id = None
+        self.id_ready = threading.Event()
+        self.queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self.thread = threading.Thread(
+            target=self._write_loop, args=(file_db,), daemon=True)
+        self.thread.start()
+        # the writer thread reads the first free exp_id
+        self.id_ready.wait()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def save(self, ini_data, stdout):
+        '''
+        stores one experiment: ini_data in 'ini', its optimal wb and
+        its loss. returns exp_id
+        '''
+        if not self.background:
+            with self.db:
+                cursor = self.db.cursor()
+                exp_id = _insert_experiment(cursor, ini_data)
+                _insert_optimal_wb(cursor, stdout, exp_id)
+                _insert_loss(cursor, stdout, exp_id)
+            return exp_id
+
+        exp_id = self.next_id
+        self.next_id += 1
+        def write(cursor):
+            _insert_experiment(cursor, ini_data, exp_id)
+            _insert_optimal_wb(cursor, stdout, exp_id)
+            _insert_loss(cursor, stdout, exp_id)
+        self._submit(write)
+
+        return exp_id
+
+    def save_result(self, exp_id, stdout):
+        '''
+        stores the result of an experiment already in 'ini' (see 
+        save_pending): its optimal wb and loss, and marks it (and
+        its job, see jobs.py) done
+        '''
+        def write(cursor):
+            _insert_optimal_wb(cursor, stdout, exp_id)
+            _insert_loss(cursor, stdout, exp_id)
+            cursor.execute("UPDATE ini SET done = 1 WHERE id = ?;", (exp_id,))
+            cursor.execute("UPDATE jobs SET status = 'done' WHERE exp_id = ?;",
+                           (exp_id,))
+        self._run(write)
+
+    def save_test_grid(self, x_grid):
+        '''
+        see db.save_test_grid
+        '''
+        self._run(lambda cursor: _insert_test_grid(cursor, x_grid))
+
+    def save_test_results(self, exp_ids, x_grid, fx_pred, mse):
+        '''
+        see db.save_test_results
+        '''
+        self._run(lambda cursor: _insert_test_results(
+            cursor, exp_ids, x_grid, fx_pred, mse))
+
+    def save_rungs(self, sweep, exp_ids, rungs):
+        '''
+        stores the rungs of a scheduled sweep in table 'rungs'
+
+        sweep: sweep number, as in table 'ini'
+        exp_ids: experiment ids, in sweep order
+        rungs: as returned by scheduler.successive_halving
+        '''
+        self._run(lambda cursor: _insert_rungs(cursor, sweep, exp_ids, 
+                                               rungs))
+
+    def save_timings(self, sweep, exp_ids, exp_timings, sweep_timings=None):
+        '''
+        stores the phase timings of a sweep in table 'timings'
+
+        exp_ids: experiment ids, in sweep order
+        exp_timings: timings dict of each experiment (or None)
+        sweep_timings: timings dict of the stages run once per sweep
+        '''
+        self._run(lambda cursor: _insert_timings(
+            cursor, sweep, exp_ids, exp_timings, sweep_timings))
+
+    def close(self):
+        '''
+        waits for pending writes and closes the connection
+        '''
+        if self.background:
+            if self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join()
+            self._raise_error()
+        else:
+            self.db.close()
+
+    def _run(self, write):
+        if self.background:
+            self._submit(write)
+        else:
+            start = time.perf_counter()
+            with self.db:
+                write(self.db.cursor())
+            self.write_time += time.perf_counter() - start
+
+    def _submit(self, write):
+        self._raise_error()
+        self.queue.put(write)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write_loop(self, file_db):
+        # background thread: owns the connection, and commits 
+        # everything queued so far in one transaction
+        try:
+            db = connect(file_db)
+            row = db.execute("SELECT MAX(id) FROM ini;").fetchone()
+            self.next_id = (row[0] or 0) + 1
+        except sqlite3.Error as e:
+            self.error = e
+            self.id_ready.set()
+            return
+        self.id_ready.set()
+        done = False
+        while not done:
+            writes = [self.queue.get()]
+            while len(writes) < WRITER_QUEUE_SIZE:
+                try:
+                    writes.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in writes:
+                done = True
+                writes = writes[:writes.index(None)]
+            start = time.perf_counter()
+            try:
+                with db:
+                    cursor = db.cursor()
+                    for write in writes:
+                        write(cursor)
+            except sqlite3.Error as e:
+                self.error = e
+            self.write_time += time.perf_counter() - start
+        db.close()
+
+
+# ----------------------------------------------------------------    
+class LossStream:
+    '''
+    stores one experiment while it runs (see runner.run_streamed):
+    ini_data when opened, then loss records in chunks of STREAM_CHUNK
+    rows of table 'loss' (one transaction each), then optimal wb and
+    summary. Only the current chunk and the summary values are kept
+    in memory, whatever the number of epochs. Streamed curves stay 
+    in table 'loss'; migrate_loss converts them to BLOBs.
+
+    usage:
+        with db.LossStream(ini_data) as stream:
+            stream.append(epoch, loss)
+            ...
+            stream.finish(record) # record with "weights", if any
+    '''
+    def __init__(self, ini_data, file_db=None, chunk=STREAM_CHUNK):
+        self.db = connect(file_db)
+        self.chunk = chunk
+        self.rows = []
+        self.delta = ini_data["delta"]
+        self.final_mse = None
+        self.min_mse = None
+        self.conv_epoch = None
+        self.epochs = 0
+        with self.db:
+            self.exp_id = _insert_experiment(self.db.cursor(), ini_data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, epoch, loss):
+        '''
+        adds the loss of one epoch; written once chunk rows are queued
+        '''
+        self.rows.append((self.exp_id, epoch, loss))
+        self.final_mse = loss
+        if self.min_mse is None or loss < self.min_mse:
+            self.min_mse = loss
+        if self.conv_epoch is None and loss < self.delta:
+            self.conv_epoch = epoch
+        self.epochs = epoch + 1
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        '''
+        writes the queued loss rows and the summary so far
+        '''
+        with self.db:
+            cursor = self.db.cursor()
+            cursor.executemany(SQL_INS_LOSS, self.rows)
+            self._insert_summary(cursor)
+        self.rows = []
+
+    def finish(self, record):
+        '''
+        stores the engine's last record: optimal wb, epochs run and
+        wall time
+        '''
+        self.epochs = record.get("epochs", self.epochs)
+        with self.db:
+            cursor = self.db.cursor()
+            cursor.executemany(SQL_INS_LOSS, self.rows)
+            _insert_optimal_wb(cursor, record, self.exp_id)
+            self._insert_summary(cursor, record.get("wall_time"))
+        self.rows = []
+
+    def close(self):
+        '''
+        writes what is left (e.g. of an aborted run) and closes
+        '''
+        if self.rows:
+            self.flush()
+        self.db.close()
+
+    def _insert_summary(self, cursor, wall_time=None):
+        cursor.execute(SQL_INS_SUMMARY, (self.final_mse, self.min_mse, 
+            self.conv_epoch, self.epochs, wall_time, self.exp_id))
+
+# ----------------------------------------------------------------    
+def read_loss(exp_id, db=None):
+    '''
+    reads the loss curve of experiment exp_id, from table
+    'loss_curve' or else from table 'loss'
+
+    exp_id: experiment id
+    db: open connection to use, default a new one to config.FILE_DB
+    return loss: float32 numpy array indexed by epoch, NaN at the 
+        epochs without a stored loss (runner.run_streamed every K > 1
+        epochs); from a BLOB it is a read-only view of the stored 
+        bytes (np.frombuffer)
+    '''
+    own_db = db is None
+    if own_db:
+        db = sqlite3.connect(config.FILE_DB)
+    try:
+        row = db.execute("SELECT curve FROM loss_curve WHERE exp_id = ?;",
+                         (exp_id,)).fetchone()
+        if row is not None:
+            return np.frombuffer(row[0], dtype=np.float32)
+        rows = db.execute("""
+            SELECT epoch, mse FROM loss WHERE exp_id = ? ORDER BY epoch;
+        """, (exp_id,)).fetchall()
+        return _curve_from_rows(rows)
+    finally:
+        if own_db:
+            db.close()
+
+# ----------------------------------------------------------------    
+def read_optimal_wb(exp_id, db=None):
+    '''
+    reads the optimized weights and biases of experiment exp_id, from
+    column 'wb' of table 'optimal_wb', or else (databases created 
+    before the hidden width was configurable) from its REAL columns
+
+    exp_id: experiment id
+    db: open connection to use, default a new one to config.FILE_DB
+    return wb: float32 numpy array in the flat layout of config.wb_keys,
+        None if the experiment has no result
+    '''
+    own_db = db is None
+    if own_db:
+        db = sqlite3.connect(config.FILE_DB)
+    try:
+        row = db.execute(f"""
+            SELECT wb, {", ".join(WB_COLS)} FROM optimal_wb 
+            WHERE exp_id = ? ORDER BY id DESC LIMIT 1;
+        """, (exp_id,)).fetchone()
+        if row is None:
+            return None
+        if row[0] is not None:
+            return np.frombuffer(row[0], dtype=np.float32)
+        return np.array(row[1:], dtype=np.float32)
+    finally:
+        if own_db:
+            db.close()
+
+# ----------------------------------------------------------------    
+def read_losses(exp_ids, db=None):
+    '''
+    bulk read_loss: the loss curves of many experiments, with one 
+    query per SQLITE_MAX_IDS experiments instead of one per experiment
+
+    exp_ids: experiment ids
+    db: open connection to use, default a new one to config.FILE_DB
+    return list of float32 numpy arrays, in exp_ids order (empty for 
+        experiments without a curve), indexed by epoch as by 
+        read_loss; BLOBs are read-only views
+    '''
+    own_db = db is None
+    if own_db:
+        db = sqlite3.connect(config.FILE_DB)
+    try:
+        curves = {exp_id: np.frombuffer(blob, dtype=np.float32) 
+                  for exp_id, blob in _select_in(db, """
+            SELECT exp_id, curve FROM loss_curve WHERE exp_id IN ({});
+        """, exp_ids)}
+        # curves stored as rows (LOSS_STORAGE = 'rows' or streamed)
+        missing = [exp_id for exp_id in exp_ids if exp_id not in curves]
+        rows = np.array(_select_in(db, """
+            SELECT exp_id, epoch, mse FROM loss WHERE exp_id IN ({}) 
+            ORDER BY exp_id, epoch;
+        """, missing), dtype=np.float64).reshape(-1, 3)
+        ids, starts = np.unique(rows[:, 0], return_index=True)
+        for exp_id, exp_rows in zip(ids, np.split(rows[:, 1:], starts[1:])):
+            curves[int(exp_id)] = _curve_from_rows(exp_rows)
+    finally:
+        if own_db:
+            db.close()
+
+    empty = np.empty(0, dtype=np.float32)
+    return [curves.get(exp_id, empty) for exp_id in exp_ids]
+
+# ----------------------------------------------------------------    
+def read_optimal_wbs(exp_ids, db=None):
+    '''
+    bulk read_optimal_wb: the optimized weights and biases of many
+    experiments, in one query per SQLITE_MAX_IDS experiments
+
+    exp_ids: experiment ids
+    db: open connection to use, default a new one to config.FILE_DB
+    return list of float32 numpy arrays in the flat layout, in 
+        exp_ids order (None for experiments without a result)
+    '''
+    own_db = db is None
+    if own_db:
+        db = sqlite3.connect(config.FILE_DB)
+    try:
+        # the last row of each experiment, as read_optimal_wb
+        wbs = {}
+        for row in _select_in(db, f"""
+                SELECT exp_id, wb, {", ".join(WB_COLS)} FROM optimal_wb 
+                WHERE exp_id IN ({{}}) ORDER BY id;
+                """, exp_ids):
+            wbs[row[0]] = np.frombuffer(row[1], dtype=np.float32) \
+                if row[1] is not None else np.array(row[2:], dtype=np.float32)
+    finally:
+        if own_db:
+            db.close()
+
+    return [wbs.get(exp_id) for exp_id in exp_ids]
+
+# ----------------------------------------------------------------    
+def read_predictions(exp_ids, db=None):
+    '''
+    predictions of many experiments on the shared test grid, from 
+    table 'predictions' in one query per SQLITE_MAX_IDS experiments
+
+    exp_ids: experiment ids
+    db: open connection to use, default a new one to config.FILE_DB
+    return x: test grid (float64 numpy array, sorted)
+        fx_pred: (len(exp_ids), len(x)) array; NaN where an 
+        experiment has no prediction at x
+    '''
+    own_db = db is None
+    if own_db:
+        db = sqlite3.connect(config.FILE_DB)
+    try:
+        rows = np.array(_select_in(db, """
+            SELECT exp_id, x, fx_pred FROM predictions WHERE exp_id IN ({});
+        """, exp_ids), dtype=np.float64).reshape(-1, 3)
+    finally:
+        if own_db:
+            db.close()
+
+    x, col = np.unique(rows[:, 1], return_inverse=True)
+    # position of each row's exp_id in exp_ids
+    ids = np.asarray(exp_ids)
+    order = np.argsort(ids)
+    row = order[np.searchsorted(ids[order], rows[:, 0])]
+    fx_pred = np.full((len(exp_ids), len(x)), np.nan)
+    fx_pred[row, col] = rows[:, 2]
+
+    return x, fx_pred
+
+# ----------------------------------------------------------------    
+def _select_in(db, sql_qry, ids):
+    # rows of sql_qry with its "IN ({})" filled with ids, in chunks of 
+    # SQLITE_MAX_IDS (SQLite's limit on bound variables)
+    ids = list(ids)
+    rows = []
+    for first in range(0, len(ids), SQLITE_MAX_IDS):
+        chunk = ids[first:first + SQLITE_MAX_IDS]
+        rows.extend(db.execute(sql_qry.format(", ".join("?"*len(chunk))), 
+                               chunk).fetchall())
+
+    return rows
+
+def _execute_in(db, sql_qry, param, ids):
+    # sql_qry with parameters param, then its "IN ({})" filled with 
+    # ids, in chunks of SQLITE_MAX_IDS as in _select_in
+    ids = list(ids)
+    for first in range(0, len(ids), SQLITE_MAX_IDS):
+        chunk = ids[first:first + SQLITE_MAX_IDS]
+        db.execute(sql_qry.format(", ".join("?"*len(chunk))), 
+                   list(param) + chunk)
+
+# ----------------------------------------------------------------    
+def migrate_loss(file_db=None, drop_rows=True):
+    '''
+    converts the per-epoch rows of table 'loss' into one 'loss_curve'
+    BLOB per experiment, for nnfit.db files written with 
+    LOSS_STORAGE = 'rows'. Experiments that already have a curve 
+    are skipped.
+
+    file_db: database file, default config.FILE_DB
+    drop_rows: delete the converted rows and VACUUM the file
+    return number of experiments converted
+    '''
+    create_tables(file_db)
+    db = connect(file_db)
+    try:
+        exp_ids = [row[0] for row in db.execute("""
+            SELECT DISTINCT exp_id FROM loss 
+            WHERE exp_id NOT IN (SELECT exp_id FROM loss_curve);
+        """)]
+        with db:
+            cursor = db.cursor()
+            for exp_id in exp_ids:
+                rows = cursor.execute("""
+                    SELECT epoch, mse FROM loss WHERE exp_id = ? 
+                    ORDER BY epoch;
+                """, (exp_id,)).fetchall()
+                _insert_curve(cursor, exp_id, _curve_from_rows(rows))
+            if drop_rows:
+                cursor.execute("""
+                    DELETE FROM loss 
+                    WHERE exp_id IN (SELECT exp_id FROM loss_curve);
+                """)
+        if drop_rows:
+            db.execute("VACUUM;")
+    finally:
+        db.close()
+
+    return len(exp_ids)
+
+# ----------------------------------------------------------------    
+def build_summary(file_db=None):
+    '''
+    fills table 'summary' for experiments saved without it, from
+    their loss curves (wall time unknown); creates missing tables 
+    and indexes first
+
+    file_db: database file, default config.FILE_DB
+    return number of experiments added
+    '''
+    create_tables(file_db)
+    db = connect(file_db)
+    try:
+        exp_ids = [row[0] for row in db.execute("""
+            SELECT id FROM ini 
+            WHERE id NOT IN (SELECT exp_id FROM summary)
+            AND (id IN (SELECT exp_id FROM loss_curve) 
+                OR id IN (SELECT exp_id FROM loss));
+        """)]
+        with db:
+            cursor = db.cursor()
+            for exp_id in exp_ids:
+                _insert_summary(cursor, exp_id, read_loss(exp_id, db))
+    finally:
+        db.close()
+
+    return len(exp_ids)
+
+# ----------------------------------------------------------------    
+def top_k(k=10, order_by='final_mse', **filters):
+    '''
+    best k experiments from table 'summary'
+
+    k: number of experiments
+    order_by: 'final_mse', 'min_mse', 'conv_epoch' or 'wall_time'
+    filters: conditions on columns of table 'ini', either a value
+        (fx='A', mb=3) or a (low, high) range (eta=(0.1, 0.5))
+    return list of dicts with SUMMARY_COLS
+    '''
+    if order_by not in SUMMARY_COLS[2:]:
+        raise ValueError(f"top_k: cannot order by {order_by}")
+    where = []
+    param = []
+    for col, value in filters.items():
+        if col not in INI_COLS:
+            raise ValueError(f"top_k: unknown ini column {col}")
+        if isinstance(value, tuple):
+            where.append(f"i.{col} BETWEEN ? AND ?")
+            param.extend(value)
+        else:
+            where.append(f"i.{col} = ?")
+            param.append(value)
+    sql_qry_sel = f"""
+        SELECT {", ".join("s." + col for col in SUMMARY_COLS)}
+        FROM summary s
+        JOIN ini i ON i.id = s.exp_id
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY s.{order_by} IS NULL, s.{order_by}
+        LIMIT ?;
+    """
+    with sqlite3.connect(config.FILE_DB) as db:
+        rows = db.execute(sql_qry_sel, param + [k]).fetchall()
+
+    return [dict(zip(SUMMARY_COLS, row)) for row in rows]
+
+# ----------------------------------------------------------------    
+def leaderboard(k=5, order_by='final_mse'):
+    '''
+    best k experiments for each function fx in table 'summary'
+
+    return dict {fx: list of dicts with SUMMARY_COLS}
+    '''
+    if order_by not in SUMMARY_COLS[2:]:
+        raise ValueError(f"leaderboard: cannot order by {order_by}")
+    sql_qry_sel = f"""
+        SELECT {", ".join(SUMMARY_COLS)}
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY fx 
+                ORDER BY {order_by} IS NULL, {order_by}) AS rank
+            FROM summary)
+        WHERE rank <= ?
+        ORDER BY fx, rank;
+    """
+    board = {}
+    with sqlite3.connect(config.FILE_DB) as db:
+        for row in db.execute(sql_qry_sel, (k,)):
+            board.setdefault(row[1], []).append(dict(zip(SUMMARY_COLS, row)))
+
+    return board
+
+# ----------------------------------------------------------------    
+def read_cache(keys, file_db=None):
+    '''
+    results stored in table 'cache' for any of 'keys'; their last use 
+    and hit count are updated
+
+    keys: experiment keys (see cache.experiment_key)
+    file_db: database file, default config.FILE_DB
+    return dict {key: stdout dict}, for the keys found
+    '''
+    found = {}
+    db = connect(file_db)
+    try:
+        with db:
+            rows = _select_in(db, """
+                SELECT key, stdout FROM cache WHERE key IN ({});
+            """, keys)
+            found.update((key, json.loads(zlib.decompress(blob))) 
+                         for key, blob in rows)
+            db.executemany("""
+                UPDATE cache SET used = ?, hits = hits + 1 WHERE key = ?;
+            """, ((time.time(), key) for key in found))
+    finally:
+        db.close()
+
+    return found
+
+# ----------------------------------------------------------------    
+def write_cache(entries, file_db=None):
+    '''
+    stores results in table 'cache', in one transaction
+
+    entries: list of (key, stdout dict)
+    file_db: database file, default config.FILE_DB
+    '''
+    now = time.time()
+    rows = []
+    for key, stdout in entries:
+        blob = zlib.compress(json.dumps(stdout).encode())
+        rows.append((key, blob, len(blob), now, now))
+    db = connect(file_db)
+    try:
+        with db:
+            db.executemany("""
+                INSERT OR REPLACE INTO cache (key, stdout, size, created, used) 
+                VALUES (?, ?, ?, ?, ?);
+            """, rows)
+    finally:
+        db.close()
+
+# ----------------------------------------------------------------    
+def evict_cache(max_entries, max_bytes, file_db=None):
+    '''
+    deletes the least recently used results of table 'cache' until 
+    it holds at most max_entries results and max_bytes of stdout
+
+    return number of results deleted
+    '''
+    db = connect(file_db)
+    try:
+        with db:
+            count, size = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache;").fetchone()
+            evict = []
+            if count > max_entries or size > max_bytes:
+                for key, entry_size in db.execute(
+                        "SELECT key, size FROM cache ORDER BY used;"):
+                    if count <= max_entries and size <= max_bytes:
+                        break
+                    evict.append((key,))
+                    count -= 1
+                    size -= entry_size
+            db.executemany("DELETE FROM cache WHERE key = ?;", evict)
+    finally:
+        db.close()
+
+    return len(evict)
+
+# ----------------------------------------------------------------    
+def cache_stats(file_db=None):
+    '''
+    return dict: entries, bytes and hits of table 'cache'
+    '''
+    with sqlite3.connect(file_db or config.FILE_DB) as db:
+        entries, size, hits = db.execute("""
+            SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) 
+            FROM cache;
+        """).fetchone()
+
+    return {"entries": entries, "bytes": size, "hits": hits}
+
+# ----------------------------------------------------------------    
+def enqueue_jobs(sweep, exp_ids):
+    '''
+    adds experiments already in table 'ini' to the job queue (table
+    'jobs') as pending; experiments already queued are left as they are
+    '''
+    with connect() as db:
+        db.executemany("""
+            INSERT OR IGNORE INTO jobs (exp_id, sweep) VALUES (?, ?);
+        """, ((exp_id, sweep) for exp_id in exp_ids))
+    db.close()
+
+# ----------------------------------------------------------------    
+def claim_jobs(worker, n, timeout, max_attempts):
+    '''
+    claims up to n pending jobs for 'worker', in one write transaction
+    (BEGIN IMMEDIATE), so that no two workers get the same job. Jobs 
+    of workers without a heartbeat for 'timeout' seconds are pending
+    again first, or failed after max_attempts; jobs whose result is
+    stored are done
+
+    return exp_ids of the claimed jobs, in order
+    '''
+    now = time.time()
+    db = connect()
+    db.isolation_level = None # transaction below
+    try:
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            db.execute("""
+                UPDATE jobs SET worker = NULL, 
+                    status = CASE WHEN attempts >= ? THEN 'failed' 
+                        ELSE 'pending' END,
+                    error = 'no heartbeat from ' || worker
+                WHERE status = 'running' AND heartbeat < ?;
+            """, (max_attempts, now - timeout))
+            db.execute("""
+                UPDATE jobs SET status = 'done' WHERE status != 'done' 
+                AND exp_id IN (SELECT id FROM ini WHERE done = 1);
+            """)
+            exp_ids = [row[0] for row in db.execute("""
+                SELECT exp_id FROM jobs WHERE status = 'pending' 
+                ORDER BY exp_id LIMIT ?;
+            """, (n,))]
+            db.executemany("""
+                UPDATE jobs SET status = 'running', worker = ?, 
+                    heartbeat = ?, attempts = attempts + 1 
+                WHERE exp_id = ?;
+            """, ((worker, now, exp_id) for exp_id in exp_ids))
+            db.execute("COMMIT;")
+        except BaseException:
+            db.execute("ROLLBACK;")
+            raise
+    finally:
+        db.close()
+
+    return exp_ids
+
+# ----------------------------------------------------------------    
+def heartbeat_jobs(worker, exp_ids):
+    '''
+    'worker' is alive: heartbeat of its running jobs among exp_ids
+    '''
+    with connect() as db:
+        _execute_in(db, """
+            UPDATE jobs SET heartbeat = ? 
+            WHERE worker = ? AND status = 'running' AND exp_id IN ({});
+        """, [time.time(), worker], exp_ids)
+    db.close()
+
+# ----------------------------------------------------------------    
+def release_jobs(worker, exp_ids, error, max_attempts):
+    '''
+    jobs among exp_ids still running for 'worker' (e.g. its engines
+    failed) are pending again, or failed after max_attempts
+    '''
+    with connect() as db:
+        _execute_in(db, """
+            UPDATE jobs SET worker = NULL, error = ?,
+                status = CASE WHEN attempts >= ? THEN 'failed' 
+                    ELSE 'pending' END
+            WHERE worker = ? AND status = 'running' AND exp_id IN ({});
+        """, [error, max_attempts, worker], exp_ids)
+    db.close()
+
+# ----------------------------------------------------------------    
+def job_counts(sweep=None):
+    '''
+    return dict {status: number of jobs}, of a sweep or of all
+    '''
+    with sqlite3.connect(config.FILE_DB) as db:
+        rows = db.execute("""
+            SELECT status, COUNT(*) FROM jobs 
+            WHERE ? IS NULL OR sweep = ? GROUP BY status;
+        """, (sweep, sweep)).fetchall()
+
+    return dict(rows)
+
+# ----------------------------------------------------------------    
+def find_training_set(fx, a, b, c, ts_size, seed):
+    '''
+    ts_id of the stored training set of function fx with parameters
+    a, b, c, size ts_size and TS seed 'seed' (ini ts_seed), as the 
+    c_engine looks it up before generating one; None if there is none
+    (or no table 'training_sets' yet)
+    '''
+    # the engine stores a, b and c as the floats it read
+    param = (fx, *(float(np.float32(v)) for v in (a, b, c)), ts_size, seed)
+    try:
+        with sqlite3.connect(config.FILE_DB) as db:
+            row = db.execute("""
+                SELECT id FROM training_sets 
+                WHERE fx = ? AND a = ? AND b = ? AND c = ? AND ts_size = ?
+                    AND seed = ?;
+            """, param).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+    return row[0] if row else None
+
+# ----------------------------------------------------------------    
+def resolve_ts_id(ts_id=None):
+    '''
+    ts_id, or if None or 0 the last training set stored, as the 
+    c_engine does; 0 for a database from before table 
+    'training_sets' (its one unversioned TS)
+    '''
+    if ts_id:
+        return ts_id
+    try:
+        with sqlite3.connect(config.FILE_DB) as db:
+            row = db.execute("SELECT MAX(id) FROM training_sets;").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+
+    return row[0] or 0
+
+# ----------------------------------------------------------------    
+def ts_file(ts_id):
+    '''
+    binary file of training set ts_id, as named by the c_engine: 
+    config.FILE_TS with _<ts_id> before its extension (xfx_3.bin), or
+    config.FILE_TS itself for ts_id 0 (unversioned)
+    '''
+    if not ts_id:
+        return config.FILE_TS
+    base, ext = os.path.splitext(config.FILE_TS)
+
+    return f"{base}_{ts_id}{ext}"
+
+# ----------------------------------------------------------------    
+def read_ts_file(ts_id=None, verify=False, file_ts=None):
+    '''
+    maps the binary TS file written by the c_engine (np.memmap, no 
+    copy: pages are shared with the engines mapping the same file)
+
+    ts_id: training set, default the last one (see resolve_ts_id)
+    verify: check the records against the header's CRC-32
+    file_ts: binary TS file, default the one of ts_id (see ts_file)
+    return header (dict: ts_size, fx, a, b, c, checksum, ts_id, seed)
+        and records (read-only structured array with fields 'x' and 
+        'fx')
+    '''
+    file_ts = file_ts or ts_file(resolve_ts_id(ts_id))
+    header = np.fromfile(file_ts, dtype=TS_HEADER_DTYPE, count=1)
+    if len(header) == 0 or header['magic'][0] != TS_MAGIC \
+            or header['version'][0] != TS_VERSION:
+        raise ValueError(f"{file_ts}: not a binary TS file")
+    header = {key: header[key][0].item() for key in 
+              ('ts_size', 'fx', 'a', 'b', 'c', 'checksum', 'ts_id', 'seed')}
+    header['fx'] = header['fx'].decode()
+    records = np.memmap(file_ts, dtype=TS_RECORD_DTYPE, mode='r', 
+        offset=TS_HEADER_DTYPE.itemsize, shape=(header['ts_size'],))
+    if verify and zlib.crc32(records) != header['checksum']:
+        raise ValueError(f"{file_ts}: checksum mismatch")
+
+    return header, records
+
+# ----------------------------------------------------------------    
+def write_ts_file(fx, a, b, c, file_ts=None):
+    '''
+    writes the unversioned training set in table 'xfx' to the binary
+    TS file, for databases created before the c_engine wrote it
+
+    fx, a, b, c: function and parameters of the training set
+    file_ts: binary TS file, default config.FILE_TS
+    '''
+    file_ts = file_ts or config.FILE_TS
+    x, fx_ts = read_ts_db()
+    records = np.empty(len(x), dtype=TS_RECORD_DTYPE)
+    records['x'] = x
+    records['fx'] = fx_ts
+    header = np.zeros(1, dtype=TS_HEADER_DTYPE)
+    header[0] = (TS_MAGIC, TS_VERSION, len(x), fx.encode(), b"", 
+                 a, b, c, zlib.crc32(records), 0, 0)
+    # same as the engine: write aside, then rename
+    tmp_name = f"{file_ts}.{os.getpid()}.tmp"
+    with open(tmp_name, 'wb') as bin_file:
+        bin_file.write(header.tobytes())
+        bin_file.write(records.tobytes())
+    os.replace(tmp_name, file_ts)
+
+# ----------------------------------------------------------------    
+def read_ts(ts_id=None):
+    '''
+    reads the training set ts_id (default the last one): from its 
+    binary TS file if there is one, else from table 'xfx'
+
+    return x, fx: float32 numpy arrays
+    '''
+    ts_id = resolve_ts_id(ts_id)
+    try:
+        _, records = read_ts_file(ts_id)
+    except (OSError, ValueError):
+        return read_ts_db(ts_id)
+
+    return records['x'], records['fx']
+
+# ----------------------------------------------------------------    
+def read_ts_db(ts_id=None):
+    '''
+    reads the training set ts_id (default the last one; 0: all rows, 
+    of an unversioned database) from table 'xfx'
+
+    return x, fx: float32 numpy arrays
+    '''
+    ts_id = resolve_ts_id(ts_id)
+    sql_qry_sel = f"""
+        SELECT x, fx
+        FROM xfx
+        {"WHERE ts_id = ?" if ts_id else ""}
+        ORDER BY id;
+    """
+    with sqlite3.connect(config.FILE_DB) as db:
+        cursor = db.cursor()
+        cursor.execute(sql_qry_sel, (ts_id,) if ts_id else ())
+        rows = cursor.fetchall()
+    xfx = np.array(rows, dtype=np.float32).reshape(-1, 2)
+
+    return xfx[:, 0].copy(), xfx[:, 1].copy()
 
 if __name__ == '__main__':
-    None
+    # python db.py migrate_loss [file.db]: converts loss rows to BLOBs
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate_loss':
+        file_db = sys.argv[2] if len(sys.argv) > 2 else None
+        print(f"converted {migrate_loss(file_db)} loss curves")
@@ -3,24 +3,31 @@
 # handles experiments generation and predictions
 
 import random
+import secrets
+
+import numpy as np
 
 import config
-import db
 
 # -------------------------------------------------------------------
 def generate_wb_points(num_of_exps, w_extreme, bl1_extreme):
     '''
-    Generates a number of points in parameter space
+    Generates a number of points in parameter space, each with its
+    own seed (ini_data "seed"); points and seeds are derived from the
+    seed of config.ini, so the same seed gives the same sweep
     :param num_of_exps: the number of points
     :param w_extreme: the boundaries of each w
     :param bl1_extreme: the boundaries of each b^(1)
     '''
+    # load config.ini into ini_data_original
+    ini_data_original = config.read(config.FILE_CONFIG) 
+    sweep_seed = ini_data_original["seed"] or new_seed()
+    rng = random.Random(sweep_seed)
+    seeds = derive_seeds(sweep_seed, num_of_exps)
     # use rnd numbers to generate set of {w's,b's} sets
     # use extremes to bound the possible {w's,b's}
     wb = [{} for _ in range(num_of_exps)]
-    wb_template = {"w00l1": 0, "w10l1": 0, "w20l1": 0, "w00l2": 0, 
-        "w01l2": 0, "w02l2": 0, "b0l1": 0, "b1l1": 0, "b2l1": 0 , 
-        "b0l2": 0}
+    wb_template = config.wb_keys(ini_data_original["hidden"])
     for i in range(num_of_exps):
         # Generate all points {w,b} in parameter-space 
         # and store in list of dict wb=[{exp 1}, {exp 2}, ...]
@@ -28,16 +35,14 @@ def generate_wb_points(num_of_exps, w_extreme, bl1_extreme):
             if k == "b0l2": 
                 wb[i][k] = 0
             # improve with gauss distribution
-            elif k in ("w00l1", "w10l1", "w20l1"):
-                wb[i][k] = round(random.uniform(-w_extreme, w_extreme), 4)
-            elif k in ("w00l2", "w01l2", "w02l2"):
-                wb[i][k] = round(random.uniform(-w_extreme, w_extreme), 4)
-            elif k in ( "b0l1", "b1l1", "b2l1"):
-                wb[i][k] = round(random.uniform(-bl1_extreme, bl1_extreme), 4)
+            elif k.endswith("l1") and k.startswith("w"):
+                wb[i][k] = round(rng.uniform(-w_extreme, w_extreme), 4)
+            elif k.endswith("l2") and k.startswith("w"):
+                wb[i][k] = round(rng.uniform(-w_extreme, w_extreme), 4)
+            elif k.endswith("l1") and k.startswith("b"):
+                wb[i][k] = round(rng.uniform(-bl1_extreme, bl1_extreme), 4)
 
-    # load config.ini into ini_data_original
     ini_data_all_points = [{} for _ in range(num_of_exps)]
-    ini_data_original = config.read(config.FILE_CONFIG) 
     # LOOP over all points {w,b} in parameter-space
     for i in range(num_of_exps):
         # concatenates a single (new) ini_data from: wb + ini_data_original
@@ -46,53 +51,108 @@ def generate_wb_points(num_of_exps, w_extreme, bl1_extreme):
             ini_data[k] = ini_data_original[k]
         for k in wb[i]:
             ini_data[k] = wb[i][k]
+        ini_data["seed"] = seeds[i]
         ini_data_all_points[i] = ini_data # store ini_data for each exp in list
 
     return ini_data_all_points
 
+# -------------------------------------------------------------------
+def new_seed():
+    '''
+    a random seed for the engine's RNG, 1...2^32-1 (0 is "from the 
+    clock")
+    '''
+    return secrets.randbits(32) or 1
+
+# -------------------------------------------------------------------
+def derive_seeds(seed, n):
+    '''
+    n seeds for the engine's RNG derived from 'seed', independent of
+    each other and the same on every platform and run (NumPy
+    SeedSequence); never 0
+    '''
+    state = np.random.SeedSequence(seed).generate_state(n, dtype=np.uint32)
+
+    return [int(s) or 1 for s in state]
+
 
 # -------------------------------------------------------------------
 def predictions(opt_wb, test_size, exp_id):
     '''
-    Performs predictions using the given ini_data parameters on
-    a test set of size test_size
-    :param ini_data: dictionary with all parameters
+    Performs predictions using the given optimal wb on the shared
+    test grid of size test_size (see test_grid)
+    :param opt_wb: [exp_id, w00l1, ..., b0l2] as from db.save_optimal_wb
+        (flat layout, see predict_batch)
     :param test_size: size of test set
-    :return predictions (dict): keys are x, values are fx_predicted
-    '''
-    # model parameters
-    w00l1 = opt_wb[1]
-    w10l1 = opt_wb[2]
-    w20l1 = opt_wb[3]
-    w00l2 = opt_wb[4]
-    w01l2 = opt_wb[5]
-    w02l2 = opt_wb[6]
-    b0l1 = opt_wb[7]
-    b1l1 = opt_wb[8]
-    b2l1 = opt_wb[9]
-    b0l2 =opt_wb[10]
-    predictions = [{} for _ in range(test_size)] # [{x:fx_pred}, ...}]
-    for i in range(test_size):
-        x = round(random.uniform(-config.X_EXTREME, config.X_EXTREME), 4)
-        a0l1 = ReLu(w00l1*x + b0l1)
-        a1l1 = ReLu(w10l1*x + b1l1)
-        a2l1 = ReLu(w20l1*x + b2l1)
-        # forward propagation
-        fx_pred = round(w00l2*a0l1 + w01l2*a1l1 + w02l2*a2l1 + b0l2, 4)
-        predictions[i][x] = fx_pred
+    :return predictions (list of dicts): [{x: fx_pred}, ...]
+    '''
+    x_grid = test_grid(test_size)
+    fx_pred = predict_batch(np.array([opt_wb[1:]]), x_grid)[0]
     
-    return predictions
+    return [{float(x): float(fx)} for x, fx in zip(x_grid, fx_pred)]
+
+# -------------------------------------------------------------------
+def test_grid(test_size):
+    '''
+    fixed test grid shared by all experiments, so their predictions
+    can be compared point for point
+    :param test_size: number of points in [-X_EXTREME, X_EXTREME]
+    '''
+    return np.linspace(-config.X_EXTREME, config.X_EXTREME, test_size)
+
+# -------------------------------------------------------------------
+def predict_batch(opt_wb, x_grid):
+    '''
+    forward pass of every experiment on every grid point at once
+    :param opt_wb: (num_of_exps, 3*hidden + 1) matrix in the flat 
+        layout of config.wb_keys: w1 (hidden), w2 (hidden), b1 (hidden),
+        b2, as from db.optimal_wb
+    :param x_grid: (test_size,) test points
+    :return fx_pred: (num_of_exps, test_size) predictions
+    '''
+    opt_wb = np.asarray(opt_wb, dtype=float)
+    h = (opt_wb.shape[1] - 1) // 3 # hidden width
+    w1 = opt_wb[:, 0:h]
+    w2 = opt_wb[:, h:2*h]
+    b1 = opt_wb[:, 2*h:3*h]
+    b2 = opt_wb[:, 3*h]
+    # (exp, x, neuron) activations of layer 1
+    a1 = np.maximum(x_grid[None, :, None]*w1[:, None, :] 
+                    + b1[:, None, :], 0)
     
+    return np.einsum('exn,en->ex', a1, w2) + b2[:, None]
 
 # -------------------------------------------------------------------
-def ReLu(z):
+def evaluate(opt_wb, x_grid, fx, a, b, c):
     '''
-    ReLu activation function
+    predictions of all experiments on the test grid plus their
+    test MSE against the analytic f(x)
+    :param opt_wb: (num_of_exps, 3*hidden + 1) matrix, see predict_batch
+    :param x_grid: (test_size,) test points
+    :param fx, a, b, c: function and parameters, as in table ini
+    :return fx_pred (num_of_exps, test_size), mse (num_of_exps,)
     '''
-    if z <= 0:
-        z = 0
+    fx_pred = predict_batch(opt_wb, x_grid)
+    fx_true = calculate_fx(x_grid, fx, a, b, c)
+    mse = ((fx_pred - fx_true[None, :])**2).mean(axis=1)
     
-    return z
+    return fx_pred, mse
+
+# -------------------------------------------------------------------
+def calculate_fx(x, fx, a, b, c):
+    '''
+    analytic f(x), same definitions as the c_engine:
+    (A) a*(x-b)^2+c, (B) a*x+b, (C) a*cos(b*x)+c
+    '''
+    if fx == "A":
+        return a*(x - b)*(x - b) + c
+    elif fx == "B":
+        return a*x + b
+    elif fx == "C":
+        return a*np.cos(b*x) + c
+    else:
+        raise ValueError(f"unknown fx: {fx}")
+
 
 if __name__ == '__main__':
     None
\ No newline at end of file
@@ -0,0 +1,291 @@
+# -------------------------------------------------------------------
+# jobs.py: job queue module
+# the experiments of a sweep as jobs in table 'jobs' of nnfit.db, run
+# by any number of independent worker processes: more capacity is
+# more workers, and a dead worker only loses its heartbeat
+#
+# usage: python3 jobs.py [--data-dir d] enqueue [--pending]
+#        python3 jobs.py [--data-dir d] work [--backend b] [--batch n] 
+#                        [--wait] [--timeout s]
+#        python3 jobs.py [--data-dir d] status
+#        python3 jobs.py [--data-dir d] finish
+#        python3 jobs.py check [--workers n] [--exps n] [--no-kill]
+
+import argparse
+import contextlib
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import config
+import db
+import runner
+
+#global
+HEARTBEAT_EVERY = 5 # seconds between heartbeats of a worker
+JOB_TIMEOUT = 60 # seconds without heartbeat before a job is reclaimed
+MAX_ATTEMPTS = 3 # claims of a job before it is marked failed
+POLL_EVERY = 2 # seconds between claims when the queue is empty
+# check: experiments long enough (epochs, no convergence) that a worker
+# can be killed while it runs them, and reclaimed after a short timeout
+CHECK_EPOCHS = 20000
+CHECK_TIMEOUT = 3
+CHECK_WAIT = 300 # seconds before a check gives up on its workers
+
+# -------------------------------------------------------------------
+def enqueue(pending=False):
+    '''
+    a new sweep (initialization run, new TS and random points, see
+    main.new_sweep) in the job queue; with pending, the experiments
+    of the last sweep that are not done instead (e.g. of an
+    interrupted main)
+    :return sweep number and exp_ids queued
+    '''
+    import main as orchestrator # main() below is this module's CLI
+    db.create_tables()
+    runner.compile_c(config.C_ENGINE_DIR)
+    if pending:
+        sweep, exp_ids, ini_data_all_points = db.read_pending()
+        if sweep is None:
+            return None, []
+    else:
+        sweep, exp_ids, ini_data_all_points = orchestrator.new_sweep()
+    db.enqueue_jobs(sweep, exp_ids)
+
+    return sweep, exp_ids
+
+# -------------------------------------------------------------------
+def work(backend=None, batch=None, wait=False, worker=None, 
+         timeout=JOB_TIMEOUT):
+    '''
+    worker loop: claims up to 'batch' jobs at a time (default
+    config.NUM_OF_WORKERS), runs them with runner.run_sweep and stores
+    each result as it arrives, which also marks its job done. A
+    heartbeat thread keeps the claimed jobs alive; if the worker
+    dies, other workers reclaim them after JOB_TIMEOUT seconds.
+    Stops when no job is pending or running, or never with 'wait'
+
+    :param backend: see runner.run_sweep
+    :param worker: worker name, default host:pid
+    :param timeout: seconds without heartbeat before a job of another
+        worker is reclaimed; heartbeats are sent at least 3 times as 
+        often
+    :return number of jobs run
+    '''
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    batch = batch or config.NUM_OF_WORKERS
+    db.create_tables()
+    os.makedirs(config.CHECKPOINT_DIR, exist_ok=True)
+    num_done = 0
+    with db.ResultWriter() as writer:
+        while True:
+            exp_ids = db.claim_jobs(worker, batch, timeout, MAX_ATTEMPTS)
+            if not exp_ids:
+                # jobs of other workers may still come back
+                if wait or db.job_counts().get('running', 0) > 0:
+                    time.sleep(POLL_EVERY)
+                    continue
+                break
+            # a reclaimed job continues from its checkpoint, if its
+            # last worker ran it with the 'process' backend
+            checkpoints = [os.path.join(config.CHECKPOINT_DIR,
+                f"exp_{exp_id}.ckpt") for exp_id in exp_ids]
+            with _heartbeat(worker, exp_ids, 
+                            min(HEARTBEAT_EVERY, timeout/3)):
+                try:
+                    all_stdout = runner.run_sweep(db.read_ini(exp_ids),
+                        backend, checkpoints=checkpoints)
+                    for exp_id, stdout in zip(exp_ids, all_stdout):
+                        writer.save_result(exp_id, stdout)
+                        num_done += 1
+                except BaseException as e:
+                    # jobs not stored yet go back to the queue now
+                    db.release_jobs(worker, exp_ids, repr(e), MAX_ATTEMPTS)
+                    raise
+
+    return num_done
+
+# -------------------------------------------------------------------
+def finish(sweep=None):
+    '''
+    once all jobs of a sweep (default the last one) are done:
+    predictions and test MSE of all its experiments (main.test_sweep)
+    :return exp_ids of the sweep, or None if jobs are left
+    '''
+    import main as orchestrator
+    if sweep is None:
+        sweep = db.read_pending()[0]
+    counts = db.job_counts(sweep)
+    if counts.get('pending', 0) or counts.get('running', 0):
+        return None
+    exp_ids = db.sweep_exp_ids(sweep)
+    ini_data = db.read_ini(exp_ids[:1])[0]
+
+    return orchestrator.test_sweep(sweep, ini_data)
+
+# -------------------------------------------------------------------
+def check(num_workers=3, num_of_exps=12, kill=True):
+    '''
+    end-to-end check of the queue with local worker processes sharing
+    one nnfit.db, in a temporary data directory: enqueues a sweep of
+    num_of_exps experiments (CHECK_EPOCHS epochs each), kills a first
+    worker with SIGKILL once it runs jobs (unless not kill), runs 
+    num_workers workers to the end, then finishes the sweep twice.
+    Passes if every job is done exactly once, the killed worker's jobs
+    were reclaimed, and the second finish changes nothing
+    :return True if the check passed
+    '''
+    keys = ['FILE_DB', 'FILE_TS', 'FILE_CONFIG', 'FILE_CONFIG_1ST', 
+            'CHECKPOINT_DIR', 'NUM_OF_EXP']
+    saved = {key: getattr(config, key) for key in keys}
+    with tempfile.TemporaryDirectory(prefix="nnfit_jobs_") as data_dir:
+        try:
+            ini_data = config.read(config.FILE_CONFIG_1ST)
+            _use_data_dir(data_dir)
+            ini_data.update(epoch_num=CHECK_EPOCHS, delta=0)
+            config.FILE_CONFIG_1ST = os.path.join(data_dir, "config_1st.ini")
+            config.update(ini_data, config.FILE_CONFIG_1ST)
+            config.NUM_OF_EXP = num_of_exps
+            sweep, exp_ids = enqueue()
+            return _check_sweep(data_dir, sweep, exp_ids, num_workers, kill)
+        finally:
+            for key, value in saved.items():
+                setattr(config, key, value)
+
+def _check_sweep(data_dir, sweep, exp_ids, num_workers, kill):
+    cmd = [sys.executable, os.path.abspath(__file__), "--data-dir", 
+           data_dir, "work", "--batch", "2", "--timeout", str(CHECK_TIMEOUT)]
+    start = time.monotonic()
+    if kill:
+        victim = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        while not db.job_counts(sweep).get('running', 0):
+            if victim.poll() is not None \
+                    or time.monotonic() - start > CHECK_WAIT:
+                print("check: the first worker ran no job")
+                victim.kill()
+                return False
+            time.sleep(0.1)
+        victim.kill()
+        victim.wait()
+        print(f"check: worker {victim.pid} killed, "
+              f"{db.job_counts(sweep).get('running', 0)} jobs left running")
+    workers = [subprocess.Popen(cmd, stdout=subprocess.DEVNULL) 
+               for _ in range(num_workers)]
+    codes = [worker.wait(timeout=CHECK_WAIT) for worker in workers]
+    print(f"check: {num_workers} workers done in "
+          f"{time.monotonic() - start:.1f} s, exit codes {codes}")
+
+    counts = db.job_counts(sweep)
+    tested = [finish(sweep), finish(sweep)]
+    with sqlite3.connect(config.FILE_DB) as db_con:
+        reclaimed, = db_con.execute("""
+            SELECT COUNT(*) FROM jobs WHERE sweep = ? AND attempts > 1;
+        """, (sweep,)).fetchone()
+        results, = db_con.execute("""
+            SELECT COUNT(*) FROM optimal_wb WHERE exp_id IN 
+                (SELECT id FROM ini WHERE sweep = ?);
+        """, (sweep,)).fetchone()
+        predictions, = db_con.execute("""
+            SELECT COUNT(*) FROM predictions WHERE exp_id IN 
+                (SELECT id FROM ini WHERE sweep = ?);
+        """, (sweep,)).fetchone()
+    checks = {
+        "workers exited cleanly": codes == [0]*num_workers,
+        "all jobs done": counts == {'done': len(exp_ids)},
+        "one result per job": results == len(exp_ids),
+        "killed worker's jobs reclaimed": reclaimed > 0 or not kill,
+        "finish tested the sweep": None not in tested,
+        "finish twice, same predictions": 
+            predictions == len(exp_ids)*config.TEST_SIZE}
+    for name, passed in checks.items():
+        print(f"check: {'ok  ' if passed else 'FAIL'} {name}")
+    print(f"check: jobs {counts}, {reclaimed} reclaimed, "
+          f"{results} results, {predictions} predictions")
+
+    return all(checks.values())
+
+def _use_data_dir(data_dir):
+    # nnfit.db, TS files, config.ini and checkpoints in data_dir, 
+    # e.g. a directory shared by the workers of several hosts
+    config.FILE_DB = os.path.join(data_dir, "nnfit.db")
+    config.FILE_TS = os.path.join(data_dir, "xfx.bin")
+    config.FILE_CONFIG = os.path.join(data_dir, "config.ini")
+    config.CHECKPOINT_DIR = os.path.join(data_dir, "checkpoints")
+
+# -------------------------------------------------------------------
+@contextlib.contextmanager
+def _heartbeat(worker, exp_ids, every=HEARTBEAT_EVERY):
+    # heartbeats of the jobs in exp_ids every 'every' seconds, from a
+    # thread, while the with block runs
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(every):
+            db.heartbeat_jobs(worker, exp_ids)
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+# -------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="nnfit job queue")
+    parser.add_argument("--data-dir", 
+        help="directory of nnfit.db, TS files, config.ini and "
+             "checkpoints, default the data directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("enqueue", help="queue a new sweep")
+    cmd.add_argument("--pending", action="store_true",
+        help="queue the experiments of the last sweep not done instead")
+    cmd = commands.add_parser("work", help="run queued jobs")
+    cmd.add_argument("--backend", choices=['process', 'worker', 'numpy',
+        'library'], help="default config.BACKEND")
+    cmd.add_argument("--batch", type=int,
+        help="jobs claimed at a time, default config.NUM_OF_WORKERS")
+    cmd.add_argument("--wait", action="store_true",
+        help="keep polling when the queue is empty")
+    cmd.add_argument("--timeout", type=float, default=JOB_TIMEOUT,
+        help=f"seconds without heartbeat before a job is reclaimed, "
+             f"default {JOB_TIMEOUT}")
+    commands.add_parser("status", help="jobs by status")
+    commands.add_parser("finish",
+        help="predictions and test MSE of the finished sweep")
+    cmd = commands.add_parser("check", 
+        help="end-to-end check with local workers, in a temporary directory")
+    cmd.add_argument("--workers", type=int, default=3)
+    cmd.add_argument("--exps", type=int, default=12, help="experiments")
+    cmd.add_argument("--no-kill", action="store_true",
+        help="do not kill a worker")
+    args = parser.parse_args(argv)
+    if args.data_dir:
+        _use_data_dir(args.data_dir)
+
+    if args.command == "enqueue":
+        sweep, exp_ids = enqueue(args.pending)
+        print(f"sweep {sweep}: {len(exp_ids)} jobs queued")
+    elif args.command == "work":
+        num_done = work(args.backend, args.batch, args.wait, 
+                        timeout=args.timeout)
+        print(f"{num_done} jobs run")
+    elif args.command == "status":
+        db.create_tables()
+        print(", ".join(f"{status}: {count}" for status, count
+                        in sorted(db.job_counts().items())) or "no jobs")
+    elif args.command == "finish":
+        exp_ids = finish()
+        print("jobs left: sweep not finished" if exp_ids is None
+              else f"{len(exp_ids)} experiments tested")
+    elif args.command == "check":
+        if not check(args.workers, args.exps, not args.no_kill):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
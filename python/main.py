@@ -2,15 +2,19 @@
 # main.py: orchestrator module
 # pipelines the execution of all modules
 
+import argparse
 import os
+import sys
 
 import db
 import config
 import runner
+import scheduler
 import experiments
 import analysis
+import timing
 
-def main():
+def main(argv=None):
     '''
     Orchestrator:
     
@@ -24,68 +28,204 @@ def main():
         to the same training set
     
     By default, the c_engine is compiled
+
+    With --resume, the last sweep is finished instead: experiments
+    already stored are skipped, and with BACKEND = 'process' running
+    ones continue from their checkpoints
+
+    With --headless (the default without a display), the screen is
+    not cleared, no plot window is opened and main never waits for
+    Enter: matplotlib is not even imported. --plot-dir saves the 
+    plots of the best experiment as files instead, in any mode
     '''
-    os.system('cls||clear')
+    parser = argparse.ArgumentParser(description="nnfit orchestrator")
+    parser.add_argument("--resume", action="store_true", 
+        help="finish the last (interrupted) sweep")
+    parser.add_argument("--headless", action="store_true", 
+        help="batch mode: no screen clearing, plot windows or prompt")
+    parser.add_argument("--plot-dir", 
+        help="save the loss and f(x) plots to this directory")
+    args = parser.parse_args(argv)
+    headless = args.headless or not has_display()
+    if not headless:
+        os.system('cls||clear')
     
 
-    # ----------------- initialization run
-    # reads config_1st.ini always with new_ts = 'Y'
     print()
     print("initializing...\n")
     db.create_tables()
-    ini_data = config.read(config.FILE_CONFIG_1ST) 
-    # copies FILE_CONFIG_1ST to FILE_CONFIG 
-    config.update(ini_data, config.FILE_CONFIG)
     # compiles c_engine
     runner.compile_c(config.C_ENGINE_DIR)
-    # first run: to initialize xfx table
-    runner.run_c(config.FILE_C_ENGINE)
-    # updates parameter new_TS = 'N' in ini_data
-    # and loads it into working file FILE_CONFIG
-    ini_data['new_ts'] = 'N'
-    config.update(ini_data, config.FILE_CONFIG)
+    if args.resume:
+        sweep, exp_ids, ini_data_all_points = db.read_pending()
+        if sweep is None:
+            print("no sweep to resume")
+            return
+        print(f"resuming sweep {sweep}: {len(exp_ids)} experiments left\n")
+    else:
+        sweep, exp_ids, ini_data_all_points = new_sweep()
+    ini_data = config.read(config.FILE_CONFIG)
 
 
     # ----------------- experimental runs
-    # list of ini_data dictionaries
-    ini_data_all_points = experiments.generate_wb_points(
-        config.NUM_OF_EXP, config.W_EXTREME, config.bl1_EXTREME)
-    # runs experiments from each wb_data_points
+    # runs experiments from each wb_data_points, NUM_OF_WORKERS 
+    # engines at a time; results arrive in experiment order
+    checkpoints = [os.path.join(config.CHECKPOINT_DIR, f"exp_{exp_id}.ckpt")
+                   for exp_id in exp_ids]
+    os.makedirs(config.CHECKPOINT_DIR, exist_ok=True)
+    rungs = None
+    if config.SCHEDULER == 'halving':
+        all_stdout, rungs = scheduler.successive_halving(ini_data_all_points)
+    elif config.SCHEDULER == 'hyperband':
+        all_stdout, rungs = scheduler.hyperband(ini_data_all_points)
+    else:
+        all_stdout = runner.run_sweep(ini_data_all_points, 
+                                      checkpoints=checkpoints)
     i = 0
     print("experiment number:   ", end = "")
-    for ini_data in ini_data_all_points:
-        # print progress 
-        print(f"\b\b\b{i:3}", end = "", flush = True)
-        # updates config.ini
-        config.update(ini_data, config.FILE_CONFIG) 
-        # stores new ini_data in db
-        exp_id = db.save_experiment(ini_data) 
-        # runs c_engine and capture stdout: w, b, loss
-        stdout = runner.run_c(config.FILE_C_ENGINE) 
-        # stores wb at the end of gradient descent
-        opt_wb = db.save_optimal_wb(stdout, exp_id)
-        # stores loss from stdout in db table loss
-        db.save_loss(stdout, exp_id)
-        # predicts using the optimal (last) set of wb
-        predicts = experiments.predictions(opt_wb, config.TEST_SIZE, exp_id)
-        # store predictions using the optimal (last) set of wb
-        db.save_predictions(predicts, exp_id)
-        i = i + 1
+    exp_timings = [] # phase timings of each experiment, see timing.py
+    num_cached = 0 # results taken from the cache, see cache.py
+    sweep_timings = timing.new()
+    # one connection for the whole sweep, written from a background 
+    # thread so that storing results never waits on disk
+    with db.ResultWriter(background=True) as writer:
+        for exp_id, stdout in zip(exp_ids, all_stdout):
+            # print progress 
+            print(f"\b\b\b{i:3}", end = "", flush = True)
+            # stores wb at the end of gradient descent and loss 
+            # from stdout in db
+            writer.save_result(exp_id, stdout) 
+            exp_timings.append(stdout.get("timings"))
+            num_cached += stdout.get("cached", False)
+            i = i + 1
+        if rungs is not None:
+            writer.save_rungs(sweep, exp_ids, rungs)
+    if sweep_timings is not None:
+        sweep_timings["db_save"] = writer.write_time
+    run_exp_ids = exp_ids
+    exp_ids = test_sweep(sweep, ini_data, sweep_timings)
+    if sweep_timings is not None:
+        with db.ResultWriter() as writer:
+            writer.save_timings(sweep, run_exp_ids, exp_timings, 
+                                sweep_timings)
     print("")
+    if num_cached:
+        print(f"{num_cached} results from the cache")
+    # where the time of the sweep went
+    if sweep_timings is not None:
+        print("")
+        timing.print_summary(exp_timings, sweep_timings)
     
     # ----------------- analysis and visualization
     # among all experiments, find the lowest loss
     print("")
     best_exp = analysis.find_min_loss()
+    # plots to files: no display needed
+    if args.plot_dir is not None:
+        os.makedirs(args.plot_dir, exist_ok=True)
+        analysis.plot_loss(best_exp, os.path.join(args.plot_dir, "loss.png"))
+        analysis.plot_function(best_exp, 
+                               os.path.join(args.plot_dir, "fx.png"))
+        analysis.plot_losses(exp_ids, 
+                             os.path.join(args.plot_dir, "losses.png"))
+        print(f"plots saved to {args.plot_dir}")
+    if headless:
+        return
     # loss curve
     print("")
     analysis.plot_loss(best_exp)
     # function curve
     analysis.plot_function(best_exp)
+    # loss percentiles of the whole sweep
+    analysis.plot_losses(exp_ids)
     # script ended
     input("Finished! Press Enter to exit and close the plot.")
-    
 
+# -------------------------------------------------------------------
+def test_sweep(sweep, ini_data, sweep_timings=None):
+    '''
+    once all results of a sweep are stored: removes its checkpoints,
+    predicts all its experiments on the test grid and stores the
+    predictions and test MSE (see experiments.evaluate)
+
+    :param ini_data: ini_data dictionary with the function of the TS
+        (fx, a, b, c)
+    :param sweep_timings: timings dict, gets "predict" and "db_test"
+    :return exp_ids of the sweep
+    '''
+    # results are stored: checkpoints of the sweep are not needed anymore
+    exp_ids = db.sweep_exp_ids(sweep)
+    for exp_id in exp_ids:
+        checkpoint = os.path.join(config.CHECKPOINT_DIR, f"exp_{exp_id}.ckpt")
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+    # predicts all experiments of the sweep at once, using their 
+    # optimal (last) set of wb, on one test grid shared by all
+    with timing.phase(sweep_timings, "predict"):
+        opt_wbs = db.read_optimal_wbs(exp_ids)
+        x_grid = experiments.test_grid(config.TEST_SIZE)
+        fx_pred, mse = experiments.evaluate(opt_wbs, x_grid, 
+            ini_data['fx'], ini_data['a'], ini_data['b'], ini_data['c'])
+    # store grid once, and predictions and test MSE of all experiments
+    with db.ResultWriter() as writer:
+        with timing.phase(sweep_timings, "db_test"):
+            writer.save_test_grid(x_grid)
+            writer.save_test_results(exp_ids, x_grid, fx_pred, mse)
+
+    return exp_ids
+
+# -------------------------------------------------------------------
+def has_display():
+    '''
+    True if plot windows can be opened: always on Windows and macOS,
+    else if an X11 or Wayland display is set
+    '''
+    if os.name == 'nt' or sys.platform == 'darwin':
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+# -------------------------------------------------------------------
+def new_sweep():
+    '''
+    initialization run (none if the training set of config_1st.ini
+    was generated before), then a new sweep of random points stored 
+    in db (see db.save_pending)
+    return sweep number, exp_ids and ini_data of its experiments
+    '''
+    # ----------------- initialization run
+    # reads config_1st.ini always with new_ts = 'Y'
+    ini_data = config.read(config.FILE_CONFIG_1ST) 
+    # seeds of the sweep and of its TS: recorded in FILE_CONFIG, they 
+    # regenerate the same points and experiment seeds, and the same TS
+    ini_data['seed'] = ini_data['seed'] or experiments.new_seed()
+    ini_data['ts_seed'] = ini_data['ts_seed'] or experiments.new_seed()
+    # a training set of the same fx, parameters, size and TS seed is 
+    # reused: no initialization run
+    ts_key = [ini_data[key] for key in ('fx', 'a', 'b', 'c', 'ts_size', 
+                                        'ts_seed')]
+    ts_id = db.find_training_set(*ts_key)
+    if ts_id is None or not os.path.exists(db.ts_file(ts_id)):
+        # copies FILE_CONFIG_1ST to FILE_CONFIG 
+        config.update(ini_data, config.FILE_CONFIG)
+        # first run: to store the training set in tables training_sets
+        # and xfx, and its binary copy xfx_<ts_id>.bin
+        runner.run_c(config.FILE_C_ENGINE, config.FILE_CONFIG, 
+                     config.FILE_DB, config.FILE_TS)
+        ts_id = db.find_training_set(*ts_key)
+    # updates parameter new_TS = 'N' and the training set of all 
+    # experiments in ini_data, and loads it into working file FILE_CONFIG
+    ini_data['new_ts'] = 'N'
+    ini_data['ts_id'] = ts_id or ini_data['ts_id']
+    config.update(ini_data, config.FILE_CONFIG)
+
+    # list of ini_data dictionaries
+    ini_data_all_points = experiments.generate_wb_points(
+        config.NUM_OF_EXP, config.W_EXTREME, config.bl1_EXTREME)
+    # stored before running, so that the sweep can be resumed
+    sweep, exp_ids = db.save_pending(ini_data_all_points)
+
+    return sweep, exp_ids, ini_data_all_points
+    
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,204 @@
+# -------------------------------------------------------------------
+# npengine.py: NumPy engine module
+# trains all experiments of a sweep at once, as stacked weights,
+# with the same optimizers and eta auto-adjust rules as c_engine/nnfit.c
+
+import numpy as np
+
+import config
+
+#global
+ETA_ADJUSTMENT = 0.8 # eta *= ETA_ADJUSTMENT when loss stalls
+EPOCH_CHK_FREQ = 5 # convergence (loss < delta) checked every n epochs
+ADAM_EPS = np.float32(1e-8) # as in c_engine/nnfit.h
+
+# -------------------------------------------------------------------
+def stack_wb(ini_data_all_points):
+    '''
+    stack the initial weights and biases of all experiments
+    return w1, b1, w2 (num_of_exps x hidden) and b2 (num_of_exps) as 
+    float32; all experiments need the same hidden width
+    '''
+    hidden = ini_data_all_points[0]["hidden"]
+    if any(d["hidden"] != hidden for d in ini_data_all_points):
+        raise ValueError("npengine: all experiments need the same hidden width")
+    keys = config.wb_keys(hidden)
+    wb = np.array([[d[key] for key in keys] for d in ini_data_all_points],
+                  dtype=np.float32)
+    w1 = wb[:, 0:hidden].copy()
+    w2 = wb[:, hidden:2*hidden].copy()
+    b1 = wb[:, 2*hidden:3*hidden].copy()
+    b2 = wb[:, 3*hidden].copy()
+
+    return w1, b1, w2, b2
+
+# -------------------------------------------------------------------
+def train(ini_data_all_points, x_ts, fx_ts):
+    '''
+    trains all experiments together: one forward and backward pass
+    per minibatch covers every experiment (experiment x minibatch
+    tensors). Each experiment shuffles the TS on its own, stops when
+    its loss drops below its delta and adjusts its own eta, and has
+    its own optimizer (see update). Shuffles are drawn from a NumPy
+    generator per experiment, seeded with its ini_data "seed" (0 = 
+    unseeded): an experiment shuffles the same in any sweep, though
+    not as in the C engine, whose RNG is another.
+
+    :param ini_data_all_points: list of ini_data dictionaries, all
+        with the same mini-batch size
+    :param x_ts, fx_ts: training set, as read by db.read_ts
+    :return: list of stdout dicts, as returned by runner.run_c
+    '''
+    if len(ini_data_all_points) == 0:
+        return []
+    mb_size = ini_data_all_points[0]["mb"]
+    if any(d["mb"] != mb_size for d in ini_data_all_points):
+        raise ValueError("npengine: all experiments need the same mb size")
+    rngs = [np.random.default_rng(d.get("seed") or None) 
+            for d in ini_data_all_points]
+
+    num_of_exps = len(ini_data_all_points)
+    ts_size = len(x_ts)
+    mb_number = ts_size // mb_size
+    x_ts = np.asarray(x_ts, dtype=np.float32)
+    fx_ts = np.asarray(fx_ts, dtype=np.float32)
+    w1, b1, w2, b2 = stack_wb(ini_data_all_points)
+    eta = np.array([d["eta"] for d in ini_data_all_points])
+    delta = np.array([d["delta"] for d in ini_data_all_points])
+    epoch_num = np.array([d["epoch_num"] for d in ini_data_all_points])
+    max_epochs = int(epoch_num.max())
+    # optimizer of each experiment, and its state per parameter array
+    opt = Optimizers(ini_data_all_points)
+    params = [w1, b1, w2, b2]
+    states = [opt.new_state(p) for p in params]
+
+    C_epoch = np.zeros((num_of_exps, max_epochs))
+    epoch_converged = np.zeros(num_of_exps, dtype=int)
+    epochs_trained = np.zeros(num_of_exps, dtype=int)
+    active = np.ones(num_of_exps, dtype=bool)
+
+    # loop all epochs
+    for epoch_index in range(max_epochs):
+        active &= epoch_index < epoch_num
+        if not active.any():
+            break
+        # shuffle TS for each epoch, independently per experiment
+        shuffled = np.stack([rng.permutation(ts_size) for rng in rngs])
+        # eta of stopped experiments is zero: their wb stay put
+        eta_mb = np.where(active, eta, 0.).astype(np.float32)
+
+        # loop all minibatches from 0...mb_number
+        for mb_index in range(mb_number):
+            mb = shuffled[:, mb_index*mb_size:(mb_index + 1)*mb_size]
+            x = x_ts[mb][:, :, None] # (exp, mb, 1)
+            fx = fx_ts[mb]          # (exp, mb)
+            # forward pass
+            z1 = x*w1[:, None, :] + b1[:, None, :] # (exp, mb, hidden)
+            a1 = np.maximum(z1, 0)
+            a2 = (a1*w2[:, None, :]).sum(axis=2) + b2[:, None]
+            # backward pass
+            error_layer_2 = a2 - fx
+            error_layer_1 = error_layer_2[:, :, None]*w2[:, None, :] \
+                *(z1 > 0)
+            # minibatch averages of C and gradC
+            C = 0.5*(error_layer_2*error_layer_2).mean(axis=1)
+            grad_w2 = (error_layer_2[:, :, None]*a1).mean(axis=1)
+            grad_w1 = (error_layer_1*x).mean(axis=1)
+            grad_b2 = error_layer_2.mean(axis=1)
+            grad_b1 = error_layer_1.mean(axis=1)
+            # update of wb
+            step = epoch_index*mb_number + mb_index + 1
+            for p, grad, state in zip(params, 
+                    [grad_w1, grad_b1, grad_w2, grad_b2], states):
+                opt.update(p, grad, state, eta_mb, step)
+            # accumulating C from all mb
+            C_epoch[:, epoch_index] += C
+        C_epoch[:, epoch_index] /= mb_number # average
+        epochs_trained[active] = epoch_index + 1
+
+        C_now = C_epoch[:, epoch_index]
+        # check, every EPOCH_CHK_FREQ if C converged
+        if epoch_index % EPOCH_CHK_FREQ == 0:
+            active &= ~(C_now < delta)
+        epoch_converged[active] = epoch_index
+
+        # auto-adjust eta for faster convergence
+        if epoch_index > 0:
+            C_prev = C_epoch[:, epoch_index - 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                change = np.abs(2*(C_prev - C_now)/(C_prev + C_now))
+            eta = np.where(active & (change < eta),
+                           eta*ETA_ADJUSTMENT, eta)
+
+    # same layout as the c_engine stdout
+    all_stdout = []
+    for i in range(num_of_exps):
+        all_stdout.append({
+            "weights": {
+                "w_layer_1": w1[i].tolist(),
+                "b_layer_1": b1[i].tolist(),
+                "w_layer_2": w2[i].tolist(),
+                "b_layer_2": float(b2[i])
+            },
+            "eta": float(eta[i]),
+            "loss": {str(epoch): float(C_epoch[i, epoch])
+                     for epoch in range(epoch_converged[i])},
+            "epochs_trained": int(epochs_trained[i])
+        })
+
+    return all_stdout
+
+# -------------------------------------------------------------------
+class Optimizers:
+    '''
+    the update rules of mb_step in c_engine/nnfit_train.c, one per
+    experiment (its ini_data "optimizer", "beta1" and "beta2"), for
+    parameter arrays stacked by experiment (first axis)
+    '''
+    def __init__(self, ini_data_all_points):
+        kind = np.array([config.OPTIMIZERS.index(d["optimizer"]) 
+                         for d in ini_data_all_points])
+        self.sgd = (kind == 0).all() # no state needed
+        self.momentum = kind == config.OPTIMIZERS.index('momentum')
+        self.nesterov = kind == config.OPTIMIZERS.index('nesterov')
+        self.adam = kind == config.OPTIMIZERS.index('adam')
+        self.beta1 = np.array([d["beta1"] for d in ini_data_all_points],
+                              dtype=np.float32)
+        self.beta2 = np.array([d["beta2"] for d in ini_data_all_points],
+                              dtype=np.float32)
+
+    def new_state(self, p):
+        '''
+        zero state of parameter array p: velocity or Adam 1st moment,
+        and Adam 2nd moment
+        '''
+        return None if self.sgd else (np.zeros_like(p), np.zeros_like(p))
+
+    def update(self, p, grad, state, eta, step):
+        '''
+        one update of parameter array p, in place, by its minibatch 
+        gradient; 'eta' (float32) per experiment, 'step' the updates
+        done so far, this one included (Adam bias correction)
+        '''
+        col = (slice(None),) + (None,)*(p.ndim - 1) # per experiment
+        if self.sgd:
+            p -= eta[col]*grad
+            return
+        m, v = state
+        beta1 = self.beta1[col]
+        beta2 = self.beta2[col]
+        heavy = (self.momentum | self.nesterov)[col]
+        adam = self.adam[col]
+        m[...] = np.where(heavy, beta1*m + grad, 
+                          np.where(adam, beta1*m + (1 - beta1)*grad, m))
+        v[...] = np.where(adam, beta2*v + (1 - beta2)*grad*grad, v)
+        m_hat = m/(1 - beta1**step)
+        v_hat = v/(1 - beta2**step)
+        adam_step = m_hat/(np.sqrt(v_hat) + ADAM_EPS)
+        direction = np.select([self.momentum[col], self.nesterov[col], adam],
+                              [m, grad + beta1*m, adam_step], grad)
+        p -= eta[col]*direction
+
+
+if __name__ == '__main__':
+    None
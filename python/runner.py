@@ -4,8 +4,25 @@
 
 import subprocess
 import json
+import math
+import os
+import queue
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import cengine
+import config
+import db
+import npengine
+import timing
 
 #global
+# worker mode: order of the values in a job line, followed by the
+# weights and biases in config.wb_keys(hidden) order
+JOB_KEYS = ['mb', 'eta', 'epoch_num', 'delta', 'optimizer', 'beta1', 
+            'beta2', 'seed', 'hidden']
 
 # -------------------------------------------------------------------
 def compile_c(file_dir):
@@ -21,10 +38,22 @@ def compile_c(file_dir):
  
 
 # -------------------------------------------------------------------
-def run_c(file_name):
+def run_c(file_name, file_config=None, file_db=None, file_ts=None, 
+          threads=None, checkpoint=None, timings=None):
     '''
-    run the c_engine 'file_name' and capture stdout JSON data
-    of the type:
+    run the c_engine 'file_name' and capture stdout JSON data,
+    plus the run's "wall_time" in seconds.
+    'file_config', 'file_db' and 'file_ts' override the engine's 
+    default ../data/config.ini, ../data/nnfit.db and ../data/xfx.bin
+    (the name the file of each training set is derived from, see
+    db.ts_file);
+    'threads' sets the threads for the minibatch gradient (-t). 
+    'checkpoint': file where the engine saves its state every
+    config.CHECKPOINT_EVERY epochs, and resumes from if it exists
+    (-k, -K, -r). 'timings': phases timed before the run (see timing);
+    with config.TIMINGS, stdout gets "timings": these, plus "engine" 
+    (the whole process), the engine's own phases and "parse". 
+    Output is of the type:
     {
         "weights": {
             "w_layer_1": [0.03896, -1.76536, 1.73470],
@@ -32,20 +61,332 @@ def run_c(file_name):
             "w_layer_2": [-0.042738, 1.014976, 1.029441],
             "b_layer_2": -0.266997
         },
+        "eta": 0.000106338,
         "loss": {
             "0": 0.039609,
             "1": 0.002054,
             ...  
-        }
+        },
+        "epochs_trained": 100
     }
+    "eta" is the learning rate after its auto-adjustments.
+    "epochs_trained" is epoch_num, or fewer if the loss converged.
+    '''
+    args = engine_args(file_name, file_config, file_db, file_ts, threads)
+    if checkpoint is not None:
+        args.extend(["-k", checkpoint, "-K", str(config.CHECKPOINT_EVERY), 
+                     "-r"])
+    timings = dict(timings or {}) if config.TIMINGS else None
+    start = time.perf_counter()
+    try:
+        with timing.phase(timings, "engine"):
+            result = subprocess.run(args, capture_output=True, text=True)
+    except FileNotFoundError:
+        print("File not found.")
+        exit()
+    with timing.phase(timings, "parse"):
+        stdout = json.loads(result.stdout)
+    stdout["wall_time"] = time.perf_counter() - start
+    timing.from_engine(stdout, timings)
+
+    return stdout
+
+# -------------------------------------------------------------------
+def engine_args(file_name, file_config=None, file_db=None, file_ts=None, 
+                threads=None):
+    '''
+    command line of the c_engine 'file_name', see run_c
+    '''
+    args = [file_name]
+    if file_config is not None:
+        args.extend(["-c", file_config])
+    if file_db is not None:
+        args.extend(["-d", file_db])
+    if file_ts is not None:
+        args.extend(["-f", file_ts])
+    if threads is not None:
+        args.extend(["-t", str(threads)])
+    if config.ENGINE_CHUNK > 0:
+        args.extend(["-S", str(config.ENGINE_CHUNK)])
+    if config.TIMINGS:
+        args.append("-T")
+
+    return args
+
+# -------------------------------------------------------------------
+def stream_c(file_name, file_config=None, file_db=None, file_ts=None, 
+             threads=None, every=1):
+    '''
+    run the c_engine in streaming mode (-s every) and yield its 
+    records as they arrive, one per line:
+        {"epoch": 0, "loss": 0.039609}      every 'every' epochs
+        ...
+        {"weights": {...}, "epochs": 99, "epochs_trained": 100, 
+         "wall_time": 0.02}                                    last
+    "epochs" is the number of epochs of the "loss" of run_c. 
+    Closing the generator (or leaving a for loop over it with break,
+    then close) kills the engine: this is how a run is aborted.
+    Neither side keeps the loss curve, so memory does not grow with
+    epoch_num. Other arguments as in run_c.
     '''
+    args = engine_args(file_name, file_config, file_db, file_ts, threads)
+    args.extend(["-s", str(every)])
+    start = time.perf_counter()
     try:
-        result = subprocess.run([file_name], capture_output=True, text=True)
+        engine = subprocess.Popen(args, stdout=subprocess.PIPE, text=True, 
+                                  bufsize=1)
     except FileNotFoundError:
         print("File not found.")
         exit()
+    try:
+        for line in engine.stdout:
+            record = json.loads(line)
+            if "weights" in record:
+                record["wall_time"] = time.perf_counter() - start
+                timings = timing.new()
+                if timings is not None:
+                    timings["engine"] = record["wall_time"]
+                timing.from_engine(record, timings)
+            yield record
+    finally:
+        if engine.poll() is None:
+            engine.kill()
+        engine.stdout.close()
+        engine.wait()
+
+# -------------------------------------------------------------------
+def diverged(record):
+    '''
+    default abort rule of run_streamed: the loss is NaN or infinite
+    '''
+    return "loss" in record and not math.isfinite(record["loss"])
+
+# -------------------------------------------------------------------
+def run_streamed(ini_data, every=1, abort=diverged, file_db=None):
+    '''
+    run one experiment in streaming mode and store it as it runs: 
+    ini_data goes to 'ini' first, then the loss every 'every' epochs 
+    in chunks (see db.LossStream), then the optimal wb.
+
+    :param ini_data: ini_data dictionary (new_ts must be 'N')
+    :param every: epochs between loss records
+    :param abort: called with each record; True kills the engine,
+        keeping the loss stored so far (no optimal wb)
+    :param file_db: database, default config.FILE_DB
+    :return exp_id and the last record: the final weights, or the
+        record that aborted the run
+    '''
+    with tempfile.TemporaryDirectory(prefix="nnfit_") as work_dir:
+        file_config = os.path.join(work_dir, "config.ini")
+        config.update(ini_data, file_config)
+        with db.LossStream(ini_data, file_db) as loss_stream:
+            records = stream_c(config.FILE_C_ENGINE, file_config, 
+                               file_db or config.FILE_DB, config.FILE_TS, 
+                               config.ENGINE_THREADS, every)
+            record = None
+            try:
+                for record in records:
+                    if "weights" in record:
+                        loss_stream.finish(record)
+                    else:
+                        loss_stream.append(record["epoch"], record["loss"])
+                        if abort is not None and abort(record):
+                            break
+            finally:
+                records.close()
+
+    return loss_stream.exp_id, record
+
+# -------------------------------------------------------------------
+def run_c_pool(file_name, ini_data_all_points, num_workers, 
+               checkpoints=None):
+    '''
+    run one c_engine per ini_data, 'num_workers' at a time.
+    Each experiment gets its own config file in a temporary
+    directory, so experiments never share config.ini; the
+    training set is only read (new_ts must be 'N').
+    Yields the stdout dicts in the order of 'ini_data_all_points'
+    
+    :param file_name: c_engine executable
+    :param ini_data_all_points: list of ini_data dictionaries
+    :param num_workers: number of engines running at the same time
+    :param checkpoints: optional checkpoint file per experiment, see
+        run_c
+    '''
+    with tempfile.TemporaryDirectory(prefix="nnfit_") as work_dir:
+        def run_one(i):
+            file_config = os.path.join(work_dir, f"config_{i}.ini")
+            timings = timing.new()
+            with timing.phase(timings, "config_write"):
+                config.update(ini_data_all_points[i], file_config)
+            stdout = run_c(file_name, file_config, config.FILE_DB, 
+                           config.FILE_TS, config.ENGINE_THREADS, 
+                           checkpoints[i] if checkpoints else None, timings)
+            os.remove(file_config)
+            return stdout
+
+        # threads are enough: each one only waits on its engine process
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+            yield from pool.map(run_one, range(len(ini_data_all_points)))
+
+# -------------------------------------------------------------------
+def start_worker(file_name, file_db=None, file_ts=None, threads=None,
+                 ts_id=None):
+    '''
+    start the c_engine 'file_name' in worker mode (-w): it loads
+    the training set 'ts_id' (-i, default the last one) once and then
+    trains one job per line sent with run_job, until stop_worker
+    '''
+    args = engine_args(file_name, None, file_db, file_ts, threads) + ["-w"]
+    if ts_id:
+        args.extend(["-i", str(ts_id)])
+    try:
+        worker = subprocess.Popen(args, stdin=subprocess.PIPE, 
+            stdout=subprocess.PIPE, text=True, bufsize=1)
+    except FileNotFoundError:
+        print("File not found.")
+        exit()
+
+    return worker
+
+# -------------------------------------------------------------------
+def run_job(worker, ini_data):
+    '''
+    send one experiment 'ini_data' to a running worker and wait for
+    its result, a stdout dict as returned by run_c
+    '''
+    keys = JOB_KEYS + config.wb_keys(ini_data["hidden"])
+    job = " ".join(str(ini_data[key]) for key in keys)
+    timings = timing.new()
+    start = time.perf_counter()
+    with timing.phase(timings, "engine"):
+        worker.stdin.write(job + "\n")
+        worker.stdin.flush()
+        line = worker.stdout.readline()
+    if not line:
+        raise RuntimeError("c_engine worker exited")
+    with timing.phase(timings, "parse"):
+        stdout = json.loads(line)
+    if "error" in stdout:
+        raise ValueError(f"c_engine worker: {stdout['error']}: {job}")
+    stdout["wall_time"] = time.perf_counter() - start
+    timing.from_engine(stdout, timings)
+
+    return stdout
+
+# -------------------------------------------------------------------
+def stop_worker(worker):
+    '''
+    close the worker's input and wait for it to exit
+    '''
+    worker.stdin.close()
+    worker.wait()
+
+# -------------------------------------------------------------------
+def run_c_workers(file_name, ini_data_all_points, num_workers):
+    '''
+    run a sweep on 'num_workers' long-lived c_engine workers,
+    kept alive for the whole sweep. Yields the stdout dicts in 
+    the order of 'ini_data_all_points', which all train on the 
+    training set of the first one
+    '''
+    num_workers = max(1, min(num_workers, len(ini_data_all_points)))
+    idle = queue.Queue()
+    ts_id = ini_data_all_points[0].get("ts_id") if ini_data_all_points \
+        else None
+    workers = [start_worker(file_name, config.FILE_DB, config.FILE_TS, 
+                            config.ENGINE_THREADS, ts_id) 
+               for _ in range(num_workers)]
+    for worker in workers:
+        idle.put(worker)
+
+    def run_one(ini_data):
+        worker = idle.get()
+        try:
+            return run_job(worker, ini_data)
+        finally:
+            idle.put(worker)
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            yield from pool.map(run_one, ini_data_all_points)
+    finally:
+        for worker in workers:
+            stop_worker(worker)
+
+# -------------------------------------------------------------------
+def run_sweep(ini_data_all_points, backend=None, num_workers=None, 
+              checkpoints=None, use_cache=None):
+    '''
+    run all experiments with the chosen backend (default 
+    config.BACKEND) and yield their stdout dicts in order
+    
+    :param ini_data_all_points: list of ini_data dictionaries
+    :param backend: 'process', 'worker', 'numpy' (all experiments
+        trained at once by npengine, in this process) or 'library'
+        (the engine's shared library, in this process, see cengine)
+    :param num_workers: engines running at the same time
+    :param checkpoints: checkpoint file per experiment, used by the
+        'process' backend only (see run_c)
+    :param use_cache: take the results of experiments that ran before
+        from the result cache (see cache.py), default config.CACHE
+    '''
+    backend = backend or config.BACKEND
+    num_workers = num_workers or config.NUM_OF_WORKERS
+    use_cache = config.CACHE if use_cache is None else use_cache
+    if backend not in ('process', 'worker', 'numpy', 'library'):
+        raise ValueError(f"unknown backend: {backend}")
+    def run(points, checkpoints):
+        return _run_backend(points, backend, num_workers, checkpoints)
+    if use_cache:
+        return cache.run_sweep(ini_data_all_points, run, backend, checkpoints)
+    return run(ini_data_all_points, checkpoints)
+
+# -------------------------------------------------------------------
+def _run_backend(ini_data_all_points, backend, num_workers, checkpoints):
+    # see run_sweep
+    ts_ids = list(dict.fromkeys(ini_data.get("ts_id", 0) 
+                                for ini_data in ini_data_all_points))
+    if backend != 'process' and len(ts_ids) > 1:
+        # one training set per run (each engine process reads its own):
+        # a run per set, results back in sweep order
+        all_stdout = [None]*len(ini_data_all_points)
+        for ts_id in ts_ids:
+            group = [i for i, ini_data in enumerate(ini_data_all_points)
+                     if ini_data.get("ts_id", 0) == ts_id]
+            for i, stdout in zip(group, _run_backend(
+                    [ini_data_all_points[i] for i in group], backend, 
+                    num_workers, None)):
+                all_stdout[i] = stdout
+        return iter(all_stdout)
+    ts_id = ts_ids[0] if ts_ids else None
+    if backend == 'process':
+        return run_c_pool(config.FILE_C_ENGINE, ini_data_all_points, 
+                          num_workers, checkpoints)
+    elif backend == 'worker':
+        return run_c_workers(config.FILE_C_ENGINE, ini_data_all_points, 
+                             num_workers)
+    elif backend == 'numpy':
+        x_ts, fx_ts = db.read_ts(ts_id)
+        start = time.perf_counter()
+        all_stdout = npengine.train(ini_data_all_points, x_ts, fx_ts)
+        # all trained together: each gets its share of the time
+        wall_time = (time.perf_counter() - start)/max(1, len(all_stdout))
+        for stdout in all_stdout:
+            stdout["wall_time"] = wall_time
+            if config.TIMINGS:
+                stdout["timings"] = {"engine": wall_time}
+        return iter(all_stdout)
+    elif backend == 'library':
+        # the mapped TS file is passed to the engine as is
+        try:
+            _, xfx = db.read_ts_file(ts_id)
+        except (OSError, ValueError):
+            xfx = db.read_ts(ts_id)
+        return cengine.run_sweep(ini_data_all_points, xfx, num_workers)
+    else:
+        raise ValueError(f"unknown backend: {backend}")
 
-    return json.loads(result.stdout)
 
 if __name__ == '__main__':
     None
@@ -0,0 +1,246 @@
+# -------------------------------------------------------------------
+# scheduler.py: sweep scheduler module
+# successive halving and hyperband over the points of a sweep: all
+# points train for a short budget, only the best ones go on
+
+import math
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+import config
+import db
+import experiments
+import runner
+import timing
+
+#global
+MIN_EPOCHS = 5 # budget of the first rung
+REDUCTION = 3 # 1/REDUCTION of the points survive each rung
+# check: backends that must give the same schedule, bit for bit (the
+# numpy engine sums in another order, and only comes close)
+CHECK_BACKENDS = ('worker', 'process', 'library')
+CHECK_EPOCHS = 50 # budget of the first rung of the check
+
+# -------------------------------------------------------------------
+def successive_halving(ini_data_all_points, min_epochs=MIN_EPOCHS,
+                       reduction=REDUCTION, max_epochs=None, backend=None):
+    '''
+    successive halving: rung 0 trains every point for min_epochs;
+    the best 1/reduction of the points (lowest last loss) resume
+    from their weights and eta for a budget 'reduction' times larger,
+    and so on until max_epochs or a single point is left.
+    Survivors are resumed, not retrained: their curves continue
+    (with a fresh optimizer state, see _resume_from). Points that 
+    converged (loss below delta) have finished, and are not promoted.
+
+    :param ini_data_all_points: list of ini_data dictionaries
+    :param min_epochs: epochs of rung 0
+    :param reduction: budget factor and survivor fraction per rung
+    :param max_epochs: total epochs of the last survivors, default
+        epoch_num of the first point
+    :param backend: see runner.run_sweep
+    :return all_stdout: one stdout dict per point, in order, as from
+        runner.run_c; "loss" is the whole curve over all its rungs,
+        by epoch since the start, and "epochs_trained" the epochs of 
+        all its rungs. The engine does not report the loss of the last
+        epoch of a run, so the last epoch of each rung has none
+    :return rungs: list of dicts (index, rung, epochs, loss,
+        promoted), one per point and rung; index in the sweep,
+        epochs trained so far, last loss
+    '''
+    num_of_exps = len(ini_data_all_points)
+    if num_of_exps == 0:
+        return [], []
+    max_epochs = max_epochs or ini_data_all_points[0]["epoch_num"]
+    jobs = [dict(ini_data) for ini_data in ini_data_all_points]
+    curves = [{} for _ in range(num_of_exps)] # loss by epoch
+    all_stdout = [None]*num_of_exps
+    rungs = []
+
+    candidates = list(range(num_of_exps))
+    trained = 0 # epochs trained by every candidate
+    rung = 0
+    while True:
+        budget = min(min_epochs*reduction**rung, max_epochs)
+        for i in candidates:
+            jobs[i]["epoch_num"] = budget - trained
+        results = runner.run_sweep([jobs[i] for i in candidates], backend)
+        converged = set()
+        for i, stdout in zip(candidates, results):
+            # a run stops early when it converges: then it trains
+            # fewer than epoch_num epochs
+            if stdout["epochs_trained"] < jobs[i]["epoch_num"]:
+                converged.add(i)
+            _resume_from(jobs[i], stdout)
+            curves[i].update((trained + int(epoch), loss) 
+                             for epoch, loss in stdout["loss"].items())
+            stdout["epochs_trained"] += trained
+            wall_time = all_stdout[i]["wall_time"] if all_stdout[i] else 0
+            stdout["wall_time"] = wall_time + stdout.get("wall_time", 0)
+            if all_stdout[i]:
+                stdout["timings"] = timing.merge(
+                    all_stdout[i].get("timings"), stdout.get("timings"))
+            all_stdout[i] = stdout
+
+        # best 1/reduction of the candidates go on, ranked at the same
+        # epoch: every candidate trained 'budget' epochs
+        ranked = sorted((i for i in candidates if i not in converged), 
+                        key=lambda i: _score(curves[i]))
+        done = budget >= max_epochs or len(ranked) <= 1
+        survivors = set() if done else \
+            set(ranked[:math.ceil(len(candidates)/reduction)])
+        for i in candidates:
+            rungs.append({"index": i, "rung": rung, "epochs": budget,
+                          "loss": _score(curves[i]),
+                          "promoted": i in survivors})
+        if done:
+            break
+        candidates = [i for i in candidates if i in survivors]
+        trained = budget
+        rung += 1
+
+    for i, stdout in enumerate(all_stdout):
+        stdout["loss"] = {str(epoch): loss
+                          for epoch, loss in sorted(curves[i].items())}
+
+    return all_stdout, rungs
+
+# -------------------------------------------------------------------
+def hyperband(ini_data_all_points, min_epochs=MIN_EPOCHS,
+              reduction=REDUCTION, max_epochs=None, backend=None):
+    '''
+    hyperband: the points are split into brackets, each run with
+    successive halving from a different first budget (min_epochs,
+    min_epochs*reduction, ...), so that slow starters are not all
+    cut after min_epochs. Brackets with larger first budgets get
+    fewer points. Same parameters and output as successive_halving;
+    rungs also have the "bracket" of each point
+    '''
+    num_of_exps = len(ini_data_all_points)
+    if num_of_exps == 0:
+        return [], []
+    max_epochs = max_epochs or ini_data_all_points[0]["epoch_num"]
+    s_max = max(0, int(math.log(max(1, max_epochs/min_epochs), reduction)))
+    # points per bracket, as in hyperband: n_s ~ reduction^s/(s + 1)
+    weights = [reduction**s/(s + 1) for s in range(s_max, -1, -1)]
+    sizes = [int(num_of_exps*w/sum(weights)) for w in weights]
+    sizes[0] += num_of_exps - sum(sizes)
+
+    all_stdout = []
+    rungs = []
+    first = 0
+    for bracket, size in enumerate(sizes):
+        if size == 0:
+            continue
+        s = s_max - bracket
+        bracket_stdout, bracket_rungs = successive_halving(
+            ini_data_all_points[first:first + size],
+            min(min_epochs*reduction**(s_max - s), max_epochs),
+            reduction, max_epochs, backend)
+        for row in bracket_rungs:
+            row["index"] += first
+            row["bracket"] = bracket
+        all_stdout.extend(bracket_stdout)
+        rungs.extend(bracket_rungs)
+        first += size
+
+    return all_stdout, rungs
+
+# -------------------------------------------------------------------
+def _resume_from(job, stdout):
+    # next rung starts from the weights and eta reached; the state of
+    # momentum or Adam is not in stdout, and starts again from zero.
+    # The seed moves on (derived from the last one, so the schedule is
+    # reproducible): the next rung does not repeat the shuffles of this
+    hidden = len(stdout["weights"]["w_layer_1"])
+    job.update(zip(config.wb_keys(hidden), db.optimal_wb(stdout)))
+    job["eta"] = stdout.get("eta", job["eta"])
+    if job.get("seed"):
+        job["seed"] = experiments.derive_seeds(job["seed"], 1)[0]
+
+def _score(curve):
+    # loss of the last epoch reported; points without a finite one 
+    # rank last
+    if len(curve) == 0 or not math.isfinite(curve[max(curve)]):
+        return math.inf
+    return curve[max(curve)]
+
+# -------------------------------------------------------------------
+def check(backends=CHECK_BACKENDS, num_of_exps=9, min_epochs=CHECK_EPOCHS):
+    '''
+    parity check of the backends over two rungs of successive halving,
+    in a temporary data directory and without the result cache: a 
+    sweep of num_of_exps points of config_1st.ini is scheduled with 
+    each backend. Passes if every backend promotes the same points
+    and ends with the same weights, eta and loss curves as the first,
+    so a rung resumed from the engine's output or from an ini file
+    (backend 'process') continues the same descent
+    :return True if the check passed
+    '''
+    import main as orchestrator
+    keys = ['FILE_DB', 'FILE_TS', 'FILE_CONFIG', 'CHECKPOINT_DIR', 
+            'NUM_OF_EXP', 'CACHE']
+    saved = {key: getattr(config, key) for key in keys}
+    with tempfile.TemporaryDirectory(prefix="nnfit_scheduler_") as data_dir:
+        try:
+            config.FILE_DB = os.path.join(data_dir, "nnfit.db")
+            config.FILE_TS = os.path.join(data_dir, "xfx.bin")
+            config.FILE_CONFIG = os.path.join(data_dir, "config.ini")
+            config.CHECKPOINT_DIR = os.path.join(data_dir, "checkpoints")
+            config.NUM_OF_EXP = num_of_exps
+            config.CACHE = False
+            db.create_tables()
+            _, _, ini_data_all_points = orchestrator.new_sweep()
+            results = {backend: successive_halving(
+                           ini_data_all_points, min_epochs, REDUCTION,
+                           min_epochs*REDUCTION, backend)
+                       for backend in backends}
+        finally:
+            for key, value in saved.items():
+                setattr(config, key, value)
+
+    first = backends[0]
+    ref_stdout, ref_rungs = results[first]
+    passed = True
+    for backend in backends[1:]:
+        all_stdout, rungs = results[backend]
+        checks = {
+            "same rungs": rungs == ref_rungs,
+            # as the float32 the engines train on: the engine prints 
+            # them with 9 digits, the library gives them exactly
+            "same weights": _float32_wb(all_stdout) == _float32_wb(ref_stdout),
+            "same eta": [stdout["eta"] for stdout in all_stdout]
+                == [stdout["eta"] for stdout in ref_stdout],
+            "same loss": [stdout["loss"] for stdout in all_stdout]
+                == [stdout["loss"] for stdout in ref_stdout]}
+        for name, ok in checks.items():
+            print(f"check: {'ok  ' if ok else 'FAIL'} {backend} vs "
+                  f"{first}: {name}")
+        passed = passed and all(checks.values())
+    promoted = sum(row["promoted"] for row in ref_rungs)
+    print(f"check: {num_of_exps} points, {promoted} promoted, "
+          f"{min_epochs} + {min_epochs*(REDUCTION - 1)} epochs")
+
+    return passed
+
+def _float32_wb(all_stdout):
+    return [np.float32(db.optimal_wb(stdout)).tolist() 
+            for stdout in all_stdout]
+
+# -------------------------------------------------------------------
+def main(argv):
+    '''
+    python3 scheduler.py check [backend ...]
+    '''
+    if len(argv) < 2 or argv[1] != 'check':
+        print(main.__doc__.strip())
+        return
+    if not check(tuple(argv[2:]) or CHECK_BACKENDS):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
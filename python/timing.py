@@ -0,0 +1,112 @@
+# -------------------------------------------------------------------
+# timing.py: timing module
+# per-phase timings of a sweep, from the engine phases (option -T) to
+# the orchestrator stages; switched off with config.TIMINGS = False
+
+import contextlib
+import time
+
+import config
+
+#global
+# phases in report order; "engine.*" are measured by the engine itself
+# and are part of "engine" (process or library call, as seen from
+# Python); the rest of "engine" is process spawn and pipes; "cache"
+# is the lookup of results taken from the cache (see cache.py)
+PHASES = ['cache', 'config_write', 'engine', 'engine.init', 'engine.ts_load',
+          'engine.shuffle', 'engine.gradient', 'engine.output', 'parse',
+          'db_save', 'predict', 'db_test']
+
+# -------------------------------------------------------------------
+@contextlib.contextmanager
+def phase(timings, name):
+    '''
+    adds the seconds spent in the with block to timings[name];
+    does nothing when timings is None (timings off)
+
+    usage:
+        with timing.phase(timings, "parse"):
+            stdout = json.loads(line)
+    '''
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+# -------------------------------------------------------------------
+def new():
+    '''
+    an empty timings dict, or None if config.TIMINGS is off
+    '''
+    return {} if config.TIMINGS else None
+
+# -------------------------------------------------------------------
+def from_engine(stdout, timings):
+    '''
+    moves the engine's "timings" of a stdout dict into 'timings' as
+    "engine.<phase>", and stores 'timings' as stdout["timings"]
+    '''
+    if timings is None:
+        return
+    for name, seconds in stdout.pop("timings", {}).items():
+        timings["engine." + name] = seconds
+    stdout["timings"] = timings
+
+# -------------------------------------------------------------------
+def merge(timings, other):
+    '''
+    phase by phase sum of two timings dicts (either may be None)
+    '''
+    if timings is None or other is None:
+        return timings or other
+    merged = dict(timings)
+    for name, seconds in other.items():
+        merged[name] = merged.get(name, 0) + seconds
+
+    return merged
+
+# -------------------------------------------------------------------
+def print_summary(exp_timings, sweep_timings=None):
+    '''
+    prints where the time of a sweep went: total and mean seconds of
+    each phase over all experiments, and its share of the total
+    (engine.* phases are shares of "engine")
+
+    :param exp_timings: list of timings dicts, one per experiment
+        (None entries are skipped)
+    :param sweep_timings: timings dict of the stages run once per sweep
+    '''
+    exp_timings = [t for t in exp_timings if t]
+    totals = {}
+    for timings in exp_timings + [sweep_timings or {}]:
+        for name, seconds in timings.items():
+            totals[name] = totals.get(name, 0) + seconds
+    if not totals:
+        return
+    whole = sum(seconds for name, seconds in totals.items()
+                if not name.startswith("engine."))
+    inside = sum(seconds for name, seconds in totals.items()
+                 if name.startswith("engine."))
+    if "engine" in totals and inside > 0:
+        totals["engine.spawn/other"] = max(0, totals["engine"] - inside)
+    order = PHASES[:PHASES.index('engine.output') + 1] \
+        + ['engine.spawn/other'] + PHASES[PHASES.index('parse'):]
+    names = [name for name in order if name in totals] \
+        + sorted(name for name in totals if name not in order)
+
+    print(f"timings of {len(exp_timings)} experiments:")
+    print(f"  {'phase':<22} {'total s':>10} {'mean ms':>10} {'share':>7}")
+    for name in names:
+        mean = 1e3*totals[name]/max(1, len(exp_timings))
+        label = "  " + name[len("engine."):] if name.startswith("engine.") \
+            else name
+        print(f"  {label:<22} {totals[name]:10.4f} {mean:10.3f} "
+              f"{100*totals[name]/whole if whole else 0:6.1f}%")
+
+
+if __name__ == '__main__':
+    None